@@ -1,4 +1,5 @@
 import asyncio
+import importlib
 import logging
 import sys
 
@@ -12,11 +13,17 @@ logger = logging.getLogger(__name__)
 
 def run():
     try:
+        from nyx_bot.startup import STARTUP_MODULES, startup_timer
+
+        for name in STARTUP_MODULES:
+            with startup_timer.step(f"import {name}"):
+                importlib.import_module(name)
+
         from . import main
 
         # Run the main function of the bot
-        asyncio.get_event_loop().run_until_complete(main.main())
+        asyncio.run(main.main())
     except ImportError as e:
         print("Unable to import nyx_box.main:", e)
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("Bye!")
@@ -2,7 +2,7 @@ import aiohttp
 from nio import AsyncClient, MatrixRoom, RoomMessageText
 
 from nyx_bot.chat_functions import send_text_to_room
-from nyx_bot.storage import ArchPackage
+from nyx_bot.storage import ArchPackage, run_db
 
 ARCHLINUXCN_PKGPATH = "https://repo.archlinuxcn.org/x86_64/archlinuxcn.db.tar.gz"
 
@@ -14,7 +14,7 @@ async def send_archlinuxcn_pkg(
     pkgname: str,
 ):
     # Only get the first matching one.
-    result = ArchPackage.get_or_none(ArchPackage.name == pkgname)
+    result = await run_db(ArchPackage.get_or_none, ArchPackage.name == pkgname)
     if result is None:
         await send_text_to_room(
             client,
@@ -55,7 +55,7 @@ async def update_archlinuxcn_pkg(
     async with aiohttp.ClientSession() as session:
         async with session.get(ARCHLINUXCN_PKGPATH) as resp:
             data = await resp.read()
-            ArchPackage.populate_from_blob(data, "archlinuxcn")
+            await run_db(ArchPackage.populate_from_blob, data, "archlinuxcn")
     await client.room_typing(room.room_id, False)
     await send_text_to_room(
         client,
@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from nio import AsyncClient, DownloadError, ResizingMethod, ThumbnailError
+
+from nyx_bot.cache import LRUCache
+from nyx_bot.compose import AVATAR_SIZE, make_avatar_tile
+from nyx_bot.errors import NyxBotRuntimeError
+from nyx_bot.render_pool import run_render
+
+logger = logging.getLogger(__name__)
+
+# Size of the avatar thumbnails asked for, a size homeservers usually have
+THUMBNAIL_SIZE = 2 * AVATAR_SIZE
+
+
+def parse_mxc(mxc: str) -> Optional[Tuple[str, str]]:
+    """Split an mxc URI into its server name and media ID."""
+    if not mxc.startswith("mxc://"):
+        return None
+    server_name, _, media_id = mxc[len("mxc://") :].partition("/")
+    if not server_name or not media_id:
+        return None
+    return server_name, media_id
+
+
+async def download_avatar(client: AsyncClient, mxc: str, size: int) -> bytes:
+    """Download a thumbnail of an avatar, or the avatar itself if the
+    homeserver can't make one.
+
+    Raises:
+        NyxBotRuntimeError: If the avatar couldn't be downloaded.
+    """
+    parsed = parse_mxc(mxc)
+    if parsed is not None:
+        server_name, media_id = parsed
+        resp = await client.thumbnail(
+            server_name, media_id, size, size, ResizingMethod.crop
+        )
+        if not isinstance(resp, ThumbnailError):
+            return resp.body
+        logger.debug(f"No thumbnail of {mxc} ({resp.message}), downloading it.")
+    resp = await client.download(mxc=mxc)
+    if isinstance(resp, DownloadError):
+        raise NyxBotRuntimeError(f"Failed to download {mxc}: {resp.message}")
+    return resp.body
+
+
+class AvatarCache:
+    """Caches the masked avatar tiles drawn on quotes, by mxc URI.
+
+    Up to ``maxsize`` recently used tiles are kept in memory, and up to
+    ``max_files`` in ``path`` so they survive a restart. A tile is only
+    downloaded and drawn again once it was evicted from both, or its user
+    changed their avatar.
+    """
+
+    def __init__(
+        self, path: Optional[str] = None, maxsize: int = 500, max_files: int = 5000
+    ):
+        self.path = path
+        self.tiles: LRUCache = LRUCache(maxsize)
+        self.max_files = max_files
+        # Tile files by the time they were last used, oldest first
+        self.files: "OrderedDict[str, None]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, path: str, maxsize: int, max_files: int):
+        self.path = path
+        self.tiles = LRUCache(maxsize)
+        self.max_files = max_files
+        os.makedirs(path, exist_ok=True)
+        self.files = _scan_files(path)
+        # The limit may have been lowered since the last start
+        _remove_files(self._evict_files())
+
+    def _file(self, mxc: str) -> Optional[str]:
+        if self.path is None:
+            return None
+        name = hashlib.sha256(mxc.encode()).hexdigest()
+        return os.path.join(self.path, f"{name}.png")
+
+    async def get(self, client: AsyncClient, mxc: str) -> bytes:
+        """Get the tile of an avatar, drawing it if needed.
+
+        Raises:
+            NyxBotRuntimeError: If the avatar couldn't be downloaded.
+        """
+        tile = self.tiles.get(mxc)
+        if tile is not None:
+            self.hits += 1
+            return tile
+        loop = asyncio.get_running_loop()
+        path = self._file(mxc)
+        if path is not None:
+            tile = await loop.run_in_executor(None, _read_file, path)
+        if tile is None:
+            self.misses += 1
+            data = await download_avatar(client, mxc, THUMBNAIL_SIZE)
+            tile = await run_render(make_avatar_tile, data)
+            if path is not None:
+                await loop.run_in_executor(None, _write_file, path, tile)
+        else:
+            self.hits += 1
+        if path is not None:
+            self.files[path] = None
+            self.files.move_to_end(path)
+            evicted = self._evict_files()
+            if evicted:
+                await loop.run_in_executor(None, _remove_files, evicted)
+        self.tiles.put(mxc, tile)
+        return tile
+
+    def _evict_files(self) -> List[str]:
+        evicted = []
+        while len(self.files) > self.max_files:
+            path, _ = self.files.popitem(last=False)
+            evicted.append(path)
+        return evicted
+
+    def invalidate(self, mxc: str):
+        """Forget the tile of an avatar that was replaced."""
+        self.tiles.pop(mxc)
+        path = self._file(mxc)
+        if path is not None:
+            self.files.pop(path, None)
+            _remove_files([path])
+
+
+def _scan_files(path: str) -> "OrderedDict[str, None]":
+    """Find the tile files in a directory, least recently used first."""
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith(".png") and entry.is_file():
+                files.append((entry.stat().st_mtime, entry.path))
+    files.sort()
+    return OrderedDict((file, None) for _, file in files)
+
+
+def _read_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # Remember it was used for the next start, files are evicted by age
+    os.utime(path)
+    return data
+
+
+def _remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_file(path: str, data: bytes):
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        logger.exception(f"Failed to save avatar tile to {path}.")
+
+
+avatar_cache = AvatarCache()
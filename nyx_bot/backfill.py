@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Callable, List, NamedTuple, Optional
+
+from nio import (
+    AsyncClient,
+    MatrixRoom,
+    RoomMessagesError,
+    RoomMessageText,
+    SyncResponse,
+)
+
+from nyx_bot.seen_events import seen_events
+from nyx_bot.storage import BackfillGap, run_db
+
+if TYPE_CHECKING:
+    from nyx_bot.callbacks import RoomDispatcher
+
+logger = logging.getLogger(__name__)
+
+# Only messages are recorded, so don't fetch anything else
+MESSAGE_FILTER = {"types": ["m.room.message"]}
+
+
+class Gap(NamedTuple):
+    gap_id: int
+    room_id: str
+    start: str
+    end: str
+    pages: int
+
+
+class Backfiller:
+    """Fills the history missed by limited syncs into the message store.
+
+    A sync timeline is limited when the room had more new events than the
+    sync returned; the missing ones are between the timeline's ``prev_batch``
+    and the previous sync token. Each gap is paginated backwards in the
+    background, at most ``workers`` at a time and only while ``interactive``
+    has nothing waiting. Progress is saved after every page, so gaps are
+    resumed after a restart.
+    """
+
+    def __init__(
+        self,
+        client: AsyncClient,
+        record: Callable[[MatrixRoom, RoomMessageText], None],
+        interactive: "RoomDispatcher",
+        workers: int = 2,
+        max_pages: int = 20,
+        page_size: int = 100,
+    ):
+        self.client = client
+        self.record = record
+        self.interactive = interactive
+        self.workers = workers
+        self.max_pages = max_pages
+        self.page_size = page_size
+        # Token of the last sync handled, None before the first one
+        self.since: Optional[str] = None
+        self.loaded = False
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+        self.filled = 0
+
+    async def load(self):
+        """Resume the gaps left from the last run, once the rooms are known."""
+        if self.loaded:
+            return
+        self.loaded = True
+        rows = await run_db(BackfillGap.load_all)
+        for row in rows:
+            self._submit(Gap(*row))
+        if rows:
+            logger.info(f"Resuming backfill of {len(rows)} gaps.")
+
+    def handle_sync(self, response: SyncResponse):
+        """Queue the gaps of a sync response."""
+        since, self.since = self.since, response.next_batch
+        if not since:
+            # Nothing to fill after a full sync
+            return
+        for room_id, info in response.rooms.join.items():
+            timeline = info.timeline
+            if timeline.limited and timeline.prev_batch:
+                asyncio.ensure_future(self._add(room_id, timeline.prev_batch, since))
+
+    async def _add(self, room_id: str, start: str, end: str):
+        gap_id = await run_db(BackfillGap.add, room_id, start, end)
+        logger.debug(f"Found a gap in {room_id}, queued for backfill.")
+        self._submit(Gap(gap_id, room_id, start, end, 0))
+
+    def _submit(self, gap: Gap):
+        if self.queue is None:
+            # Created lazily so the queue binds to the running event loop.
+            self.queue = asyncio.Queue()
+        if not self.tasks:
+            self.tasks = [
+                asyncio.ensure_future(self._worker()) for _ in range(self.workers)
+            ]
+        self.queue.put_nowait(gap)
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def close(self):
+        """Stop backfilling, the progress is kept for the next run."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.queue = None
+
+    async def _worker(self):
+        while True:
+            gap = await self.queue.get()
+            try:
+                await self._fill(gap)
+            except Exception:
+                # Kept in the database, so it's tried again after a restart
+                logger.exception(f"Failed to backfill {gap.room_id}.")
+            finally:
+                self.queue.task_done()
+
+    async def _fill(self, gap: Gap):
+        room = self.client.rooms.get(gap.room_id)
+        start = gap.start
+        pages = gap.pages
+        count = 0
+        while room is not None and pages < self.max_pages:
+            await self.interactive.wait_idle()
+            response = await self.client.room_messages(
+                gap.room_id,
+                start,
+                gap.end,
+                limit=self.page_size,
+                message_filter=MESSAGE_FILTER,
+            )
+            if isinstance(response, RoomMessagesError):
+                logger.warning(
+                    f"Giving up backfilling {gap.room_id}: {response.message}"
+                )
+                break
+            pages += 1
+            messages = [
+                event for event in response.chunk if isinstance(event, RoomMessageText)
+            ]
+            recorded = all(
+                (gap.room_id, event.event_id) in seen_events for event in messages
+            )
+            for event in messages:
+                self.record(room, event)
+            count += len(messages)
+            if not response.chunk or not response.end or (messages and recorded):
+                # Reached the end of the gap, or messages recorded before
+                break
+            start = response.end
+            await run_db(BackfillGap.advance, gap.gap_id, start, pages)
+        await run_db(BackfillGap.remove, gap.gap_id)
+        self.filled += count
+        logger.info(f"Backfilled {count} messages in {gap.room_id}.")
@@ -1,9 +1,13 @@
+import asyncio
 import logging
 import time
 from calendar import THURSDAY
 from collections import defaultdict
+from copy import deepcopy
 from datetime import date, datetime
+from enum import Enum
 from operator import itemgetter
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
 from zlib import crc32
 
 from dateutil.relativedelta import relativedelta
@@ -11,15 +15,13 @@ from nio import (
     AsyncClient,
     JoinedMembersError,
     MatrixRoom,
-    PowerLevels,
-    RoomGetEventError,
-    RoomGetStateEventError,
     RoomMessageImage,
     RoomMessageText,
     StickerEvent,
 )
 
 from nyx_bot.archcn_utils import send_archlinuxcn_pkg, update_archlinuxcn_pkg
+from nyx_bot.cache import EditIndex
 from nyx_bot.chat_functions import (
     bulk_update_messages,
     send_exception,
@@ -30,7 +32,15 @@ from nyx_bot.chat_functions import (
 )
 from nyx_bot.config import Config
 from nyx_bot.errors import NyxBotRuntimeError, NyxBotValueError
-from nyx_bot.storage import MatrixMessage, MembershipUpdates, UserTag
+from nyx_bot.event_cache import fetch_event
+from nyx_bot.ratelimit import RateLimiter
+from nyx_bot.storage import (
+    MatrixMessage,
+    MembershipUpdates,
+    MessageRecorder,
+    UserTag,
+    run_db,
+)
 from nyx_bot.utils import (
     get_user_id_parts,
     make_datetime,
@@ -42,8 +52,122 @@ from nyx_bot.utils import (
 from nyx_bot.wordcloud import send_wordcloud
 
 logger = logging.getLogger(__name__)
-SLOW_MODE_ENABLED = False
-LAST_DELTA = 0
+# Commands taking longer than this are logged as warnings
+SLOW_COMMAND_SECONDS = 10.0
+
+
+class CommandCost(Enum):
+    """How expensive running a command is."""
+
+    # Replies with what's already known, or after a single request
+    CHEAP = "cheap"
+    # Queries the database or does a lot of requests
+    DB = "db"
+    # Renders an image
+    RENDER = "render"
+
+
+class CommandSpec:
+    """A registered command and its metadata."""
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[..., Awaitable[Any]],
+        aliases: Tuple[str, ...] = (),
+        reply_error: Optional[str] = None,
+        args_error: Optional[str] = None,
+        cost: CommandCost = CommandCost.CHEAP,
+        concurrency: int = 0,
+        kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        Args:
+            name: The command name.
+
+            handler: The Command method running it.
+
+            aliases: Other names of the command.
+
+            reply_error: If set, the command needs a reply and this is the error
+                shown otherwise.
+
+            args_error: If set, the command needs arguments and this is the
+                error shown otherwise.
+
+            cost: How expensive the command is.
+
+            concurrency: How many invocations may run at once, 0 for no limit.
+
+            kwargs: Extra keyword arguments passed to the handler.
+        """
+        self.name = name
+        self.handler = handler
+        self.aliases = aliases
+        self.reply_error = reply_error
+        self.args_error = args_error
+        self.cost = cost
+        self.concurrency = concurrency
+        self.kwargs = kwargs or {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def needs_reply(self) -> bool:
+        return self.reply_error is not None
+
+    @property
+    def semaphore(self) -> Optional[asyncio.Semaphore]:
+        # Created lazily so it's bound to the running event loop
+        if self.concurrency and self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def record_time(self, elapsed: float):
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+
+# Registered commands, by name and alias
+COMMANDS: Dict[str, CommandSpec] = {}
+
+
+def register_command(name: str, **kwargs):
+    """Register the decorated Command method as a command.
+
+    Takes the same keyword arguments as CommandSpec, the remaining ones are
+    passed to the handler.
+    """
+    spec_kwargs = {}
+    for key in ("aliases", "reply_error", "args_error", "cost", "concurrency"):
+        if key in kwargs:
+            spec_kwargs[key] = kwargs.pop(key)
+
+    def decorator(handler):
+        spec = CommandSpec(name, handler, kwargs=kwargs, **spec_kwargs)
+        for key in (name, *spec.aliases):
+            if key in COMMANDS:
+                raise ValueError(f"Command {key} is already registered")
+            COMMANDS[key] = spec
+        return handler
+
+    return decorator
+
+
+def get_command_stats() -> Dict[str, Tuple[int, float, float]]:
+    """Get the number of calls, average and maximum run time of each command."""
+    stats = {}
+    for spec in set(COMMANDS.values()):
+        if spec.calls:
+            stats[spec.name] = (
+                spec.calls,
+                spec.total_time / spec.calls,
+                spec.max_time,
+            )
+    return stats
 
 
 class Command:
@@ -55,8 +179,10 @@ class Command:
         room: MatrixRoom,
         event: RoomMessageText,
         reply_to: str,
-        replace_map: dict,
+        edit_index: EditIndex,
         command_prefix: str,
+        rate_limiter: RateLimiter,
+        recorder: MessageRecorder,
     ):
         """A command made by a user.
 
@@ -70,27 +196,25 @@ class Command:
             room: The room the command was sent in.
 
             event: The event describing the command.
+
+            recorder: Records messages fetched by the command.
         """
         all_args = command.split()
         self.client = client
         self.config = config
         self.command = all_args[0]
+        self.spec = COMMANDS.get(self.command)
         self.room = room
         self.event = event
         self.args = all_args[1:]
         self.reply_to = reply_to
-        self.replace_map = replace_map
+        self.edit_index = edit_index
         self.command_prefix = command_prefix
-        global LAST_DELTA
-        LAST_DELTA = event.server_timestamp
+        self.rate_limiter = rate_limiter
+        self.recorder = recorder
 
     async def process(self):
         """Process the command"""
-        global LAST_DELTA
-        global SLOW_MODE_ENABLED
-        dt = self.event.server_timestamp - LAST_DELTA
-        if SLOW_MODE_ENABLED and dt < 60000:
-            return
         try:
             await self._process()
         except Exception as inst:
@@ -101,91 +225,68 @@ class Command:
             )
 
     async def _process(self):
-        if self.command == "quote":
-            await self._quote()
-        elif self.command == "archlinuxcn":
-            await self._archlinuxcn()
-        elif self.command == "update_archlinuxcn":
-            await self._update_archlinuxcn()
-        elif self.command == "multiquote":
-            await self._multiquote(False)
-        elif self.command == "forward_multiquote":
-            await self._multiquote(True)
-        elif self.command == "send_avatar":
-            await self._send_avatar()
-        elif self.command == "avatar_changes":
-            await self._avatar_changes()
-        elif self.command == "name_changes":
-            await self._name_changes()
-        elif self.command == "crazy_thursday":
-            await self._crazy_thursday()
-        elif self.command == "send_as_sticker":
-            await self._send_as_sticker()
-        elif self.command == "emit_statistics":
-            await self._stat()
-        elif self.command == "parse_matrixdotto":
-            await self._parse_matrixdotto()
-        elif self.command == "help":
-            await self._show_help()
-        elif self.command == "tag":
-            await self._tag()
-        elif self.command == "remove_tag":
-            await self._remove_tag()
-        elif self.command == "update":
-            await self._update()
-        elif self.command == "room_id":
-            await self._room_id()
-        elif self.command == "user_id":
-            await self._user_id()
-        elif self.command == "last_message":
-            await self._last_message()
-        elif self.command == "divergence":
-            await self._divergence()
-        elif self.command == "wordcloud":
-            await self._wordcloud()
-        elif self.command == "ping":
-            await self._ping()
-        elif self.command == "servers":
-            await self._servers()
-        elif self.command == "lookup_message":
-            await self._lookup_message()
-        elif self.command == "slow":
-            await self._slow()
-        elif self.command == "slow_disable":
-            await self._slow_disable()
-        else:
+        spec = self.spec
+        if spec is None:
             await self._unknown_command()
+            return
+        if spec.needs_reply and not self.reply_to:
+            raise NyxBotValueError(spec.reply_error)
+        if spec.args_error and not self.args:
+            raise NyxBotValueError(spec.args_error)
+        semaphore = spec.semaphore
+        if semaphore is not None:
+            async with semaphore:
+                await self._run(spec)
+        else:
+            await self._run(spec)
+
+    async def _run(self, spec: CommandSpec):
+        start = time.perf_counter()
+        try:
+            await spec.handler(self, **spec.kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            spec.record_time(elapsed)
+            if elapsed >= SLOW_COMMAND_SECONDS:
+                logger.warning(
+                    f"Command {self.command} in {self.room.room_id} took {elapsed:.1f}s"
+                )
+            else:
+                logger.debug(
+                    f"Command {self.command} in {self.room.room_id} took {elapsed:.3f}s"
+                )
 
+    @register_command(
+        "quote",
+        reply_error="Please reply to a text message.",
+        cost=CommandCost.RENDER,
+        concurrency=2,
+    )
     async def _quote(self):
         """Make a new quote image. This command must be used on a reply."""
-        if not self.reply_to:
-            raise NyxBotValueError("Please reply to a text message.")
         await self.client.room_typing(self.room.room_id)
         await send_quote_image(
             self.client,
             self.room,
             self.event,
             self.reply_to,
-            self.replace_map,
+            self.edit_index,
+            self.config.quote_cache_size,
         )
 
+    @register_command(
+        "archlinuxcn", args_error="No package given.", cost=CommandCost.DB
+    )
     async def _archlinuxcn(self):
-        if not self.args:
-            raise NyxBotValueError("No package given.")
         await send_archlinuxcn_pkg(self.client, self.room, self.event, self.args[0])
 
+    @register_command(
+        "last_message", args_error="No user ID given.", cost=CommandCost.DB
+    )
     async def _last_message(self):
-        if not self.args:
-            raise NyxBotValueError("No user ID given.")
         target_sender = self.args[0]
-        result = (
-            MatrixMessage.select()
-            .where(
-                (MatrixMessage.room_id == self.room.room_id)
-                & (MatrixMessage.sender == target_sender)
-            )
-            .order_by(MatrixMessage.origin_server_ts.desc())
-            .get()
+        result = await run_db(
+            MatrixMessage.last_message, self.room.room_id, target_sender
         )
         matrixdotto_url = f"https://matrix.to/#/{self.room.room_id}/{result.event_id}"
         await send_text_to_room(
@@ -198,19 +299,15 @@ class Command:
             literal_text=True,
         )
 
+    @register_command(
+        "lookup_message", args_error="No external URL given.", cost=CommandCost.DB
+    )
     async def _lookup_message(self):
-        if not self.args:
-            raise NyxBotValueError("No external URL given.")
         target_url = self.args[0]
         if target_url.startswith("tg://resolve"):
             target_url = tg_link_to_tdotme_link(target_url)
-        result = (
-            MatrixMessage.select()
-            .where(
-                (MatrixMessage.room_id == self.room.room_id)
-                & (MatrixMessage.external_url == target_url)
-            )
-            .get_or_none()
+        result = await run_db(
+            MatrixMessage.lookup_external_url, self.room.room_id, target_url
         )
         if result is None:
             await send_text_to_room(
@@ -234,26 +331,17 @@ class Command:
             literal_text=True,
         )
 
+    @register_command(
+        "avatar_changes",
+        reply_error="Please reply to a message for sending avatar changes.",
+        cost=CommandCost.DB,
+    )
     async def _avatar_changes(self):
-        if not self.reply_to:
-            raise NyxBotValueError(
-                "Please reply to a message for sending avatar changes."
-            )
         await self.client.room_typing(self.room.room_id)
-        target_response = await self.client.room_get_event(
-            self.room.room_id, self.reply_to
-        )
-        if isinstance(target_response, RoomGetEventError):
-            error = target_response.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        target_sender = target_response.event.sender
-        changes = (
-            MembershipUpdates.select()
-            .where(
-                (MembershipUpdates.room_id == self.room.room_id)
-                & (MembershipUpdates.state_key == target_sender)
-            )
-            .order_by(MembershipUpdates.origin_server_ts.desc())
+        target_event = await fetch_event(self.client, self.room.room_id, self.reply_to)
+        target_sender = target_event.sender
+        changes = await run_db(
+            MembershipUpdates.changes, self.room.room_id, target_sender
         )
         send_text = ""
         i = 0
@@ -282,26 +370,17 @@ class Command:
             literal_text=True,
         )
 
+    @register_command(
+        "name_changes",
+        reply_error="Please reply to a message for sending avatar changes.",
+        cost=CommandCost.DB,
+    )
     async def _name_changes(self):
-        if not self.reply_to:
-            raise NyxBotValueError(
-                "Please reply to a message for sending avatar changes."
-            )
         await self.client.room_typing(self.room.room_id)
-        target_response = await self.client.room_get_event(
-            self.room.room_id, self.reply_to
-        )
-        if isinstance(target_response, RoomGetEventError):
-            error = target_response.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        target_sender = target_response.event.sender
-        changes = (
-            MembershipUpdates.select()
-            .where(
-                (MembershipUpdates.room_id == self.room.room_id)
-                & (MembershipUpdates.state_key == target_sender)
-            )
-            .order_by(MembershipUpdates.origin_server_ts.desc())
+        target_event = await fetch_event(self.client, self.room.room_id, self.reply_to)
+        target_sender = target_event.sender
+        changes = await run_db(
+            MembershipUpdates.changes, self.room.room_id, target_sender
         )
         send_text = ""
         i = 0
@@ -326,17 +405,19 @@ class Command:
             literal_text=True,
         )
 
+    @register_command("update_archlinuxcn", cost=CommandCost.DB, concurrency=1)
     async def _update_archlinuxcn(self):
         await self.client.room_typing(self.room.room_id)
         await update_archlinuxcn_pkg(self.client, self.room, self.event)
 
+    @register_command("update", cost=CommandCost.DB, concurrency=1)
     async def _update(self):
         await self.client.room_typing(self.room.room_id)
         context_resp = await self.client.room_context(
             self.room.room_id, self.event.event_id
         )
         start_token = context_resp.start
-        await bulk_update_messages(self.client, self.room, start_token)
+        await bulk_update_messages(self.client, self.room, start_token, self.recorder)
         await self.client.room_typing(self.room.room_id, False)
         await send_text_to_room(
             self.client,
@@ -348,26 +429,14 @@ class Command:
             literal_text=True,
         )
 
-    async def _check_slow(self):
-        state_resp = await self.client.room_get_state_event(
-            self.room.room_id, "m.room.power_levels"
-        )
-        if isinstance(state_resp, RoomGetStateEventError):
-            logger.debug(
-                f"Failed to get power level data in room {self.room.display_name} ({self.room.room_id})."
-            )
-            return
-        content = state_resp.content
-        events = content.get("events")
-        users = content.get("users")
-        powers = PowerLevels(events=events, users=users)
-        return powers.can_user_kick(self.event.sender)
+    def _check_slow(self) -> bool:
+        return self.room.power_levels.can_user_kick(self.event.sender)
 
+    @register_command("slow")
     async def _slow(self):
-        global SLOW_MODE_ENABLED
-        if not await self._check_slow():
+        if not self._check_slow():
             return
-        SLOW_MODE_ENABLED = True
+        self.rate_limiter.set_slow(self.room.room_id, True)
         await send_text_to_room(
             self.client,
             self.room.room_id,
@@ -378,11 +447,11 @@ class Command:
             literal_text=True,
         )
 
+    @register_command("slow_disable")
     async def _slow_disable(self):
-        global SLOW_MODE_ENABLED
-        if not await self._check_slow():
+        if not self._check_slow():
             return
-        SLOW_MODE_ENABLED = False
+        self.rate_limiter.set_slow(self.room.room_id, False)
         await send_text_to_room(
             self.client,
             self.room.room_id,
@@ -393,6 +462,7 @@ class Command:
             literal_text=True,
         )
 
+    @register_command("room_id")
     async def _room_id(self):
         await send_text_to_room(
             self.client,
@@ -404,6 +474,7 @@ class Command:
             literal_text=True,
         )
 
+    @register_command("ping")
     async def _ping(self):
         event_ts = make_datetime(self.event.server_timestamp)
         now = time.time()
@@ -418,6 +489,7 @@ class Command:
             literal_text=True,
         )
 
+    @register_command("servers")
     async def _servers(self):
         results = defaultdict(int)
         members_response = await self.client.joined_members(self.room.room_id)
@@ -444,16 +516,12 @@ class Command:
             literal_text=True,
         )
 
+    @register_command(
+        "user_id", reply_error="Please reply to a message for sending user ID."
+    )
     async def _user_id(self):
-        if not self.reply_to:
-            raise NyxBotValueError("Please reply to a message for sending user ID.")
-        target_response = await self.client.room_get_event(
-            self.room.room_id, self.reply_to
-        )
-        if isinstance(target_response, RoomGetEventError):
-            error = target_response.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        target_sender = target_response.event.sender
+        target_event = await fetch_event(self.client, self.room.room_id, self.reply_to)
+        target_sender = target_event.sender
         await send_text_to_room(
             self.client,
             self.room.room_id,
@@ -464,6 +532,7 @@ class Command:
             literal_text=True,
         )
 
+    @register_command("divergence")
     async def _divergence(self):
         room_hash = crc32(self.room.room_id.encode())
         event_id_hash = None
@@ -480,10 +549,22 @@ class Command:
             literal_text=True,
         )
 
+    @register_command(
+        "multiquote",
+        reply_error="Please reply to a text message.",
+        cost=CommandCost.RENDER,
+        concurrency=2,
+        forward=False,
+    )
+    @register_command(
+        "forward_multiquote",
+        reply_error="Please reply to a text message.",
+        cost=CommandCost.RENDER,
+        concurrency=2,
+        forward=True,
+    )
     async def _multiquote(self, forward: bool):
         """Make a new multiquote image. This command must be used on a reply."""
-        if not self.reply_to:
-            raise NyxBotValueError("Please reply to a text message.")
         limit = 3
         if self.args:
             try:
@@ -499,18 +580,16 @@ class Command:
             self.event,
             limit,
             self.reply_to,
-            self.replace_map,
+            self.edit_index,
             self.command_prefix,
             forward,
+            self.config.quote_cache_size,
         )
 
+    @register_command("emit_statistics", cost=CommandCost.DB)
     async def _stat(self):
-        count = MatrixMessage.select().count()
-        room_count = (
-            MatrixMessage.select()
-            .where(MatrixMessage.room_id == self.room.room_id)
-            .count()
-        )
+        count = await run_db(MatrixMessage.count_messages)
+        room_count = await run_db(MatrixMessage.count_messages, self.room.room_id)
         string = f"Total counted messages: {count}\nThis room: {room_count}"
         await send_text_to_room(
             self.client,
@@ -522,6 +601,7 @@ class Command:
             literal_text=True,
         )
 
+    @register_command("crazy_thursday")
     async def _crazy_thursday(self):
         today = date.today()
         now = datetime.now()
@@ -546,9 +626,8 @@ class Command:
             literal_text=True,
         )
 
+    @register_command("parse_matrixdotto", args_error="No matrix.to links given.")
     async def _parse_matrixdotto(self):
-        if not self.args:
-            raise NyxBotValueError("No matrix.to links given.")
         string = "Parse results:\n"
         for i in self.args:
             result = parse_matrixdotto_link(i)
@@ -575,6 +654,7 @@ class Command:
             literal_text=True,
         )
 
+    @register_command("send_avatar", cost=CommandCost.RENDER, concurrency=2)
     async def _send_avatar(self):
         """\
 Send an avatar.
@@ -584,19 +664,13 @@ Outside of a reply, send the avatar of the command sender.\
 """
         await send_user_image(self.client, self.room, self.event, self.reply_to)
 
+    @register_command("send_as_sticker", reply_error="Please reply to a image message.")
     async def _send_as_sticker(self):
         """Turn an image into a sticker. This command must be used on a reply."""
-        if not self.reply_to:
-            raise NyxBotValueError("Please reply to a image message.")
-        target_response = await self.client.room_get_event(
-            self.room.room_id, self.reply_to
-        )
-        if isinstance(target_response, RoomGetEventError):
-            error = target_response.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        target_event = target_response.event
+        target_event = await fetch_event(self.client, self.room.room_id, self.reply_to)
         if isinstance(target_event, RoomMessageImage):
-            content = target_event.source.get("content")
+            # Don't modify the cached event
+            content = deepcopy(target_event.source.get("content"))
             info = content["info"]
             if "thumbnail_info" not in content:
                 # Populate Thumbnail info
@@ -631,6 +705,7 @@ Outside of a reply, send the avatar of the command sender.\
         else:
             raise NyxBotValueError("Please reply to a image message.")
 
+    @register_command("help")
     async def _show_help(self):
         """Show the help text"""
         text = (
@@ -650,22 +725,16 @@ Outside of a reply, send the avatar of the command sender.\
             literal_text=True,
         )
 
+    @register_command(
+        "tag", reply_error="Please reply to a message.", cost=CommandCost.DB
+    )
     async def _tag(self):
-        if not self.reply_to:
-            raise NyxBotValueError("Please reply to a message.")
-        target_event = await self.client.room_get_event(
-            self.room.room_id, self.reply_to
-        )
-        if isinstance(target_event, RoomGetEventError):
-            error = target_event.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        sender = target_event.event.sender
+        target_event = await fetch_event(self.client, self.room.room_id, self.reply_to)
+        sender = target_event.sender
         if not self.args:
-            user_tag = UserTag.get_or_none(
-                (UserTag.room_id == self.room.room_id) & (UserTag.sender == sender)
-            )
+            user_tag = await run_db(UserTag.get_tag, self.room.room_id, sender)
             if user_tag:
-                tag_name = f"#{user_tag.tag}"
+                tag_name = f"#{user_tag}"
             else:
                 tag_name = "(None)"
             await send_text_to_room(
@@ -684,7 +753,9 @@ Outside of a reply, send the avatar of the command sender.\
                 if tag_name == "":
                     raise NyxBotValueError("Tag is empty.")
                 else:
-                    UserTag.update_user_tag(self.room.room_id, sender, tag_name)
+                    await run_db(
+                        UserTag.update_user_tag, self.room.room_id, sender, tag_name
+                    )
                     await send_text_to_room(
                         self.client,
                         self.room.room_id,
@@ -697,18 +768,15 @@ Outside of a reply, send the avatar of the command sender.\
             else:
                 raise NyxBotValueError("Tag is invaild: Tag should start with #.")
 
+    @register_command(
+        "remove_tag", reply_error="Please reply to a message.", cost=CommandCost.DB
+    )
     async def _remove_tag(self):
-        if not self.reply_to:
-            raise NyxBotValueError("Please reply to a message.")
-        target_event = await self.client.room_get_event(
-            self.room.room_id, self.reply_to
-        )
-        if isinstance(target_event, RoomGetEventError):
-            error = target_event.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        sender = target_event.event.sender
-        UserTag.delete_user_tag(self.room.room_id, sender)
+        target_event = await fetch_event(self.client, self.room.room_id, self.reply_to)
+        sender = target_event.sender
+        await run_db(UserTag.delete_user_tag, self.room.room_id, sender)
 
+    @register_command("wordcloud", cost=CommandCost.RENDER, concurrency=1)
     async def _wordcloud(self):
         await self.client.room_typing(self.room.room_id)
         (sender, days) = await parse_wordcloud_args(
@@ -0,0 +1,134 @@
+import logging
+from collections import OrderedDict
+from typing import Generic, Hashable, NamedTuple, Optional, TypeVar
+
+from nio import RoomMessageText
+
+from nyx_bot.storage import MessageEdit, MessageRecorder, run_db
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A mapping that evicts the least recently used entries beyond ``maxsize``."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data: "OrderedDict[K, V]" = OrderedDict()
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        if key not in self.data:
+            return default
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def put(self, key: K, value: V):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        return self.data.pop(key, default)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+class Edit(NamedTuple):
+    """The latest replacement of an edited message."""
+
+    replaced_by: str
+    origin_server_ts: int
+    # Whether the content below is known, or has to be read from the replacement
+    has_content: bool
+    body: Optional[str] = None
+    formatted_body: Optional[str] = None
+
+
+# Cached for events known to have no edits
+NOT_EDITED = Edit("", 0, False)
+
+
+class EditIndex:
+    """Resolves edited messages to their latest replacement.
+
+    Recent lookups are kept in memory, everything is recorded to the database
+    through the recorder so edits are still known after a restart.
+    """
+
+    def __init__(self, recorder: MessageRecorder, maxsize: int = 10000):
+        self.recorder = recorder
+        self.cache: LRUCache = LRUCache(maxsize)
+
+    def record(
+        self,
+        room_id: str,
+        original_event_id: str,
+        event: RoomMessageText,
+        include_text: bool = False,
+    ):
+        """Record a replacement event.
+
+        Args:
+            room_id: The room of the events.
+
+            original_event_id: The event being replaced.
+
+            event: The replacement event.
+
+            include_text: Whether the new content may be stored in the database.
+        """
+        key = (room_id, original_event_id)
+        known = self.cache.get(key)
+        if known and known.origin_server_ts > event.server_timestamp:
+            return
+        content = event.source.get("content", {})
+        new_content = content.get("m.new_content", {})
+        edit = Edit(
+            event.event_id,
+            event.server_timestamp,
+            True,
+            new_content.get("body"),
+            new_content.get("formatted_body"),
+        )
+        self.cache.put(key, edit)
+        self.recorder.record_edit(
+            room_id,
+            original_event_id,
+            edit.replaced_by,
+            edit.origin_server_ts,
+            edit.body if include_text else None,
+            edit.formatted_body if include_text else None,
+        )
+
+    async def resolve(self, room_id: str, event_id: str) -> Optional[Edit]:
+        """Get the latest replacement of an event, or None if it wasn't edited."""
+        key = (room_id, event_id)
+        edit = self.cache.get(key)
+        if edit is None:
+            row = await run_db(MessageEdit.get_edit, room_id, event_id)
+            if row is None:
+                edit = NOT_EDITED
+            else:
+                edit = Edit(
+                    row.replaced_by,
+                    row.origin_server_ts,
+                    row.body is not None,
+                    row.body,
+                    row.formatted_body,
+                )
+            # An edit might have been recorded while querying
+            if key in self.cache:
+                edit = self.cache.get(key)
+            else:
+                self.cache.put(key, edit)
+        if edit is NOT_EDITED:
+            return None
+        return edit
@@ -1,30 +1,41 @@
 import asyncio
 import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
 
 from nio import (
     AsyncClient,
+    Event,
     MatrixRoom,
-    PowerLevels,
-    RoomGetEventError,
-    RoomGetStateEventError,
+    RedactionEvent,
     RoomMemberEvent,
     RoomMessageText,
-    RoomPutStateError,
+    RoomSendResponse,
+    SyncResponse,
     UnknownEvent,
 )
 
-from nyx_bot.bot_commands import Command
+from nyx_bot.avatar_cache import avatar_cache
+from nyx_bot.backfill import Backfiller
+from nyx_bot.bot_commands import Command, CommandCost, get_command_stats
+from nyx_bot.cache import EditIndex
 from nyx_bot.chat_functions import send_text_to_room
 from nyx_bot.config import Config
+from nyx_bot.errors import NyxBotRuntimeError
+from nyx_bot.event_cache import event_cache, fetch_event, room_timeline
+from nyx_bot.join_confirm import JoinConfirmBatcher, Pending, PendingConfirmations
 from nyx_bot.message_responses import Message
-from nyx_bot.storage import MatrixMessage, MembershipUpdates
+from nyx_bot.power_levels import PowerLevelCache
+from nyx_bot.ratelimit import RateLimiter
+from nyx_bot.storage import MessageRecorder
 from nyx_bot.utils import (
+    REACTIONS,
     get_bot_event_type,
     get_replaces,
     get_reply_to,
     hash_user_id,
     is_bot_event,
-    make_datetime,
     should_enable_join_confirm,
     should_record_message_content,
     strip_beginning_quote,
@@ -33,6 +44,214 @@ from nyx_bot.utils import (
 
 logger = logging.getLogger(__name__)
 
+Job = Callable[[], Awaitable[None]]
+
+# Log a warning when a job waited longer than this in its room queue.
+SLOW_WAIT_SECONDS = 5.0
+
+# How often the queue statistics are logged, in seconds
+STATS_INTERVAL_SECONDS = 300.0
+
+
+async def cancel_tasks(tasks: List[asyncio.Task]):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class RoomDispatcher:
+    """Runs event handlers on per-room FIFO queues.
+
+    Jobs submitted for the same room are run one at a time in submission order.
+    Different rooms are drained concurrently by a bounded pool of workers, which
+    take turns between rooms so a busy room can't starve the others.
+    """
+
+    def __init__(self, workers: int = 4):
+        self.workers = workers
+        # Rooms with pending jobs. A room is present here while it's either
+        # waiting in the ready queue or being handled by a worker.
+        self.room_queues: Dict[str, Deque[Tuple[float, Job]]] = {}
+        self.ready: Optional[asyncio.Queue] = None
+        # Set while no submitted job is waiting to start
+        self.idle: Optional[asyncio.Event] = None
+        self.pending = 0
+        self.tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, room_id: str, job: Job) -> None:
+        """Queue a job to run after all previously submitted jobs of the room."""
+        self._ensure_workers()
+        self.pending += 1
+        self.idle.clear()
+        queue = self.room_queues.get(room_id)
+        if queue is None:
+            queue = deque()
+            self.room_queues[room_id] = queue
+            queue.append((time.monotonic(), job))
+            self.ready.put_nowait(room_id)
+        else:
+            queue.append((time.monotonic(), job))
+
+    def depth(self, room_id: Optional[str] = None) -> int:
+        """Number of jobs waiting, either in the given room or in total."""
+        if room_id is not None:
+            return len(self.room_queues.get(room_id, ()))
+        return sum(len(queue) for queue in self.room_queues.values())
+
+    def stats(self) -> Dict[str, float]:
+        """Return queue depth and wait time statistics."""
+        return {
+            "rooms": len(self.room_queues),
+            "queued": self.depth(),
+            "max_room_depth": max(
+                (len(queue) for queue in self.room_queues.values()), default=0
+            ),
+            "processed": self.processed,
+            "avg_wait": self.total_wait / self.processed if self.processed else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    async def wait_idle(self):
+        """Wait until no job is waiting to start."""
+        if self.idle is not None:
+            await self.idle.wait()
+
+    async def close(self):
+        """Cancel the workers, dropping queued jobs."""
+        await cancel_tasks(self.tasks)
+        self.tasks = []
+        if self.room_queues:
+            logger.warning(f"Dropped {self.depth()} queued jobs.")
+        self.room_queues.clear()
+        self.ready = None
+        self.idle = None
+        self.pending = 0
+
+    def _ensure_workers(self):
+        if self.ready is None:
+            # Created lazily so the queue binds to the running event loop.
+            self.ready = asyncio.Queue()
+            self.idle = asyncio.Event()
+            self.idle.set()
+        if not self.tasks:
+            self.tasks = [self._start_worker() for _ in range(self.workers)]
+
+    def _start_worker(self) -> asyncio.Task:
+        task = asyncio.ensure_future(self._worker())
+        task.add_done_callback(self._worker_done)
+        return task
+
+    def _worker_done(self, task: asyncio.Task):
+        # Workers only stop when cancelled by close()
+        if task.cancelled() or task not in self.tasks:
+            return
+        logger.error(
+            "A room queue worker stopped, starting another.",
+            exc_info=task.exception(),
+        )
+        self.tasks[self.tasks.index(task)] = self._start_worker()
+
+    async def _worker(self):
+        while True:
+            room_id = await self.ready.get()
+            queue = self.room_queues[room_id]
+            enqueued_at, job = queue.popleft()
+            self.pending -= 1
+            if not self.pending:
+                self.idle.set()
+            waited = time.monotonic() - enqueued_at
+            self.processed += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            if waited >= SLOW_WAIT_SECONDS:
+                logger.warning(
+                    f"Job in {room_id} waited {waited:.3f}s, {len(queue)} more queued."
+                )
+            else:
+                logger.debug(
+                    f"Job in {room_id} waited {waited:.3f}s, {len(queue)} more queued."
+                )
+            try:
+                await job()
+            except Exception:
+                logger.exception(f"Unhandled exception in job for {room_id}.")
+            finally:
+                if queue:
+                    # Go to the back of the line to let other rooms run.
+                    self.ready.put_nowait(room_id)
+                else:
+                    del self.room_queues[room_id]
+                self.ready.task_done()
+
+
+class HeavyLane:
+    """Runs expensive jobs behind interactive ones.
+
+    At most ``workers`` jobs run at once, and at most ``max_queued`` may wait.
+    A job is only started while the interactive dispatcher has nothing waiting,
+    so cheap commands are never queued behind renders.
+    """
+
+    def __init__(
+        self, interactive: RoomDispatcher, workers: int = 2, max_queued: int = 20
+    ):
+        self.interactive = interactive
+        self.workers = workers
+        self.max_queued = max_queued
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+        self.rejected = 0
+
+    def submit(self, room_id: str, job: Job) -> bool:
+        """Queue a job, returning False if the queue is full."""
+        self._ensure_workers()
+        try:
+            self.queue.put_nowait((room_id, time.monotonic(), job))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning(f"Heavy job for {room_id} rejected, queue is full.")
+            return False
+        return True
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def close(self):
+        """Cancel the workers, dropping queued jobs."""
+        await cancel_tasks(self.tasks)
+        self.tasks = []
+        if self.depth():
+            logger.warning(f"Dropped {self.depth()} queued heavy jobs.")
+        self.queue = None
+
+    def _ensure_workers(self):
+        if self.queue is None:
+            # Created lazily so the queue binds to the running event loop.
+            self.queue = asyncio.Queue(self.max_queued)
+        if not self.tasks:
+            self.tasks = [
+                asyncio.ensure_future(self._worker()) for _ in range(self.workers)
+            ]
+
+    async def _worker(self):
+        while True:
+            room_id, enqueued_at, job = await self.queue.get()
+            await self.interactive.wait_idle()
+            waited = time.monotonic() - enqueued_at
+            logger.debug(
+                f"Heavy job in {room_id} waited {waited:.3f}s, "
+                f"{self.queue.qsize()} more queued."
+            )
+            try:
+                await job()
+            except Exception:
+                logger.exception(f"Unhandled exception in heavy job for {room_id}.")
+            finally:
+                self.queue.task_done()
+
 
 class Callbacks:
     def __init__(self, client: AsyncClient, config: Config):
@@ -46,7 +265,44 @@ class Callbacks:
         self.config = config
         self.room_features = config.room_features
         self.command_prefix = config.command_prefix
-        self.replace_map = {}
+        self.dispatcher = RoomDispatcher(config.dispatcher_workers)
+        self.rate_limiter = RateLimiter(self.room_features)
+        self.power_levels = PowerLevelCache(client)
+        self.join_confirm = JoinConfirmBatcher(self.power_levels)
+        self.pending_confirmations = PendingConfirmations()
+        self.heavy_lane = HeavyLane(
+            self.dispatcher, config.heavy_workers, config.heavy_queue_size
+        )
+        self.recorder = MessageRecorder(
+            config.record_batch_size, config.record_flush_interval
+        )
+        self.edit_index = EditIndex(self.recorder, config.edit_cache_size)
+        self.backfiller = Backfiller(
+            client,
+            self.record_history,
+            self.dispatcher,
+            config.backfill_workers,
+            config.backfill_max_pages,
+        )
+        self.stats_logged_at = time.monotonic()
+        # Background tasks waiting for join confirm updates
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def timeline_event(self, room: MatrixRoom, event: Event) -> None:
+        """Callback for events that could be looked up later, like reply targets.
+
+        Args:
+            room: The room the event came from.
+
+            event: The event itself.
+        """
+        if isinstance(event, RedactionEvent):
+            event_cache.pop(room.room_id, event.redacts)
+            room_timeline.remove(room.room_id, event.redacts)
+        else:
+            event_cache.put(room.room_id, event)
+            if isinstance(event, RoomMessageText):
+                room_timeline.append(room.room_id, event)
 
     async def message(self, room: MatrixRoom, event: RoomMessageText) -> None:
         """Callback for when a message event is received
@@ -56,19 +312,14 @@ class Callbacks:
 
             event: The event defining the message.
         """
+        include_text = should_record_message_content(self.room_features, room.room_id)
         if event_replace := get_replaces(event):
-            self.replace_map[event_replace] = event.event_id
+            self.edit_index.record(room.room_id, event_replace, event, include_text)
 
         # Extract the message text
         msg = strip_beginning_quote(event.body)
 
-        # Ignore messages from ourselves
-        if event.sender == self.client.user and is_bot_event(event):
-            return
-
-        # XXX: Special case for Arch Linux CN
-        # Also ignore maubot commands
-        if msg.startswith("!"):
+        if self._is_ignored(event, msg):
             return
 
         logger.debug(
@@ -87,19 +338,21 @@ class Callbacks:
         # room.member_count > 2 ... we assume a public room
         # room.member_count <= 2 ... we assume a DM
         if not has_command_prefix and room.member_count > 2:
-            include_text = True
             # Record this message.
-            if not should_record_message_content(self.room_features, room.room_id):
-                include_text = False
-            MatrixMessage.update_message(room, event, event_replace, include_text)
+            self.recorder.record_message(room, event, event_replace, include_text)
             # General message listener
             message = Message(
                 self.client, self.config, msg, room, event, reply_to, self.room_features
             )
-            await asyncio.create_task(message.process())
+            self.dispatcher.submit(room.room_id, message.process)
 
         # Treat it as a command only if it has a prefix
         if has_command_prefix:
+            if not self.rate_limiter.allow(room.room_id, event.sender):
+                logger.debug(
+                    f"Command from {event.sender} in {room.room_id} was rate limited."
+                )
+                return
             # Remove the command prefix
             msg = msg[len(self.command_prefix) :]
 
@@ -110,10 +363,154 @@ class Callbacks:
                 room,
                 event,
                 reply_to,
-                self.replace_map,
+                self.edit_index,
                 self.command_prefix,
+                self.rate_limiter,
+                self.recorder,
+            )
+            spec = command.spec
+            if spec is None or spec.cost is CommandCost.CHEAP:
+                self.dispatcher.submit(room.room_id, command.process)
+            elif not self.heavy_lane.submit(room.room_id, command.process):
+                self.dispatcher.submit(
+                    room.room_id, lambda: self._reply_busy(room, event)
+                )
+
+    def _is_ignored(self, event: RoomMessageText, msg: str) -> bool:
+        # Ignore messages from ourselves
+        if event.sender == self.client.user and is_bot_event(event):
+            return True
+
+        # XXX: Special case for Arch Linux CN
+        # Also ignore maubot commands
+        return msg.startswith("!")
+
+    def record_history(self, room: MatrixRoom, event: RoomMessageText):
+        """Record a message fetched from the room history like a received one."""
+        include_text = should_record_message_content(self.room_features, room.room_id)
+        if event_replace := get_replaces(event):
+            self.edit_index.record(room.room_id, event_replace, event, include_text)
+        msg = strip_beginning_quote(event.body)
+        if (
+            not self._is_ignored(event, msg)
+            and not msg.startswith(self.command_prefix)
+            and room.member_count > 2
+        ):
+            self.recorder.record_message(room, event, event_replace, include_text)
+
+    async def drain(self, timeout: float):
+        """Wait up to timeout seconds for queued jobs to finish."""
+        queues = [
+            queue
+            for queue in (self.dispatcher.ready, self.heavy_lane.queue)
+            if queue is not None
+        ]
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in queues)), timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"{self.dispatcher.depth() + self.heavy_lane.depth()} jobs "
+                f"still queued after {timeout}s."
+            )
+
+    def _spawn(self, coro: Awaitable[None]):
+        """Run a coroutine in the background, keeping it until it's done."""
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def close(self):
+        """Stop handling queued jobs."""
+        await cancel_tasks(list(self.tasks))
+        await self.join_confirm.close()
+        await self.dispatcher.close()
+        await self.heavy_lane.close()
+        await self.backfiller.close()
+
+    async def _reply_busy(self, room: MatrixRoom, event: RoomMessageText):
+        await send_text_to_room(
+            self.client,
+            room.room_id,
+            "The bot is busy, please try again later.",
+            notice=False,
+            markdown_convert=False,
+            reply_to_event_id=event.event_id,
+            literal_text=True,
+        )
+
+    async def sync(self, response: SyncResponse) -> None:
+        """Callback for every sync response.
+
+        Args:
+            response: The sync response.
+        """
+        self._maybe_log_stats()
+        self.power_levels.handle_sync(response)
+        self.backfiller.handle_sync(response)
+        # Membership events are recorded in bulk here rather than one by one,
+        # a full state sync has every member of every room
+        for room_id, info in response.rooms.join.items():
+            if info.timeline.limited:
+                # Only the messages after the gap follow each other
+                redacted = {
+                    event.redacts
+                    for event in info.timeline.events
+                    if isinstance(event, RedactionEvent)
+                }
+                room_timeline.reset(
+                    room_id,
+                    (
+                        event
+                        for event in info.timeline.events
+                        if isinstance(event, RoomMessageText)
+                        and event.event_id not in redacted
+                    ),
+                )
+            events = [
+                event
+                for event in (*info.state, *info.timeline.events)
+                if isinstance(event, RoomMemberEvent)
+            ]
+            if events:
+                self.recorder.record_memberships(room_id, events)
+            for event in events:
+                # Tiles of replaced avatars won't be drawn again
+                prev_avatar = (event.prev_content or {}).get("avatar_url")
+                if prev_avatar and prev_avatar != event.content.get("avatar_url"):
+                    avatar_cache.invalidate(prev_avatar)
+
+    def _maybe_log_stats(self):
+        now = time.monotonic()
+        if now - self.stats_logged_at >= STATS_INTERVAL_SECONDS:
+            self.stats_logged_at = now
+            self.log_stats()
+
+    def log_stats(self):
+        """Log how busy the room queues are, and how long commands take."""
+        stats = self.dispatcher.stats()
+        logger.info(
+            f"Room queues: {stats['queued']} jobs waiting in {stats['rooms']} rooms "
+            f"(at most {stats['max_room_depth']} in one), {stats['processed']} "
+            f"handled, waited {stats['avg_wait']:.3f}s on average and "
+            f"{stats['max_wait']:.3f}s at most."
+        )
+        command_stats = get_command_stats()
+        if command_stats:
+            # Those taking the most time in total first
+            by_total = sorted(
+                command_stats.items(),
+                key=lambda item: item[1][0] * item[1][1],
+                reverse=True,
+            )
+            logger.info(
+                "Commands: "
+                + ", ".join(
+                    f"{name} {calls} calls, {avg:.3f}s avg, {max_time:.3f}s max"
+                    for name, (calls, avg, max_time) in by_total
+                )
             )
-            await asyncio.create_task(command.process())
 
     async def unknown(self, room: MatrixRoom, event: UnknownEvent) -> None:
         """Callback for when an event with a type that is unknown to matrix-nio is received.
@@ -131,17 +528,33 @@ class Callbacks:
 
             reacted_to = relation_dict.get("event_id")
             if reacted_to and relation_dict.get("rel_type") == "m.annotation":
-                await self._reaction(room, event, reacted_to)
+                # Only reactions to pending join confirm notices need handling
+                pending = self.pending_confirmations.get(room.room_id, reacted_to)
+                if pending is not None:
+                    self.dispatcher.submit(
+                        room.room_id,
+                        lambda: self._reaction(room, event, reacted_to, pending),
+                    )
+                elif relation_dict.get("key") in REACTIONS and (
+                    should_enable_join_confirm(self.room_features, room.room_id)
+                ):
+                    # Could be a notice sent before they were recorded
+                    self.dispatcher.submit(
+                        room.room_id,
+                        lambda: self._unrecorded_reaction(room, event, reacted_to),
+                    )
                 return
 
         logger.debug(
             f"Got unknown event with type to {event.type} from {event.sender} in {room.room_id}."
         )
 
-    async def _reaction(
+    async def _unrecorded_reaction(
         self, room: MatrixRoom, event: UnknownEvent, reacted_to_id: str
     ) -> None:
-        """A reaction was sent to one of our messages. Let's send a reply acknowledging it.
+        """A join confirm reaction was sent to an event that isn't a pending
+        notice. Handle it if the event is a notice sent before pending ones
+        were recorded.
 
         Args:
             room: The room the reaction was sent in.
@@ -150,50 +563,77 @@ class Callbacks:
 
             reacted_to_id: The event ID that the reaction points to.
         """
-        logger.debug(f"Got reaction to {room.room_id} from {event.sender}.")
-
-        # Get the original event that was reacted to
-        event_response = await self.client.room_get_event(room.room_id, reacted_to_id)
-        if isinstance(event_response, RoomGetEventError):
+        try:
+            reacted_to_event = await fetch_event(
+                self.client, room.room_id, reacted_to_id
+            )
+        except NyxBotRuntimeError:
             logger.warning(
                 "Error getting event that was reacted to (%s)", reacted_to_id
             )
             return
-        reacted_to_event = event_response.event
-        if (
-            is_bot_event(reacted_to_event)
-            and get_bot_event_type(reacted_to_event) == "join_confirm"
-        ):
-            content = reacted_to_event.source.get("content")
-            state_key = content.get("io.github.shadowrz.nyx_bot", {}).get("state_key")
-            required_reaction = hash_user_id(state_key)
+        if get_bot_event_type(reacted_to_event) != "join_confirm":
+            return
+        content = reacted_to_event.source.get("content")
+        state_key = content.get("io.github.shadowrz.nyx_bot", {}).get("state_key")
+        if state_key:
+            pending = Pending(state_key, hash_user_id(state_key))
+            await self._reaction(room, event, reacted_to_id, pending)
+
+    async def _reaction(
+        self,
+        room: MatrixRoom,
+        event: UnknownEvent,
+        reacted_to_id: str,
+        pending: Pending,
+    ) -> None:
+        """A reaction was sent to a join confirm notice. Release the joined user if
+        it's the expected one.
 
-            reaction_content = (
-                event.source.get("content", {}).get("m.relates_to", {}).get("key")
+        Args:
+            room: The room the reaction was sent in.
+
+            event: The reaction event.
+
+            reacted_to_id: The event ID that the reaction points to.
+
+            pending: The join confirmation of the notice.
+        """
+        logger.debug(f"Got reaction to {room.room_id} from {event.sender}.")
+
+        reaction_content = (
+            event.source.get("content", {}).get("m.relates_to", {}).get("key")
+        )
+
+        if reaction_content == pending.reaction:
+            # The confirmation is kept until the power levels are written, so
+            # the user can react again if writing them failed. Waiting is done
+            # outside the room's queue to not hold back its other events.
+            released = self.join_confirm.release(room.room_id, pending.state_key)
+            self._spawn(
+                self._after_released(room, pending.state_key, reacted_to_id, released)
             )
 
-            if reaction_content == required_reaction:
-                state_resp = await self.client.room_get_state_event(
-                    room.room_id, "m.room.power_levels"
-                )
-                if isinstance(state_resp, RoomGetStateEventError):
-                    logger.debug(
-                        f"Failed to get power level data in room {room.display_name} ({room.room_id}). Stop processing."
-                    )
-                    return
-                content = state_resp.content
-                events = content.get("events")
-                users = content.get("users")
-                del users[state_key]
-                await self.client.room_put_state(
-                    room.room_id,
-                    "m.room.power_levels",
-                    {"events": events, "users": users},
-                )
+    async def _after_released(
+        self,
+        room: MatrixRoom,
+        state_key: str,
+        reacted_to_id: str,
+        released: asyncio.Future,
+    ):
+        try:
+            if not await released:
+                logger.warning(f"Failed to release {state_key} in {room.room_id}.")
+                return
+        except Exception:
+            logger.exception(f"Failed to release {state_key} in {room.room_id}.")
+            return
+        self.dispatcher.submit(
+            room.room_id,
+            lambda: self.pending_confirmations.remove(room.room_id, reacted_to_id),
+        )
 
     async def membership(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
-        timestamp = make_datetime(event.server_timestamp)
-        MembershipUpdates.update_membership(room, event, timestamp)
         if event.membership == "join" and event.prev_membership in (
             None,
             "invite",
@@ -201,44 +641,58 @@ class Callbacks:
         ):
             if not should_enable_join_confirm(self.room_features, room.room_id):
                 return
-            content = event.content or {}
-            name = content.get("displayname")
+            self._join_confirm(room, event)
+
+    def _join_confirm(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
+        """Restrict a newly joined user and ask them to confirm with a reaction.
+
+        Args:
+            room: The room the user joined.
+
+            event: The membership event of the join.
+        """
+        content = event.content or {}
+        name = content.get("displayname")
+        logger.debug(
+            f"New user joined in {room.display_name}: {name} ({event.state_key})"
+        )
+        if not room.power_levels.can_user_send_state(
+            self.client.user, "m.room.power_levels"
+        ):
             logger.debug(
-                f"New user joined in {room.display_name}: {name} ({event.state_key})"
-            )
-            state_resp = await self.client.room_get_state_event(
-                room.room_id, "m.room.power_levels"
-            )
-            if isinstance(state_resp, RoomGetStateEventError):
-                logger.debug(
-                    f"Failed to get power level data in room {room.display_name} ({room.room_id}). Stop processing."
-                )
-                return
-            content = state_resp.content
-            events = content.get("events")
-            events["m.reaction"] = -1
-            users = content.get("users")
-            powers = PowerLevels(events=events, users=users)
-            if not powers.can_user_send_state(self.client.user, "m.room.power_levels"):
-                logger.debug(
-                    f"Bot is unable to update power levels in {room.display_name} ({room.room_id}). Stop processing."
-                )
-                return
-            users[event.state_key] = -1
-            put_state_resp = await self.client.room_put_state(
-                room.room_id, "m.room.power_levels", {"events": events, "users": users}
+                f"Bot is unable to update power levels in {room.display_name} ({room.room_id}). Stop processing."
             )
-            if isinstance(put_state_resp, RoomPutStateError):
-                logger.warn(
-                    f"Failed to reconfigure power level: {put_state_resp.message}"
-                )
+            return
+        # Joins of a room are restricted together, the notice is sent once
+        # the power levels are written
+        restricted = self.join_confirm.restrict(room.room_id, event.state_key)
+        self._spawn(self._after_restricted(room, event, restricted))
+
+    async def _after_restricted(
+        self, room: MatrixRoom, event: RoomMemberEvent, restricted: asyncio.Future
+    ):
+        try:
+            if not await restricted:
                 return
-            await send_text_to_room(
-                self.client,
-                room.room_id,
-                f"新加群的用户 {user_name(room, event.state_key)} ({event.state_key}) 请用 Reaction {hash_user_id(event.state_key)} 回复本条消息",
-                notice=True,
-                markdown_convert=False,
-                literal_text=True,
-                extended_data={"type": "join_confirm", "state_key": event.state_key},
+        except Exception:
+            logger.exception(f"Failed to restrict {event.state_key} in {room.room_id}.")
+            return
+        self.dispatcher.submit(
+            room.room_id, lambda: self._send_join_notice(room, event)
+        )
+
+    async def _send_join_notice(self, room: MatrixRoom, event: RoomMemberEvent):
+        reaction = hash_user_id(event.state_key)
+        response = await send_text_to_room(
+            self.client,
+            room.room_id,
+            f"新加群的用户 {user_name(room, event.state_key)} ({event.state_key}) 请用 Reaction {reaction} 回复本条消息",
+            notice=True,
+            markdown_convert=False,
+            literal_text=True,
+            extended_data={"type": "join_confirm", "state_key": event.state_key},
+        )
+        if isinstance(response, RoomSendResponse):
+            await self.pending_confirmations.add(
+                room.room_id, response.event_id, event.state_key, reaction
             )
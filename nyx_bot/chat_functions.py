@@ -5,17 +5,14 @@ import re
 import time
 from html import escape
 from io import BytesIO
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Union
 
-import magic
-from markdown import markdown
 from nio import (
     AsyncClient,
     DownloadError,
     ErrorResponse,
     MatrixRoom,
     RedactedEvent,
-    RoomGetEventError,
     RoomMessageFormatted,
     RoomMessageMedia,
     RoomMessageText,
@@ -24,20 +21,16 @@ from nio import (
     StickerEvent,
     UploadResponse,
 )
-from wand.image import Image
 
+from nyx_bot.cache import EditIndex
+from nyx_bot.compose import EncodedImage, QuoteSpec, render_quotes
 from nyx_bot.errors import NyxBotRuntimeError, NyxBotValueError
-from nyx_bot.multiquote import make_multiquote_image
-from nyx_bot.quote_image import make_single_quote_image
-from nyx_bot.storage import MatrixMessage
-from nyx_bot.utils import (
-    get_body,
-    get_external_url,
-    get_replaces,
-    make_datetime,
-    strip_beginning_quote,
-    user_name,
-)
+from nyx_bot.event_cache import fetch_event
+from nyx_bot.multiquote import make_multiquote_specs
+from nyx_bot.quote_image import fetch_avatars, make_quote_spec, quote_key
+from nyx_bot.render_pool import run_render
+from nyx_bot.storage import MessageRecorder, QuoteCache, run_db
+from nyx_bot.utils import get_body, get_replaces, strip_beginning_quote, user_name
 
 logger = logging.getLogger(__name__)
 
@@ -83,12 +76,11 @@ async def send_text_to_room(
     # Don't even try to make <mx-reply> if we're sending a notice
     target_event = None
     if (not notice) and reply_to_event_id:
-        target_resp = await client.room_get_event(room_id, reply_to_event_id)
-        if isinstance(target_resp, RoomGetEventError):
-            error = target_resp.message
-            logger.error(f"Failed to fetch event: {error}")
+        try:
+            target_event = await fetch_event(client, room_id, reply_to_event_id)
+        except NyxBotRuntimeError as e:
+            logger.error(str(e))
         else:
-            target_event = target_resp.event
             matrixdotto_url = f"https://matrix.to/#/{room_id}/{target_event.event_id}"
             pill = make_pill(target_event.sender)
             formatted_body += f'<mx-reply><blockquote><a href="{matrixdotto_url}">In reply to</a> {pill}<br/>'
@@ -143,6 +135,8 @@ async def send_text_to_room(
     }
 
     if markdown_convert:
+        from markdown import markdown
+
         formatted_body += markdown(message)
     else:
         # So HTML can be directly written
@@ -203,30 +197,27 @@ async def send_multiquote_image(
     event: RoomMessageText,
     limit: int,
     reply_to: str,
-    replace_map: dict,
+    edit_index: EditIndex,
     command_prefix: str,
     forward: bool,
+    cache_size: int,
 ):
-    target_response = await client.room_get_event(room.room_id, reply_to)
-    if isinstance(target_response, RoomGetEventError):
-        error = target_response.message
-        raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-    target_event = target_response.event
+    target_event = await fetch_event(client, room.room_id, reply_to)
     if isinstance(target_event, RedactedEvent):
         raise NyxBotRuntimeError("You can't start a multiquote on a redacted event.")
     elif isinstance(target_event, RoomMessageText):
-        quote_image = await make_multiquote_image(
+        specs = await make_multiquote_specs(
             client,
             room,
             target_event,
             limit,
-            replace_map,
+            edit_index,
             event,
             command_prefix,
             forward,
         )
-        await send_sticker_image(
-            client, room.room_id, quote_image, "[Multiquote]", event.event_id
+        await send_quote_sticker(
+            client, room.room_id, specs, "[Multiquote]", event.event_id, cache_size
         )
         await client.room_typing(room.room_id, False)
     else:
@@ -240,42 +231,93 @@ async def send_quote_image(
     room: MatrixRoom,
     event: RoomMessageText,
     reply_to: str,
-    replace_map: dict,
+    edit_index: EditIndex,
+    cache_size: int,
 ):
-    target_response = await client.room_get_event(room.room_id, reply_to)
-    if isinstance(target_response, RoomGetEventError):
-        error = target_response.message
-        raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-    target_event = target_response.event
+    target_event = await fetch_event(client, room.room_id, reply_to)
     if isinstance(target_event, RedactedEvent):
         raise NyxBotRuntimeError("Event has been redacted.")
     elif isinstance(target_event, RoomMessageText):
-        quote_image = await make_single_quote_image(
-            client, room, target_event, replace_map, True
-        )
+        spec = await make_quote_spec(client, room, target_event, edit_index, True)
         matrixdotto_url = f"https://matrix.to/#/{room.room_id}/{target_event.event_id}"
-        await send_sticker_image(
-            client, room.room_id, quote_image, matrixdotto_url, event.event_id
+        await send_quote_sticker(
+            client, room.room_id, [spec], matrixdotto_url, event.event_id, cache_size
         )
         await client.room_typing(room.room_id, False)
     else:
         raise NyxBotValueError("Please reply to a normal text message.")
 
 
+class UploadedImage(NamedTuple):
+    content_uri: str
+    mimetype: str
+    size: int
+    width: int
+    height: int
+
+
+async def send_quote_sticker(
+    client: AsyncClient,
+    room_id: str,
+    specs: List[QuoteSpec],
+    body: str,
+    reply_to: Optional[str],
+    cache_size: int,
+):
+    """Send quotes as a sticker, reusing the image if it was uploaded before."""
+    key = quote_key(specs)
+    now = int(time.time() * 1000)
+    cached = await run_db(QuoteCache.lookup, key, now)
+    if cached is not None:
+        logger.debug(f"Reusing quote image {cached.content_uri}")
+        image = UploadedImage(
+            cached.content_uri,
+            cached.mimetype,
+            cached.size,
+            cached.width,
+            cached.height,
+        )
+    else:
+        specs = await fetch_avatars(client, specs)
+        encoded = await run_render(render_quotes, specs)
+        image = await upload_image(client, encoded)
+        await run_db(QuoteCache.store, key, *image, now, cache_size)
+    await send_sticker_image(client, room_id, image, body, reply_to)
+
+
+async def upload_image(client: AsyncClient, image: EncodedImage) -> UploadedImage:
+    length = len(image.data)
+    logger.debug(
+        f"Uploading Image with length {length}, "
+        f"width={image.width}, height={image.height}"
+    )
+    resp, maybe_keys = await client.upload(
+        BytesIO(image.data),
+        content_type=image.mimetype,
+        filename="image.webp",
+        filesize=length,
+    )
+    if not isinstance(resp, UploadResponse):
+        raise NyxBotRuntimeError(f"Failed to upload image: {resp.message}")
+    return UploadedImage(
+        resp.content_uri, image.mimetype, length, image.width, image.height
+    )
+
+
 async def send_sticker_image(
     client: AsyncClient,
     room_id: str,
-    image: Image,
+    image: UploadedImage,
     body: str,
     reply_to: Optional[str] = None,
 ):
-    """Send sticker to toom. Hardcodes to WebP.
+    """Send sticker to toom.
 
     Arguments:
     ---------
     client : Client
     room_id : str
-    image : Image
+    image : UploadedImage
 
     This is a working example for a JPG image.
         "content": {
@@ -299,42 +341,24 @@ async def send_sticker_image(
 
     """
     (width, height) = (image.width, image.height)
-
-    bytesio = BytesIO()
-    with image:
-        image.format = "webp"
-        image.save(file=bytesio)
-    length = bytesio.getbuffer().nbytes
-    bytesio.seek(0)
-    logger.debug(f"Sending Image with length {length}, width={width}, height={height}")
-
-    resp, maybe_keys = await client.upload(
-        bytesio,
-        content_type="image/webp",  # image/jpeg
-        filename="image.webp",
-        filesize=length,
-    )
-    if isinstance(resp, UploadResponse):
-        print("Image was uploaded successfully to server. ")
-    else:
-        print(f"Failed to upload image. Failure response: {resp}")
+    length = image.size
 
     content = {
         "body": body,
         "info": {
             "size": length,
-            "mimetype": "image/webp",
+            "mimetype": image.mimetype,
             "thumbnail_info": {
-                "mimetype": "image/webp",
+                "mimetype": image.mimetype,
                 "size": length,
                 "w": width,  # width in pixel
                 "h": height,  # height in pixel
             },
             "w": width,  # width in pixel
             "h": height,  # height in pixel
-            "thumbnail_url": resp.content_uri,
+            "thumbnail_url": image.content_uri,
         },
-        "url": resp.content_uri,
+        "url": image.content_uri,
     }
 
     if reply_to:
@@ -347,7 +371,7 @@ async def send_sticker_image(
         await client.room_send(room_id, message_type="m.sticker", content=content)
         print("Image was sent successfully")
     except Exception:
-        print(f"Image send of file {image} failed.")
+        print(f"Image send of {body} failed.")
 
 
 async def send_user_image(
@@ -360,11 +384,7 @@ async def send_user_image(
     if not reply_to:
         target_event = event
     else:
-        target_response = await client.room_get_event(room.room_id, reply_to)
-        if isinstance(target_response, RoomGetEventError):
-            error = target_response.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        target_event = target_response.event
+        target_event = await fetch_event(client, room.room_id, reply_to)
     sender = target_event.sender
     sender_name = room.user_name(sender)
     sender_avatar = room.avatar_url(sender)
@@ -376,11 +396,14 @@ async def send_user_image(
         if isinstance(avatar_resp, DownloadError):
             error = avatar_resp.message
             raise NyxBotRuntimeError(f"Failed to download {sender_avatar}: {error}")
+        import magic
+        from wand.image import Image
+
         data = avatar_resp.body
         mimetype = magic.from_buffer(data, mime=True)
-        bytesio = BytesIO(data)
-        length = bytesio.getbuffer().nbytes
-        image = Image(file=bytesio)
+        length = len(data)
+        # Only the size is needed, don't decode the pixels
+        image = Image.ping(blob=data)
     else:
         await send_text_to_room(
             client,
@@ -466,6 +489,7 @@ async def bulk_update_messages(
     client: AsyncClient,
     room: MatrixRoom,
     start: str,
+    recorder: MessageRecorder,
     limit: int = 500,
 ):
     count = 0
@@ -476,14 +500,11 @@ async def bulk_update_messages(
         sorted_messages = sorted(messages, key=lambda ev: ev.server_timestamp)
         for event in sorted_messages:
             if isinstance(event, RoomMessageText):
-                event_replace = get_replaces(event)
-                timestamp = make_datetime(event.server_timestamp)
-                external_url = get_external_url(event)
-                MatrixMessage.update_message(
-                    room, event, external_url, timestamp, event_replace
-                )
+                recorder.record_message(room, event, get_replaces(event))
                 count += 1
         sync_token = messages_resp.end
+    # Written by the time the command replies
+    await recorder.flush()
 
 
 def gen_result_randomdraw(
@@ -0,0 +1,189 @@
+import logging
+import os.path
+from html import escape
+from typing import TYPE_CHECKING, List, NamedTuple, Optional
+
+import nyx_bot
+from nyx_bot.text_render import BACKGROUND, get_renderer, render_text
+
+if TYPE_CHECKING:
+    from wand.image import Image
+
+logger = logging.getLogger(__name__)
+
+TEXTBOX_PADDING_PIX = 16
+AVATAR_SIZE = 48
+AVATAR_RIGHT_PADDING = 6
+BORDER_MARGIN = 8
+# MIN_TEXTBOX_WIDTH = 256
+MASK_FILE = os.path.join(nyx_bot.__path__[0], "mask.png")
+
+
+class QuoteSpec(NamedTuple):
+    """Everything needed to draw a quote, as plain data for the render processes."""
+
+    event_id: str
+    # None to leave out the name and avatar
+    sender: Optional[str]
+    # Pango markup if formatted, plain text otherwise
+    text: str
+    formatted: bool
+    tag: Optional[str] = None
+    avatar_url: Optional[str] = None
+    # Avatar tile from make_avatar_tile, filled in before rendering.
+    # None for a placeholder.
+    avatar: Optional[bytes] = None
+
+
+class EncodedImage(NamedTuple):
+    data: bytes
+    width: int
+    height: int
+    mimetype: str = "image/webp"
+
+
+def warm_up():
+    """Load the rendering libraries and fonts, run when a render process starts."""
+    try:
+        import wand.image  # noqa: F401
+
+        get_renderer()
+    except ImportError:
+        # Raised again when rendering, with the job that needs it
+        logger.exception("Failed to load the rendering libraries.")
+
+
+_mask: Optional["Image"] = None
+
+
+def _mask_avatar(img: "Image"):
+    """Shrink an avatar to AVATAR_SIZE and cut it round, in place."""
+    from wand.image import Image
+    from wand.version import MAGICK_VERSION_INFO
+
+    global _mask
+    if _mask is None:
+        _mask = Image(filename=MASK_FILE)
+    img.resize(AVATAR_SIZE, AVATAR_SIZE)
+    img.alpha_channel = True
+    if MAGICK_VERSION_INFO[0] == 7:
+        img.composite_channel("default", _mask, "copy_alpha", 0, 0)
+    else:
+        img.composite_channel("default", _mask, "copy_opacity", 0, 0)
+
+
+def read_first_frame(data: bytes) -> "Image":
+    """Decode only the first frame of an image, animated avatars can have
+    hundreds of them."""
+    from wand.api import library
+    from wand.image import Image
+
+    img = Image()
+    # ImageMagick reads the scenes given after the file name, even from blobs
+    library.MagickSetFilename(img.wand, b"avatar[0]")
+    img.read(blob=data)
+    return img
+
+
+def make_avatar_tile(data: bytes) -> bytes:
+    """Turn an encoded avatar into the PNG tile drawn on quotes."""
+    with read_first_frame(data) as img:
+        _mask_avatar(img)
+        img.format = "png"
+        return img.make_blob()
+
+
+def _make_quote_image(spec: QuoteSpec) -> "Image":
+    from wand.drawing import Drawing
+    from wand.image import Image
+
+    draw = Drawing()
+    draw_text = ""
+    if spec.sender:
+        draw_text += (
+            f"""<span size="larger" foreground="#1f4788">{escape(spec.sender)}</span>"""
+        )
+        if spec.tag:
+            draw_text += f"""<span size="larger" foreground="#8D94A5"> {escape(spec.tag)}</span>"""
+    draw_text += "\n"
+    if spec.formatted:
+        # If formatted, this message should be already formatted.
+        draw_text += spec.text
+    else:
+        draw_text += escape(spec.text)
+    image = render_text(draw_text).to_image()
+    image.trim(color=BACKGROUND)
+    text_width = image.width
+    text_height = image.height
+    textbox_height = (TEXTBOX_PADDING_PIX * 2) + text_height
+    # Textbox width
+    textbox_width = (TEXTBOX_PADDING_PIX * 2) + text_width
+    # Final calculated height
+    final_height = (BORDER_MARGIN * 2) + textbox_height
+    width = (BORDER_MARGIN * 2) + AVATAR_SIZE + AVATAR_RIGHT_PADDING + textbox_width
+    height = max(final_height, AVATAR_SIZE + (BORDER_MARGIN * 2))
+
+    # Textbox
+    textbox_x = BORDER_MARGIN + AVATAR_SIZE + AVATAR_RIGHT_PADDING
+    textbox_y = BORDER_MARGIN
+
+    # Avatar tile
+    avatar = None
+    if spec.avatar is not None:
+        avatar = Image(blob=spec.avatar)
+    elif spec.sender is not None:
+        avatar = Image(width=64, height=64, background="#FFFF00")
+        _mask_avatar(avatar)
+    if avatar:
+        with avatar as img:
+            draw.composite(
+                "overlay", BORDER_MARGIN, BORDER_MARGIN, AVATAR_SIZE, AVATAR_SIZE, img
+            )
+
+    # Make image
+    draw.fill_color = BACKGROUND
+    draw.stroke_width = 0
+    draw.rectangle(
+        textbox_x, textbox_y, width=textbox_width, height=textbox_height, radius=16
+    )
+
+    # Draw text
+    text_x = textbox_x + TEXTBOX_PADDING_PIX
+    text_y = textbox_y + TEXTBOX_PADDING_PIX
+    with image:
+        draw.composite("src_over", text_x, text_y, text_width, text_height, image)
+    ret = Image(width=int(width), height=int(height))
+    with draw:
+        draw(ret)
+    return ret
+
+
+def _stack_images(images: List["Image"]) -> "Image":
+    from wand.drawing import Drawing
+    from wand.image import Image
+
+    final_width = max(img.width for img in images)
+    final_height = sum(img.height for img in images)
+
+    ret = Image(width=int(final_width), height=int(final_height))
+    render_y = 0
+    with Drawing() as draw:
+        for img in images:
+            draw.composite("overlay", 0, render_y, img.width, img.height, img)
+            render_y += img.height + 1
+        draw(ret)
+    return ret
+
+
+def render_quotes(specs: List[QuoteSpec]) -> EncodedImage:
+    """Draw quotes stacked from top to bottom and encode them as WebP."""
+    images = [_make_quote_image(spec) for spec in specs]
+    if len(images) == 1:
+        image = images[0]
+    else:
+        image = _stack_images(images)
+        for img in images:
+            img.close()
+    with image:
+        image.format = "webp"
+        return EncodedImage(image.make_blob(), image.width, image.height)
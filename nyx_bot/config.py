@@ -17,6 +17,34 @@ logging.getLogger("peewee").setLevel(
     logging.INFO
 )  # Prevent debug messages from peewee lib
 
+# Timeline events the bot handles, or that keep nio's room state current
+DEFAULT_SYNC_TIMELINE_TYPES = [
+    "m.room.message",
+    "m.room.encrypted",
+    "m.sticker",
+    "m.reaction",
+    "m.room.redaction",
+    "m.room.member",
+    "m.room.power_levels",
+    "m.room.create",
+    "m.room.name",
+    "m.room.topic",
+    "m.room.avatar",
+    "m.room.canonical_alias",
+    "m.room.encryption",
+    "m.room.join_rules",
+    "m.room.guest_access",
+    "m.room.history_visibility",
+    "m.room.tombstone",
+]
+
+RATE_LIMIT_KEYS = (
+    "room_commands_per_minute",
+    "room_command_burst",
+    "user_commands_per_minute",
+    "user_command_burst",
+)
+
 
 class Config:
     """Creates a Config object from a YAML-encoded config file from a given filepath"""
@@ -100,6 +128,57 @@ class Config:
         else:
             raise ConfigError("Invalid connection string for storage.database")
 
+        # Number of threads running database queries
+        self.database_workers = self._get_cfg(
+            ["storage", "database_workers"], default=1
+        )
+
+        # Recorded messages are buffered and written in batches
+        self.record_batch_size = self._get_cfg(
+            ["storage", "record_batch_size"], default=200
+        )
+        self.record_flush_interval = self._get_cfg(
+            ["storage", "record_flush_interval"], default=5.0
+        )
+
+        # Number of edited messages to keep in memory
+        self.edit_cache_size = self._get_cfg(
+            ["storage", "edit_cache_size"], default=10000
+        )
+
+        # Memory used for caching recently seen events, in MiB
+        self.event_cache_size = (
+            self._get_cfg(["storage", "event_cache_mb"], default=32) * 1024 * 1024
+        )
+
+        # Number of recorded events remembered in memory to skip replays,
+        # and the accepted chance of taking a new event for a recorded one
+        self.seen_events_size = self._get_cfg(
+            ["storage", "seen_events_size"], default=200000
+        )
+        self.seen_events_error_rate = self._get_cfg(
+            ["storage", "seen_events_error_rate"], default=0.0001
+        )
+
+        # Number of avatar tiles drawn on quotes to keep in memory
+        self.avatar_cache_size = self._get_cfg(
+            ["storage", "avatar_cache_size"], default=500
+        )
+        # Number of avatar tiles to keep on disk
+        self.avatar_disk_cache_size = self._get_cfg(
+            ["storage", "avatar_disk_cache_size"], default=5000
+        )
+
+        # Number of uploaded quote images remembered for quoting again
+        self.quote_cache_size = self._get_cfg(
+            ["storage", "quote_cache_size"], default=1000
+        )
+
+        # Number of recent text messages kept in memory for each room
+        self.room_timeline_size = self._get_cfg(
+            ["storage", "room_timeline_size"], default=100
+        )
+
         # Matrix bot account setup
         self.user_id = self._get_cfg(["matrix", "user_id"], required=True)
         if not re.match("@.*:.*", self.user_id):
@@ -124,29 +203,75 @@ class Config:
             "randomdraw": False,
             "record_messages": False,
             "join_confirm": False,
+            # Command rate limits, 0 disables a limit
+            "room_commands_per_minute": 0,
+            "room_command_burst": 0,
+            "user_commands_per_minute": 0,
+            "user_command_burst": 0,
         }
-        if "jerryxiao" in room_features_dict:
-            room_features_default["jerryxiao"] = room_features_dict["jerryxiao"]
-            del room_features_dict["jerryxiao"]
-        if "randomdraw" in room_features_dict:
-            room_features_default["randomdraw"] = room_features_dict["randomdraw"]
-            del room_features_dict["randomdraw"]
-        if "record_messages" in room_features_dict:
-            room_features_default["record_messages"] = room_features_dict[
-                "record_messages"
-            ]
-            del room_features_dict["record_messages"]
-        if "join_confirm" in room_features_dict:
-            room_features_default["join_confirm"] = room_features_dict["join_confirm"]
-            del room_features_dict["join_confirm"]
+        for key in list(room_features_default):
+            if key in room_features_dict:
+                room_features_default[key] = room_features_dict[key]
+                del room_features_dict[key]
         self.room_features = defaultdict(lambda: room_features_default)
         for k, v in room_features_dict.items():
             if isinstance(v, dict):
                 features_override = v
                 self.room_features[k] = room_features_default | features_override
+        for features in [room_features_default, *self.room_features.values()]:
+            for key in RATE_LIMIT_KEYS:
+                value = features[key]
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise ConfigError(f"room_features.{key} must be a number")
+                if value < 0:
+                    raise ConfigError(f"room_features.{key} must not be negative")
 
         self.encryption = self._get_cfg(["encryption"], False, required=False)
 
+        # Sync filter, an empty list of timeline types disables type filtering
+        self.sync_timeline_types = self._get_cfg(
+            ["sync", "timeline_types"], default=DEFAULT_SYNC_TIMELINE_TYPES
+        )
+        if not isinstance(self.sync_timeline_types, list):
+            raise ConfigError("sync.timeline_types must be a list")
+        self.sync_lazy_load_members = self._get_cfg(
+            ["sync", "lazy_load_members"], default=True
+        )
+
+        # Messages missed by limited syncs are backfilled in the background
+        self.backfill_workers = self._get_cfg(["sync", "backfill_workers"], default=2)
+        self.backfill_max_pages = self._get_cfg(
+            ["sync", "backfill_max_pages"], default=20
+        )
+
+        # Number of workers handling queued room events concurrently
+        self.dispatcher_workers = self._get_cfg(["dispatcher", "workers"], default=4)
+        if not isinstance(self.dispatcher_workers, int) or self.dispatcher_workers < 1:
+            raise ConfigError("dispatcher.workers must be a positive integer")
+        # Database and rendering commands run in a separate, smaller pool
+        self.heavy_workers = self._get_cfg(["dispatcher", "heavy_workers"], default=2)
+        if not isinstance(self.heavy_workers, int) or self.heavy_workers < 1:
+            raise ConfigError("dispatcher.heavy_workers must be a positive integer")
+        self.heavy_queue_size = self._get_cfg(
+            ["dispatcher", "heavy_queue_size"], default=20
+        )
+        if not isinstance(self.heavy_queue_size, int) or self.heavy_queue_size < 1:
+            raise ConfigError("dispatcher.heavy_queue_size must be a positive integer")
+
+        # Processes drawing images, and how many images may wait for one
+        self.render_processes = self._get_cfg(
+            ["dispatcher", "render_processes"], default=self.heavy_workers
+        )
+        if not isinstance(self.render_processes, int) or self.render_processes < 1:
+            raise ConfigError("dispatcher.render_processes must be a positive integer")
+        self.render_queue_size = self._get_cfg(
+            ["dispatcher", "render_queue_size"], default=8
+        )
+        if not isinstance(self.render_queue_size, int) or self.render_queue_size < 0:
+            raise ConfigError(
+                "dispatcher.render_queue_size must be a non-negative integer"
+            )
+
     def _get_cfg(
         self,
         path: List[str],
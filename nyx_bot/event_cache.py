@@ -0,0 +1,148 @@
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+from nio import AsyncClient, Event, RoomGetEventError, RoomMessageText
+
+from nyx_bot.errors import NyxBotRuntimeError
+
+logger = logging.getLogger(__name__)
+
+# Rough size of an event besides its text, in bytes
+EVENT_OVERHEAD = 1024
+
+
+def estimate_event_size(event: Event) -> int:
+    """Roughly estimate the memory used by an event without serializing it."""
+    size = EVENT_OVERHEAD
+    for attr in ("body", "formatted_body"):
+        value = getattr(event, attr, None)
+        if isinstance(value, str):
+            size += len(value)
+    return size
+
+
+class EventCache:
+    """Caches events by (room_id, event_id), evicting the least recently used
+    ones once their estimated size reaches ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.events: "OrderedDict[Tuple[str, str], Tuple[Event, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def get(self, room_id: str, event_id: str) -> Optional[Event]:
+        item = self.events.get((room_id, event_id))
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.events.move_to_end((room_id, event_id))
+        return item[0]
+
+    def put(self, room_id: str, event: Event):
+        key = (room_id, event.event_id)
+        self.pop(room_id, event.event_id)
+        size = estimate_event_size(event)
+        self.events[key] = (event, size)
+        self.size += size
+        self._evict()
+
+    def pop(self, room_id: str, event_id: str):
+        item = self.events.pop((room_id, event_id), None)
+        if item is not None:
+            self.size -= item[1]
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.events:
+            _, (_, size) = self.events.popitem(last=False)
+            self.size -= size
+
+
+class RoomTimeline:
+    """Keeps the last ``size`` text messages of each room, in timeline order."""
+
+    def __init__(self, size: int = 100):
+        self.size = size
+        self.rooms: Dict[str, Deque[RoomMessageText]] = {}
+
+    def configure(self, size: int):
+        self.size = size
+        self.rooms = {
+            room_id: deque(events, maxlen=size)
+            for room_id, events in self.rooms.items()
+        }
+
+    def append(self, room_id: str, event: RoomMessageText):
+        events = self.rooms.get(room_id)
+        if events is None:
+            events = deque(maxlen=self.size)
+            self.rooms[room_id] = events
+        events.append(event)
+
+    def reset(self, room_id: str, events: Iterable[RoomMessageText]):
+        """Replace the messages of a room after a gap in its timeline, so
+        messages from both sides of it aren't taken as consecutive."""
+        self.rooms[room_id] = deque(events, maxlen=self.size)
+
+    def remove(self, room_id: str, event_id: str):
+        events = self.rooms.get(room_id)
+        if events is None:
+            return
+        for event in events:
+            if event.event_id == event_id:
+                events.remove(event)
+                return
+
+    def get(self, room_id: str, event_id: str) -> Optional[RoomMessageText]:
+        for event in reversed(self.rooms.get(room_id, ())):
+            if event.event_id == event_id:
+                return event
+        return None
+
+    def neighbours(
+        self, room_id: str, event_id: str, forward: bool
+    ) -> Optional[List[RoomMessageText]]:
+        """Get the known messages after (or before) an event, nearest first.
+
+        Returns None if the event isn't in the timeline.
+        """
+        events = list(self.rooms.get(room_id, ()))
+        for index, event in enumerate(events):
+            if event.event_id == event_id:
+                if forward:
+                    return events[index + 1 :]
+                return events[index - 1 :: -1] if index else []
+        return None
+
+
+event_cache = EventCache()
+room_timeline = RoomTimeline()
+
+
+async def fetch_event(client: AsyncClient, room_id: str, event_id: str) -> Event:
+    """Get an event, from the recent timeline or the cache if possible.
+
+    Raises:
+        NyxBotRuntimeError: If the event couldn't be fetched from the server.
+    """
+    event = room_timeline.get(room_id, event_id)
+    if event is not None:
+        return event
+    event = event_cache.get(room_id, event_id)
+    if event is not None:
+        return event
+    target_response = await client.room_get_event(room_id, event_id)
+    if isinstance(target_response, RoomGetEventError):
+        error = target_response.message
+        raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
+    event = target_response.event
+    event_cache.put(room_id, event)
+    return event
@@ -1,8 +1,10 @@
 import logging
 
-from nio import AsyncClient, MatrixRoom, RoomGetEventError, RoomMessageText
+from nio import AsyncClient, MatrixRoom, RoomMessageText
 
 from nyx_bot.chat_functions import make_pill, send_text_to_room
+from nyx_bot.errors import NyxBotRuntimeError
+from nyx_bot.event_cache import fetch_event
 
 logger = logging.getLogger(__name__)
 
@@ -49,12 +51,12 @@ async def send_jerryxiao(
     reversed_senders: bool = False,
 ):
     from_sender = event.sender
-    target_event = await client.room_get_event(room.room_id, reply_to)
-    if isinstance(target_event, RoomGetEventError):
-        error = target_event.message
-        logger.error(f"Failed to fetch event: {error}")
+    try:
+        target_event = await fetch_event(client, room.room_id, reply_to)
+    except NyxBotRuntimeError as e:
+        logger.error(str(e))
         return
-    to_sender = target_event.event.sender
+    to_sender = target_event.sender
     action = reference_text[len(prefix) :]
     if action.isascii():
         return
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+
+from nyx_bot.power_levels import PowerLevelCache
+from nyx_bot.storage import PendingConfirmation, run_db
+
+logger = logging.getLogger(__name__)
+
+# How long to collect changes before writing them, in seconds
+BATCH_WINDOW_SECONDS = 1.0
+
+# Power level of users who haven't confirmed their join yet
+RESTRICTED_LEVEL = -1
+
+
+class JoinConfirmBatcher:
+    """Coalesces the power level changes of join confirming.
+
+    Restricting new users and releasing confirmed ones are collected per room
+    for a short window, then written with a single state update.
+    """
+
+    def __init__(
+        self, power_levels: PowerLevelCache, window: float = BATCH_WINDOW_SECONDS
+    ):
+        self.power_levels = power_levels
+        self.window = window
+        # New power level of each user, None to drop them from the users list
+        self.pending: Dict[str, Dict[str, Optional[int]]] = {}
+        self.futures: Dict[str, asyncio.Future] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.tasks: Set[asyncio.Task] = set()
+
+    def restrict(self, room_id: str, user_id: str) -> asyncio.Future:
+        """Restrict a user until they confirm their join.
+
+        Returns:
+            A future resolving to whether the change was written.
+        """
+        return self._add(room_id, user_id, RESTRICTED_LEVEL)
+
+    def release(self, room_id: str, user_id: str) -> asyncio.Future:
+        """Drop the restriction of a user.
+
+        Returns:
+            A future resolving to whether the change was written.
+        """
+        return self._add(room_id, user_id, None)
+
+    def _add(self, room_id: str, user_id: str, level: Optional[int]) -> asyncio.Future:
+        changes = self.pending.get(room_id)
+        if changes is None:
+            changes = {}
+            self.pending[room_id] = changes
+            self.futures[room_id] = asyncio.get_running_loop().create_future()
+            task = asyncio.ensure_future(self._flush_later(room_id))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        # A later change of the same user replaces the earlier one
+        changes[user_id] = level
+        return self.futures[room_id]
+
+    async def close(self):
+        """Drop the changes waiting to be written, failing their futures."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _flush_later(self, room_id: str):
+        cancelled = False
+        try:
+            await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            cancelled = True
+        changes = self.pending.pop(room_id)
+        future = self.futures.pop(room_id)
+        if cancelled:
+            future.set_result(False)
+            raise asyncio.CancelledError()
+        lock = self.locks.get(room_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[room_id] = lock
+        result = False
+        try:
+            # Don't overlap with a previous write of the room
+            async with lock:
+                result = await self._apply(room_id, changes)
+        except Exception:
+            logger.exception(f"Failed to update power levels in {room_id}.")
+        finally:
+            # Resolved even when cancelled, so nothing waits for it forever
+            future.set_result(result)
+
+    async def _apply(self, room_id: str, changes: Dict[str, Optional[int]]) -> bool:
+        content = await self.power_levels.get_content(room_id)
+        if content is None:
+            return False
+        users = content.setdefault("users", {})
+        for user_id, level in changes.items():
+            if level is None:
+                users.pop(user_id, None)
+            else:
+                users[user_id] = level
+        if RESTRICTED_LEVEL in changes.values():
+            # Let restricted users send the confirming reaction
+            content.setdefault("events", {})["m.reaction"] = RESTRICTED_LEVEL
+        result = await self.power_levels.put_content(room_id, content)
+        if result:
+            logger.info(
+                f"Merged {len(changes)} join confirm updates into one power level update in {room_id}."
+            )
+        return result
+
+
+class Pending(NamedTuple):
+    """A join confirm notice waiting for a reaction."""
+
+    state_key: str
+    reaction: str
+
+
+class PendingConfirmations:
+    """Join confirm notices still waiting for their reaction.
+
+    Kept in memory by (room_id, event_id) of the notice so reactions can be
+    checked without fetching the reacted event, and in the database so they
+    survive a restart.
+    """
+
+    def __init__(self):
+        self.pending: Dict[Tuple[str, str], Pending] = {}
+
+    async def load(self):
+        rows = await run_db(PendingConfirmation.load_all)
+        for room_id, event_id, state_key, reaction in rows:
+            self.pending[(room_id, event_id)] = Pending(state_key, reaction)
+        logger.info(f"Loaded {len(rows)} pending join confirmations.")
+
+    def get(self, room_id: str, event_id: str) -> Optional[Pending]:
+        return self.pending.get((room_id, event_id))
+
+    async def add(self, room_id: str, event_id: str, state_key: str, reaction: str):
+        self.pending[(room_id, event_id)] = Pending(state_key, reaction)
+        await run_db(PendingConfirmation.add, room_id, event_id, state_key, reaction)
+
+    async def remove(self, room_id: str, event_id: str):
+        if self.pending.pop((room_id, event_id), None) is not None:
+            await run_db(PendingConfirmation.remove, room_id, event_id)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
+import asyncio
 import logging
 import os.path
+import signal
 import sys
 from asyncio.exceptions import TimeoutError
-from time import sleep
+from typing import Any, Dict, Union
 
 from aiohttp import ClientConnectionError, ServerDisconnectedError
 from nio import (
@@ -11,28 +13,120 @@ from nio import (
     AsyncClientConfig,
     LocalProtocolError,
     LoginError,
+    RedactionEvent,
     RoomMemberEvent,
+    RoomMessage,
     RoomMessageText,
+    StickerEvent,
     SyncError,
+    SyncResponse,
     UnknownEvent,
+    UploadFilterError,
 )
 from peewee import OperationalError
 from playhouse.db_url import connect
 
+from nyx_bot.avatar_cache import avatar_cache
 from nyx_bot.callbacks import Callbacks
 from nyx_bot.config import Config
+from nyx_bot.errors import NyxBotRuntimeError
+from nyx_bot.event_cache import event_cache, room_timeline
 from nyx_bot.migrations import migrate_db
+from nyx_bot.render_pool import render_pool
+from nyx_bot.seen_events import seen_events
+from nyx_bot.startup import startup_timer
 from nyx_bot.storage import (
     ArchPackage,
+    BackfillGap,
     DatabaseVersion,
     MatrixMessage,
     MembershipUpdates,
+    MessageEdit,
+    PendingConfirmation,
+    QuoteCache,
     UserTag,
+    database_executor,
     pkginfo_database,
+    recent_recorded_events,
+    run_db,
 )
+from nyx_bot.supervisor import ReconnectBackoff
+from nyx_bot.sync_state import SyncStateStore
 
 logger = logging.getLogger(__name__)
 
+# How long queued work may take to finish before reconnecting, in seconds
+DRAIN_TIMEOUT_SECONDS = 10.0
+
+
+def make_sync_filter(config: Config) -> Dict[str, Any]:
+    """Make the filter of the sync loop from the config."""
+    lazy_load_members = config.sync_lazy_load_members
+    timeline = {"lazy_load_members": lazy_load_members}
+    if config.sync_timeline_types:
+        timeline["types"] = config.sync_timeline_types
+    return {
+        "presence": {"not_types": ["*"]},
+        "room": {
+            "timeline": timeline,
+            "state": {"lazy_load_members": lazy_load_members},
+            "ephemeral": {"not_types": ["*"]},
+        },
+    }
+
+
+async def upload_sync_filter(
+    client: AsyncClient, sync_filter: Dict[str, Any]
+) -> Union[str, Dict[str, Any]]:
+    """Upload a sync filter, returning its ID or the filter itself on failure."""
+    resp = await client.upload_filter(
+        presence=sync_filter["presence"], room=sync_filter["room"]
+    )
+    if isinstance(resp, UploadFilterError):
+        logger.warning(f"Failed to upload sync filter, sending it inline: {resp}")
+        return sync_filter
+    return resp.filter_id
+
+
+def is_rejected_token(resp: SyncError) -> bool:
+    """Whether a sync failed because the server doesn't accept its since token.
+
+    Servers answer an invalid token with a 400, Synapse with M_UNKNOWN and
+    "Invalid stream token", others with M_INVALID_PARAM. Any other failure is
+    retried with the same token, so the saved state isn't thrown away.
+    """
+    transport = resp.transport_response
+    if transport is None or transport.status != 400:
+        return False
+    if resp.status_code == "M_INVALID_PARAM":
+        return True
+    return resp.status_code == "M_UNKNOWN" and "token" in resp.message.lower()
+
+
+async def full_sync(
+    client: AsyncClient,
+    sync_filter: Union[str, Dict[str, Any]],
+    backoff: ReconnectBackoff,
+):
+    """Sync the full state of all rooms.
+
+    Event callbacks aren't run on the timeline of a full sync, it's history the
+    bot has either already handled or missed.
+    """
+    event_callbacks = client.event_callbacks
+    client.event_callbacks = []
+    try:
+        resp = await client.sync(
+            timeout=30000, sync_filter=sync_filter, full_state=True
+        )
+        while isinstance(resp, SyncError):
+            await backoff.wait(f"Initial sync failed ({resp.message})")
+            resp = await client.sync(
+                timeout=30000, sync_filter=sync_filter, full_state=True
+            )
+    finally:
+        client.event_callbacks = event_callbacks
+
 
 async def main():
     """The first function that is run when starting the bot"""
@@ -45,17 +139,66 @@ async def main():
         config_path = "nyx_bot.toml"
 
     # Read the parsed config file and create a Config object
-    config = Config(config_path)
+    with startup_timer.step("config"):
+        config = Config(config_path)
+
+    event_cache.configure(config.event_cache_size)
+    room_timeline.configure(config.room_timeline_size)
+    render_pool.configure(config.render_processes, config.render_queue_size)
+    avatar_cache.configure(
+        os.path.join(config.store_path, "avatars"),
+        config.avatar_cache_size,
+        config.avatar_disk_cache_size,
+    )
 
     # Configure the database
-    db = connect(config.database["connection_string"])
-    db.connect()
-    db.bind([MatrixMessage, UserTag, MembershipUpdates, DatabaseVersion])
-    db.create_tables([MatrixMessage, UserTag, MembershipUpdates, DatabaseVersion])
-    try:
-        migrate_db(db)
-    except OperationalError:
-        pass
+    database_executor.configure(config.database_workers)
+    with startup_timer.step("database connect"):
+        db = connect(config.database["connection_string"])
+        db.connect()
+    db.bind(
+        [
+            MatrixMessage,
+            UserTag,
+            MembershipUpdates,
+            MessageEdit,
+            PendingConfirmation,
+            BackfillGap,
+            QuoteCache,
+            DatabaseVersion,
+        ]
+    )
+    with startup_timer.step("migrations"):
+        db.create_tables([DatabaseVersion])
+        # Migrate existing tables before creating any missing tables and indexes
+        try:
+            migrate_db(db)
+        except OperationalError:
+            pass
+        db.create_tables(
+            [
+                MatrixMessage,
+                UserTag,
+                MembershipUpdates,
+                MessageEdit,
+                PendingConfirmation,
+                BackfillGap,
+                QuoteCache,
+            ]
+        )
+
+    # Remember recently recorded events, so replayed ones aren't written again
+    seen_events.configure(config.seen_events_size, config.seen_events_error_rate)
+    with startup_timer.step("seen events"):
+        seen_events.add_many(
+            await run_db(recent_recorded_events, config.seen_events_size // 2)
+        )
+    stats = seen_events.stats()
+    logger.info(
+        f"Remembering {stats['events']} recorded events in "
+        f"{stats['memory_bytes'] // 1024} KiB, "
+        f"false positive rate {stats['false_positive_rate']:.2e}."
+    )
 
     pacman_db = os.path.join(config.store_path, "pacman_pkginfo.db")
     pkginfo_database.init(pacman_db)
@@ -83,73 +226,130 @@ async def main():
         client.user_id = config.user_id
 
     callbacks = Callbacks(client, config)
-    callbacks_added = False
+    await callbacks.pending_confirmations.load()
+    sync_state = SyncStateStore(
+        client, os.path.join(config.store_path, "sync_state.json"), callbacks.recorder
+    )
+    sync_filter = None
+    restored = False
+    backoff = ReconnectBackoff()
 
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            if config.user_token:
-                # Use token to log in
-                if config.encryption:
-                    client.load_store()
-
-                # Sync encryption keys with the server
-                if client.should_upload_keys:
-                    await client.keys_upload()
-            else:
-                # Try to login with the configured username/password
-                try:
-                    login_response = await client.login(
-                        password=config.user_password,
-                        device_name=config.device_name,
-                    )
+    # Set up event callbacks
+    client.add_event_callback(
+        callbacks.timeline_event, (RoomMessage, StickerEvent, RedactionEvent)
+    )
+    client.add_event_callback(callbacks.message, (RoomMessageText,))
+    client.add_event_callback(callbacks.unknown, (UnknownEvent,))
+    client.add_event_callback(callbacks.membership, (RoomMemberEvent,))
+    client.add_response_callback(callbacks.sync, (SyncResponse,))
+    client.add_response_callback(sync_state.handle_sync, (SyncResponse,))
+    client.add_response_callback(backoff.sync_succeeded, (SyncResponse,))
 
-                    # Check if login failed
-                    if login_response is LoginError:
-                        logger.error("Failed to login: %s", login_response.message)
+    # Cancel the bot on SIGTERM too, so buffered messages are still recorded
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass
+
+    try:
+        # Keep trying to reconnect on failure (with some time in-between)
+        while True:
+            try:
+                if config.user_token:
+                    # Use token to log in
+                    if config.encryption:
+                        client.load_store()
+
+                    # Sync encryption keys with the server
+                    if client.should_upload_keys:
+                        await client.keys_upload()
+                else:
+                    # Try to login with the configured username/password
+                    try:
+                        login_response = await client.login(
+                            password=config.user_password,
+                            device_name=config.device_name,
+                        )
+
+                        # Check if login failed
+                        if login_response is LoginError:
+                            logger.error("Failed to login: %s", login_response.message)
+                            return False
+                    except LocalProtocolError as e:
+                        # There's an edge case here where the user hasn't installed the correct C
+                        # dependencies. In that case, a LocalProtocolError is raised on login.
+                        logger.fatal(
+                            "Failed to login. Have you installed the correct dependencies? "
+                            "https://github.com/poljar/matrix-nio#installation "
+                            "Error: %s",
+                            e,
+                        )
                         return False
-                except LocalProtocolError as e:
-                    # There's an edge case here where the user hasn't installed the correct C
-                    # dependencies. In that case, a LocalProtocolError is raised on login.
-                    logger.fatal(
-                        "Failed to login. Have you installed the correct dependencies? "
-                        "https://github.com/poljar/matrix-nio#installation "
-                        "Error: %s",
-                        e,
+
+                    # Login succeeded!
+
+                logger.info(f"Logged in as {config.user_id}")
+                if sync_filter is None:
+                    sync_filter = await upload_sync_filter(
+                        client, make_sync_filter(config)
                     )
-                    return False
-
-                # Login succeeded!
-
-            logger.info(f"Logged in as {config.user_id}")
-            # Do a initial sync
-            resp = await client.sync(timeout=30000, full_state=True)
-            while isinstance(resp, SyncError):
-                logger.warning("Initial sync failed, retrying in 30s...")
-                sleep(30)
-                resp = await client.sync(timeout=30000, full_state=True)
-            logger.info("Initial sync completed.")
-            sync_token = resp.next_batch
-
-            if not callbacks_added:
-                # Set up event callbacks
-                client.add_event_callback(callbacks.message, (RoomMessageText,))
-                client.add_event_callback(callbacks.unknown, (UnknownEvent,))
-                client.add_event_callback(callbacks.membership, (RoomMemberEvent,))
-
-                callbacks_added = True
-
-            await client.sync_forever(timeout=30000, full_state=True, since=sync_token)
-
-        except (ClientConnectionError, ServerDisconnectedError, TimeoutError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
-
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        except Exception:
-            logger.exception("An exception was raised.")
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
+                if not restored:
+                    restored = True
+                    with startup_timer.step("restore sync state"):
+                        restored_token = sync_state.restore()
+                    if restored_token is None:
+                        # Rooms can't be rebuilt without the saved state
+                        client.next_batch = ""
+                    callbacks.backfiller.since = restored_token
+                if client.next_batch:
+                    # Catch up from the last sync, with callbacks attached
+                    with startup_timer.step("first sync"):
+                        resp = await client.sync(
+                            timeout=0, sync_filter=sync_filter, since=client.next_batch
+                        )
+                    if isinstance(resp, SyncError):
+                        if not is_rejected_token(resp):
+                            raise NyxBotRuntimeError(
+                                f"Resuming sync failed ({resp.message})"
+                            )
+                        logger.warning(
+                            f"Sync token was rejected ({resp.message}), doing a full sync."
+                        )
+                        sync_state.reset()
+                        # The history in between is lost along with the token
+                        callbacks.backfiller.since = None
+                    else:
+                        logger.info("Resumed sync from the last sync token.")
+                if not client.next_batch:
+                    with startup_timer.step("full sync"):
+                        await full_sync(client, sync_filter, backoff)
+                    logger.info("Initial sync completed.")
+                startup_timer.report()
+                await callbacks.backfiller.load()
+
+                await client.sync_forever(
+                    timeout=30000, sync_filter=sync_filter, since=client.next_batch
+                )
+                error = "Sync loop stopped"
+
+            except (ClientConnectionError, ServerDisconnectedError, TimeoutError):
+                error = "Unable to connect to homeserver"
+            except NyxBotRuntimeError as e:
+                error = str(e)
+            except Exception:
+                logger.exception("An exception was raised.")
+                error = "An exception was raised"
+            finally:
+                # Let queued work finish before closing the client connection
+                await callbacks.drain(DRAIN_TIMEOUT_SECONDS)
+                await client.close()
+            # Back off so we don't bombard the server with login requests
+            await backoff.wait(error)
+    finally:
+        await callbacks.close()
+        await sync_state.save()
+        # Write any messages still waiting to be recorded
+        await callbacks.recorder.close()
+        database_executor.shutdown()
+        render_pool.shutdown()
@@ -1,19 +1,35 @@
 # Used for migrations
 import logging
 
-from peewee import BigIntegerField, MySQLDatabase, PostgresqlDatabase, SqliteDatabase
-from playhouse.migrate import MySQLMigrator, PostgresqlMigrator, SqliteMigrator, migrate
+from peewee import (
+    BigIntegerField,
+    Entity,
+    MySQLDatabase,
+    PostgresqlDatabase,
+    SqliteDatabase,
+    fn,
+)
+from playhouse.migrate import (
+    MySQLMigrator,
+    PostgresqlMigrator,
+    SqliteMigrator,
+    make_index_name,
+    migrate,
+)
 
-from nyx_bot.storage import DatabaseVersion, MatrixMessage, UserTag
+from nyx_bot.storage import DatabaseVersion, MatrixMessage, MembershipUpdates, UserTag
 
 logger = logging.getLogger(__name__)
 
+LATEST_VERSION = 6
+
 
 def migrate_db(db):
     version_item = DatabaseVersion.get_or_none()
     if version_item is None:
+        # A new database, the tables will be created up to date.
         version_item = DatabaseVersion()
-        version_item.version = 4
+        version_item.version = LATEST_VERSION
         version_item.save()
         return
 
@@ -25,26 +41,94 @@ def migrate_db(db):
         migrator = MySQLMigrator(db)
 
     logger.info(f"Database version: {version_item.version}")
-    if version_item.version == 1:
+    if version_item.version < 2:
         migrate(migrator.add_column("usertag", "locked", UserTag.locked))
-    elif version_item.version == 2:
+
+        version_item.version = 2
+        version_item.save()
+
+    if version_item.version < 3:
         migrate(migrator.add_column("matrixmessage", "body", MatrixMessage.body))
         migrate(
             migrator.add_column(
                 "matrixmessage", "formatted_body", MatrixMessage.formatted_body
             )
         )
-    elif version_item.version == 3:
+
+        version_item.version = 3
+        version_item.save()
+
+    if version_item.version < 4:
         migrate(
             migrator.alter_column_type(
-                "matrixmessage", "origin_server_ts", BigIntegerField
+                "matrixmessage", "origin_server_ts", BigIntegerField()
             )
         )
         migrate(
             migrator.alter_column_type(
-                "membershipupdates", "origin_server_ts", BigIntegerField
+                "membershipupdates", "origin_server_ts", BigIntegerField()
             )
         )
 
-    version_item.version = 4
-    version_item.save()
+        version_item.version = 4
+        version_item.save()
+
+    if version_item.version < 5:
+        # Unique (room_id, event_id), needed for batched upserts.
+        for model in (MatrixMessage, MembershipUpdates):
+            delete_duplicates(model, [model.room_id, model.event_id])
+            add_index_online(db, model, ("room_id", "event_id"), True)
+
+        version_item.version = 5
+        version_item.save()
+
+    if version_item.version < 6:
+        # Indexes for lookups done by commands
+        delete_duplicates(UserTag, [UserTag.room_id, UserTag.sender])
+        add_index_online(db, UserTag, ("room_id", "sender"), True)
+        for model in (MatrixMessage, MembershipUpdates):
+            for columns, unique in model._meta.indexes:
+                add_index_online(db, model, columns, unique)
+
+        version_item.version = 6
+        version_item.save()
+
+
+def add_index_online(db, model, columns, unique=False):
+    """Create an index while still allowing writes to the table where possible.
+
+    Existing indexes of the same name are left as is.
+    """
+    table = model._meta.table_name
+    name = make_index_name(table, columns)
+    if any(index.name == name for index in db.get_indexes(table)):
+        return
+    logger.info(f"Creating index {name}, this may take a while...")
+
+    def quote(identifier):
+        return db.get_sql_context().sql(Entity(identifier)).query()[0]
+
+    sql = "CREATE {}INDEX {}{} ON {} ({})".format(
+        "UNIQUE " if unique else "",
+        # Postgres builds the index without locking out writes.
+        # This can't be run in a transaction, so don't run it in one.
+        "CONCURRENTLY " if isinstance(db, PostgresqlDatabase) else "",
+        quote(name),
+        quote(table),
+        ", ".join(quote(column) for column in columns),
+    )
+    if isinstance(db, MySQLDatabase):
+        # InnoDB online DDL
+        sql += " ALGORITHM=INPLACE LOCK=NONE"
+    db.execute_sql(sql)
+
+
+def delete_duplicates(model, columns):
+    """Only keep the latest row for each group of the given columns."""
+    keep = model.select(fn.MAX(model.id).alias("id")).group_by(*columns)
+    # Selecting from a derived table, as MySQL can't select from the deleted table
+    deleted = (
+        model.delete().where(model.id.not_in(keep.select_from(keep.c.id))).execute()
+    )
+    if deleted:
+        logger.info(f"Deleted {deleted} duplicated rows in {model._meta.table_name}.")
@@ -1,22 +1,25 @@
+from typing import List
+
 from nio import AsyncClient, MatrixRoom, RoomMessageText
-from wand.drawing import Drawing
-from wand.image import Image
 
-from nyx_bot.quote_image import make_single_quote_image
+from nyx_bot.cache import EditIndex
+from nyx_bot.compose import QuoteSpec
+from nyx_bot.event_cache import room_timeline
+from nyx_bot.quote_image import make_quote_spec
 from nyx_bot.utils import get_replaces, strip_beginning_quote
 
 
-async def make_multiquote_image(
+async def make_multiquote_specs(
     client: AsyncClient,
     room: MatrixRoom,
     first_event: RoomMessageText,
     limit: int,
-    replace_map: dict,
+    edit_index: EditIndex,
     self_event: RoomMessageText,
     command_prefix: str,
     forward: bool,
-) -> Image:
-    images = []
+) -> List[QuoteSpec]:
+    specs = []
     show_user = True
     sender = None
     for next_event in await fetch_events(
@@ -25,23 +28,10 @@ async def make_multiquote_image(
         show_user = sender != next_event.sender
         sender = next_event.sender
         if isinstance(next_event, RoomMessageText):
-            next_quote_image = await make_single_quote_image(
-                client, room, next_event, replace_map, show_user
+            specs.append(
+                await make_quote_spec(client, room, next_event, edit_index, show_user)
             )
-            images.append(next_quote_image)
-
-    # Make the final quote image
-    final_width = max(img.width for img in images)
-    final_height = sum(img.height for img in images)
-
-    ret = Image(width=int(final_width), height=int(final_height))
-    render_y = 0
-    with Drawing() as draw:
-        for img in images:
-            draw.composite("overlay", 0, render_y, img.width, img.height, img)
-            render_y += img.height + 1
-        draw(ret)
-    return ret
+    return specs
 
 
 async def fetch_events(
@@ -53,18 +43,14 @@ async def fetch_events(
     command_prefix: str,
     forward: bool,
 ):
-    events = []
+    events = [first_event]
     event_marker = first_event
-    events.append(first_event)
-    while len(events) < limit:
-        context_resp = await client.room_context(room.room_id, event_marker.event_id)
-        if forward:
-            collected_events = context_resp.events_after
-            collected_events.sort(key=lambda ev: ev.server_timestamp, reverse=False)
-        else:
-            collected_events = context_resp.events_before
-            collected_events.sort(key=lambda ev: ev.server_timestamp, reverse=True)
+
+    def collect(collected_events):
+        nonlocal event_marker
         for event in collected_events:
+            if len(events) >= limit:
+                return
             event_id = event.event_id
             # Ignore control message
             if event_id == self_event.event_id:
@@ -81,6 +67,26 @@ async def fetch_events(
             # Update event marker
             event_marker = event
 
+    # Try the messages the bot has seen recently first
+    recent_events = room_timeline.neighbours(
+        room.room_id, first_event.event_id, forward
+    )
+    if recent_events:
+        collect(recent_events)
+
+    while len(events) < limit:
+        context_resp = await client.room_context(room.room_id, event_marker.event_id)
+        if forward:
+            collected_events = context_resp.events_after
+            collected_events.sort(key=lambda ev: ev.server_timestamp, reverse=False)
+        else:
+            collected_events = context_resp.events_before
+            collected_events.sort(key=lambda ev: ev.server_timestamp, reverse=True)
+        if not collected_events:
+            # Reached the start or end of the room
+            break
+        collect(collected_events)
+
     # Sort events
     events.sort(key=lambda ev: ev.server_timestamp)
     # Return them
@@ -0,0 +1,73 @@
+import logging
+from copy import deepcopy
+from typing import Any, Dict, Optional
+
+from nio import (
+    AsyncClient,
+    PowerLevelsEvent,
+    RoomGetStateEventError,
+    RoomPutStateError,
+    SyncResponse,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class PowerLevelCache:
+    """Keeps the m.room.power_levels content of rooms.
+
+    The content is updated from power level events seen in sync, and only
+    fetched from the server the first time it's needed in a room. Permission
+    checks should use ``MatrixRoom.power_levels``, which nio keeps current; this
+    is for writing the state back without dropping fields nio doesn't model.
+    """
+
+    def __init__(self, client: AsyncClient):
+        self.client = client
+        self.contents: Dict[str, Dict[str, Any]] = {}
+
+    def update(self, room_id: str, content: Dict[str, Any]):
+        self.contents[room_id] = content
+
+    def invalidate(self, room_id: str):
+        self.contents.pop(room_id, None)
+
+    def handle_sync(self, response: SyncResponse):
+        """Update the cache from the state and timeline events of a sync."""
+        for room_id, info in response.rooms.join.items():
+            for event in (*info.state, *info.timeline.events):
+                if isinstance(event, PowerLevelsEvent):
+                    self.update(room_id, event.source.get("content", {}))
+        for room_id in response.rooms.leave:
+            self.invalidate(room_id)
+
+    async def get_content(self, room_id: str) -> Optional[Dict[str, Any]]:
+        """Get a copy of the power levels content of a room, or None on failure."""
+        content = self.contents.get(room_id)
+        if content is None:
+            state_resp = await self.client.room_get_state_event(
+                room_id, "m.room.power_levels"
+            )
+            if isinstance(state_resp, RoomGetStateEventError):
+                logger.debug(
+                    f"Failed to get power level data in room {room_id}: {state_resp.message}"
+                )
+                return None
+            content = state_resp.content
+            self.update(room_id, content)
+        return deepcopy(content)
+
+    async def put_content(self, room_id: str, content: Dict[str, Any]) -> bool:
+        """Write the power levels content of a room, returning whether it worked."""
+        put_state_resp = await self.client.room_put_state(
+            room_id, "m.room.power_levels", content
+        )
+        if isinstance(put_state_resp, RoomPutStateError):
+            logger.warning(
+                f"Failed to reconfigure power level in {room_id}: {put_state_resp.message}"
+            )
+            # Read it again next time in case it changed meanwhile
+            self.invalidate(room_id)
+            return False
+        self.update(room_id, content)
+        return True
@@ -1,22 +1,15 @@
+import hashlib
+import json
 import logging
-import os.path
-from asyncio import create_subprocess_exec
-from asyncio.subprocess import PIPE
-from html import escape
-from io import BytesIO
-from os import remove
-from tempfile import mkstemp
-from typing import Optional
+from typing import List
 
-from nio import AsyncClient, DownloadError, MatrixRoom, RoomMessageText
-from wand.drawing import Drawing
-from wand.image import Image
-from wand.version import MAGICK_VERSION_INFO
+from nio import AsyncClient, MatrixRoom, RoomMessageText
 
-import nyx_bot
-from nyx_bot.errors import NyxBotRuntimeError
+from nyx_bot.avatar_cache import avatar_cache
+from nyx_bot.cache import EditIndex
+from nyx_bot.compose import QuoteSpec
 from nyx_bot.parsers import MatrixHTMLParser
-from nyx_bot.storage import UserTag
+from nyx_bot.storage import UserTag, run_db
 from nyx_bot.utils import (
     get_body,
     get_formatted_body,
@@ -27,126 +20,23 @@ from nyx_bot.utils import (
 
 logger = logging.getLogger(__name__)
 
-TEXTBOX_PADDING_PIX = 16
-AVATAR_SIZE = 48
-AVATAR_RIGHT_PADDING = 6
-BORDER_MARGIN = 8
-# MIN_TEXTBOX_WIDTH = 256
-MASK_FILE = os.path.join(nyx_bot.__path__[0], "mask.png")
+# Change this when quotes are drawn differently, to not reuse old images
+QUOTE_KEY_VERSION = 1
 
 
-async def _make_quote_image(
-    sender: Optional[str],
-    text: str,
-    avatar: Optional[Image],
-    formatted: bool,
-    tag: Optional[str] = None,
-) -> Image:
-    draw = Drawing()
-    draw_text = ""
-    if sender:
-        draw_text += (
-            f"""<span size="larger" foreground="#1f4788">{escape(sender)}</span>"""
-        )
-        if tag:
-            draw_text += (
-                f"""<span size="larger" foreground="#8D94A5"> {escape(tag)}</span>"""
-            )
-    draw_text += "\n"
-    if formatted:
-        # If formatted, this message should be already formatted.
-        draw_text += text
-    else:
-        draw_text += escape(text)
-    imagefile = await render_text(draw_text)
-    image = Image(filename=imagefile)
-    image.trim(color="#C0E5F5")
-    text_width = image.width
-    text_height = image.height
-    textbox_height = (TEXTBOX_PADDING_PIX * 2) + text_height
-    # Textbox width
-    textbox_width = (TEXTBOX_PADDING_PIX * 2) + text_width
-    # Final calculated height
-    final_height = (BORDER_MARGIN * 2) + textbox_height
-    width = (BORDER_MARGIN * 2) + AVATAR_SIZE + AVATAR_RIGHT_PADDING + textbox_width
-    height = max(final_height, AVATAR_SIZE + (BORDER_MARGIN * 2))
-
-    # Textbox
-    textbox_x = BORDER_MARGIN + AVATAR_SIZE + AVATAR_RIGHT_PADDING
-    textbox_y = BORDER_MARGIN
-
-    # Make a mask
-    if avatar:
-        with avatar.clone() as img, Image(filename=MASK_FILE) as mask:
-            img.resize(AVATAR_SIZE, AVATAR_SIZE)
-            img.alpha_channel = True
-            if MAGICK_VERSION_INFO[0] == 7:
-                img.composite_channel("default", mask, "copy_alpha", 0, 0)
-            else:
-                img.composite_channel("default", mask, "copy_opacity", 0, 0)
-            draw.composite(
-                "overlay", BORDER_MARGIN, BORDER_MARGIN, AVATAR_SIZE, AVATAR_SIZE, img
-            )
-
-    # Make image
-    draw.fill_color = "#C0E5F5"
-    draw.stroke_width = 0
-    draw.rectangle(
-        textbox_x, textbox_y, width=textbox_width, height=textbox_height, radius=16
-    )
-
-    # Draw text
-    text_x = textbox_x + TEXTBOX_PADDING_PIX
-    text_y = textbox_y + TEXTBOX_PADDING_PIX
-    with image:
-        draw.composite("src_over", text_x, text_y, text_width, text_height, image)
-    ret = Image(width=int(width), height=int(height))
-    with draw:
-        draw(ret)
-    remove(imagefile)
-    return ret
-
-
-async def render_text(text: str) -> str:
-    _, path = mkstemp(".png")
-    logger.debug(f"File path: {path}")
-    proc = await create_subprocess_exec(
-        "pango-view",
-        "--background=#C0E5F5",
-        "--foreground=black",
-        "--font=Sarasa Gothic SC 16",
-        "--antialias=gray",
-        "--margin=0",
-        "--hinting=full",
-        "--markup",
-        "--width=500",
-        "--wrap=word-char",
-        "-q",
-        "-o",
-        path,
-        f"--text={text}",
-        stdin=PIPE,
-    )
-    stdout, stderr = await proc.communicate(input=text.encode("utf-8"))
-    if stdout:
-        print(f"[stdout]\n{stdout}")
-    if stderr:
-        print(f"[stderr]\n{stderr}")
-    return path
-
-
-async def make_single_quote_image(
+async def make_quote_spec(
     client: AsyncClient,
     room: MatrixRoom,
     target_event: RoomMessageText,
-    replace_map: dict,
+    edit_index: EditIndex,
     show_user: bool = True,
-) -> Image:
+) -> QuoteSpec:
+    """Gather what is needed to draw a quote of an event, except the avatar tile."""
     sender = target_event.sender
     body = ""
     formatted = True
     formatted_body = await get_formatted_body(
-        client, room, target_event.event_id, replace_map
+        client, room, target_event.event_id, edit_index
     )
     if not formatted_body:
         formatted = False
@@ -155,7 +45,7 @@ async def make_single_quote_image(
         parser.feed(formatted_body)
         body = parser.into_pango_markup()
     else:
-        body = await get_body(client, room.room_id, target_event.event_id, replace_map)
+        body = await get_body(client, room.room_id, target_event.event_id, edit_index)
         if get_reply_to(target_event):
             body = strip_beginning_quote(body)
         if len(body) > 1000:
@@ -163,25 +53,31 @@ async def make_single_quote_image(
             body = f"{body_stripped}..."
     sender_name = user_name(room, sender)
     sender_avatar = room.avatar_url(sender)
-    image = None
-    if show_user:
-        if sender_avatar:
-            avatar_resp = await client.download(mxc=sender_avatar)
-            if isinstance(avatar_resp, DownloadError):
-                error = avatar_resp.message
-                raise NyxBotRuntimeError(f"Failed to download {sender_avatar}: {error}")
-            data = avatar_resp.body
-            bytesio = BytesIO(data)
-            image = Image(file=bytesio)
-        else:
-            image = Image(width=64, height=64, background="#FFFF00")
-    else:
+    if not show_user:
         sender_name = None
-    user_tag = UserTag.get_or_none(
-        (UserTag.room_id == room.room_id) & (UserTag.sender == sender)
-    )
+        sender_avatar = None
+    user_tag = await run_db(UserTag.get_tag, room.room_id, sender)
     tag_name = None
     if user_tag:
-        tag_name = f"#{user_tag.tag}"
-    quote_image = await _make_quote_image(sender_name, body, image, formatted, tag_name)
-    return quote_image
+        tag_name = f"#{user_tag}"
+    return QuoteSpec(
+        target_event.event_id, sender_name, body, formatted, tag_name, sender_avatar
+    )
+
+
+async def fetch_avatars(client: AsyncClient, specs: List[QuoteSpec]) -> List[QuoteSpec]:
+    """Fill in the avatar tiles of quotes."""
+    return [
+        spec._replace(avatar=await avatar_cache.get(client, spec.avatar_url))
+        if spec.avatar_url
+        else spec
+        for spec in specs
+    ]
+
+
+def quote_key(specs: List[QuoteSpec]) -> str:
+    """Hash what is drawn for quotes, to find an image uploaded before."""
+    # Everything but the tile, which is known by its avatar URL. The sender is
+    # None when the name and avatar aren't shown.
+    data = [QUOTE_KEY_VERSION] + [spec._replace(avatar=None) for spec in specs]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
@@ -0,0 +1,120 @@
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from nyx_bot.utils import get_rate_limits
+
+logger = logging.getLogger(__name__)
+
+# Rate of a room in slow mode, in commands per minute
+SLOW_MODE_RATE = 1.0
+SLOW_MODE_BURST = 1.0
+
+# Drop idle buckets once there are more than this
+MAX_IDLE_BUCKETS = 10000
+
+
+class TokenBucket:
+    """Allows ``burst`` actions at once, refilled at ``rate`` per second."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now: float):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def consume(self, now: Optional[float] = None) -> bool:
+        """Take a token, returning False if there's none left."""
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class RateLimiter:
+    """Limits commands with a token bucket per room and per user in a room.
+
+    Limits are read from the room features, and a room in slow mode uses
+    SLOW_MODE_RATE instead of its configured room limit.
+    """
+
+    def __init__(self, room_features):
+        self.room_features = room_features
+        self.rooms: Dict[str, TokenBucket] = {}
+        self.users: Dict[Tuple[str, str], TokenBucket] = {}
+        self.slow_rooms = set()
+        self.limited = 0
+
+    def allow(self, room_id: str, user_id: str, now: Optional[float] = None) -> bool:
+        """Check whether a user may run a command in a room now.
+
+        A token is only taken from the room bucket if the user has one left,
+        so a single user can't use up the limit of the whole room.
+        """
+        if now is None:
+            now = time.monotonic()
+        room_rate, room_burst, user_rate, user_burst = self._limits(room_id)
+        user_bucket = None
+        if user_rate > 0:
+            user_bucket = self._bucket(
+                self.users, (room_id, user_id), user_rate, user_burst, now
+            )
+            user_bucket.refill(now)
+            if user_bucket.tokens < 1:
+                self.limited += 1
+                return False
+        if room_rate > 0:
+            room_bucket = self._bucket(self.rooms, room_id, room_rate, room_burst, now)
+            if not room_bucket.consume(now):
+                self.limited += 1
+                return False
+        if user_bucket is not None:
+            user_bucket.consume(now)
+        return True
+
+    def set_slow(self, room_id: str, enabled: bool):
+        """Turn slow mode of a room on or off."""
+        if enabled:
+            self.slow_rooms.add(room_id)
+        else:
+            self.slow_rooms.discard(room_id)
+        # Recreated with the new limits when needed
+        self.rooms.pop(room_id, None)
+
+    def _limits(self, room_id: str) -> Tuple[float, float, float, float]:
+        room_rate, room_burst, user_rate, user_burst = get_rate_limits(
+            self.room_features, room_id
+        )
+        if room_id in self.slow_rooms:
+            room_rate, room_burst = SLOW_MODE_RATE, SLOW_MODE_BURST
+        # Limits are configured per minute
+        return room_rate / 60, room_burst, user_rate / 60, user_burst
+
+    def _bucket(self, buckets, key, rate: float, burst: float, now: float):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= MAX_IDLE_BUCKETS:
+                self._prune(buckets, now)
+            bucket = TokenBucket(rate, burst, now)
+            buckets[key] = bucket
+        return bucket
+
+    @staticmethod
+    def _prune(buckets, now: float):
+        # A full bucket behaves the same as a new one
+        for key in [key for key, bucket in buckets.items() if bucket.is_full(now)]:
+            del buckets[key]
+        logger.debug(f"Pruned rate limit buckets, {len(buckets)} left.")
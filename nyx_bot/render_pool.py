@@ -0,0 +1,73 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, TypeVar
+
+from nyx_bot.compose import warm_up
+from nyx_bot.errors import NyxBotRuntimeError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RenderPool:
+    """Runs image rendering in worker processes.
+
+    ImageMagick work blocks for hundreds of milliseconds, so it runs off the
+    event loop on up to ``workers`` cores. Jobs take and return plain data.
+    At most ``max_queued`` jobs wait for a free process, others are refused.
+    """
+
+    def __init__(self, workers: int = 2, max_queued: int = 8):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.running = 0
+
+    def configure(self, workers: int, max_queued: int):
+        """Set the pool size. Must be called before anything is rendered."""
+        self.workers = workers
+        self.max_queued = max_queued
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        if self.running >= self.workers + self.max_queued:
+            raise NyxBotRuntimeError(
+                "Too many images are being rendered, please try again later."
+            )
+        if self.executor is None:
+            # Spawned rather than forked from the running bot and its threads
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=warm_up,
+            )
+        loop = asyncio.get_running_loop()
+        self.running += 1
+        try:
+            return await loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs)
+            )
+        except BrokenProcessPool:
+            logger.exception("A render process died, restarting the pool.")
+            self.shutdown()
+            raise NyxBotRuntimeError("Rendering failed, please try again.")
+        finally:
+            self.running -= 1
+
+    def shutdown(self):
+        """Stop the render processes."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+render_pool = RenderPool()
+
+
+async def run_render(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run a rendering function in a render process and await its result."""
+    return await render_pool.run(func, *args, **kwargs)
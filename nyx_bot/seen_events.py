@@ -0,0 +1,117 @@
+import logging
+import math
+from typing import Any, Dict, Iterable, Tuple
+
+import xxhash
+
+logger = logging.getLogger(__name__)
+
+MASK_64 = (1 << 64) - 1
+
+
+class BloomFilter:
+    """A fixed size set of keys that may report keys it never had.
+
+    Sized for ``capacity`` keys with about ``error_rate`` false positives.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.num_bits = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key: bytes):
+        # Double hashing, both halves of one 128 bit hash
+        digest = xxhash.xxh3_128_intdigest(key)
+        h1 = digest & MASK_64
+        h2 = (digest >> 64) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: bytes):
+        for index in self._indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(
+            self.bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(key)
+        )
+
+    def false_positive_rate(self) -> float:
+        """Estimate the current chance of a false positive from the keys added."""
+        return (
+            1 - math.exp(-self.num_hashes * self.count / self.num_bits)
+        ) ** self.num_hashes
+
+
+class SeenEvents:
+    """Remembers which events were already recorded to the database.
+
+    Two Bloom filters are kept; once the current one holds ``capacity`` events
+    it becomes the previous one and the oldest is dropped, so memory stays
+    bounded and the most recent ``capacity`` to ``2 * capacity`` events are
+    remembered. Events found here are skipped without asking the database, so
+    a false positive loses a new event and ``error_rate`` should be kept low.
+    """
+
+    def __init__(self, capacity: int = 200000, error_rate: float = 0.0001):
+        self.configure(capacity, error_rate)
+
+    def configure(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+        self.rotations = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(room_id: str, event_id: str) -> bytes:
+        return f"{room_id}|{event_id}".encode()
+
+    def add(self, room_id: str, event_id: str):
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.rotations += 1
+        self.current.add(self._key(room_id, event_id))
+
+    def add_many(self, keys: Iterable[Tuple[str, str]]):
+        for room_id, event_id in keys:
+            self.add(room_id, event_id)
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        encoded = self._key(*key)
+        if encoded in self.current or encoded in self.previous:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def false_positive_rate(self) -> float:
+        """Estimate the chance of an unseen event looking seen in either filter."""
+        return 1 - (1 - self.current.false_positive_rate()) * (
+            1 - self.previous.false_positive_rate()
+        )
+
+    def memory_bytes(self) -> int:
+        return len(self.current.bits) + len(self.previous.bits)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "events": self.current.count + self.previous.count,
+            "memory_bytes": self.memory_bytes(),
+            "false_positive_rate": self.false_positive_rate(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "rotations": self.rotations,
+        }
+
+
+seen_events = SeenEvents()
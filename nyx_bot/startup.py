@@ -0,0 +1,46 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Imported one by one at startup to report their import time, in dependency
+# order so each entry only counts what the previous ones didn't import
+STARTUP_MODULES = [
+    "nio",
+    "peewee",
+    "nyx_bot.storage",
+    "nyx_bot.chat_functions",
+    "nyx_bot.bot_commands",
+    "nyx_bot.callbacks",
+    "nyx_bot.main",
+]
+
+
+class StartupTimer:
+    """Collects how long each startup step took, and logs them once."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps: List[Tuple[str, float]] = []
+        self.reported = False
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - start))
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        total = time.perf_counter() - self.started
+        steps = ", ".join(f"{name} {elapsed:.3f}s" for name, elapsed in self.steps)
+        logger.info(f"Started in {total:.3f}s: {steps}")
+
+
+startup_timer = StartupTimer()
@@ -1,10 +1,15 @@
+import asyncio
+import functools
+import logging
 import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO
-from typing import Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
 
 from nio import MatrixRoom, RoomMemberEvent, RoomMessageText
 from peewee import (
+    EXCLUDED,
     BigIntegerField,
     BooleanField,
     CharField,
@@ -12,14 +17,60 @@ from peewee import (
     DateTimeField,
     IntegerField,
     Model,
+    MySQLDatabase,
     SqliteDatabase,
     TextField,
     chunked,
 )
 
 from nyx_bot.errors import NyxBotRuntimeError
+from nyx_bot.seen_events import seen_events
 from nyx_bot.utils import get_external_url, make_datetime
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class DatabaseExecutor:
+    """Runs blocking database calls on dedicated threads.
+
+    peewee is synchronous, so every query goes through here to keep the event
+    loop responsive while the database is slow.
+    """
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def configure(self, workers: int):
+        """Set the number of database threads. Must be called before any query."""
+        self.workers = workers
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="nyx_bot-db"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def shutdown(self):
+        """Wait for running queries and stop the database threads."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+database_executor = DatabaseExecutor()
+
+
+async def run_db(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking database call on the database threads and await its result."""
+    return await database_executor.run(func, *args, **kwargs)
+
 
 class MatrixMessage(Model):
     room_id = CharField()
@@ -34,41 +85,70 @@ class MatrixMessage(Model):
     date = DateField()
     datetime = DateTimeField()
 
+    class Meta:
+        indexes = (
+            (("room_id", "event_id"), True),
+            # last_message and wordclouds of a user
+            (("room_id", "sender", "origin_server_ts"), False),
+            # Wordclouds of a room
+            (("room_id", "origin_server_ts"), False),
+            (("room_id", "external_url"), False),
+        )
+
     @staticmethod
-    def update_message(
-        room: MatrixRoom,
+    def make_row(
+        room_id: str,
         event: RoomMessageText,
         event_replace: Optional[str] = None,
         include_text: Optional[bool] = False,
-    ):
+    ) -> Dict[str, Any]:
+        """Build the row recorded for a message, for use with bulk inserts."""
         timestamp = make_datetime(event.server_timestamp)
-        external_url = get_external_url(event)
-        message_db_item = MatrixMessage.get_or_none(
-            (MatrixMessage.room_id == room.room_id)
-            & (MatrixMessage.event_id == event.event_id)
-        )
-        if not message_db_item:
-            message_db_item = MatrixMessage()
-        message_db_item.room_id = room.room_id
-        message_db_item.event_id = event.event_id
+        row = {
+            "room_id": room_id,
+            "event_id": event.event_id,
+            "origin_server_ts": event.server_timestamp,
+            "external_url": get_external_url(event),
+            "sender": event.sender,
+            "is_replacement": event_replace is not None,
+            "date": timestamp.date(),
+            "datetime": timestamp,
+        }
         if include_text:
-            message_db_item.body = event.body
-            message_db_item.formatted_body = event.formatted_body
-        message_db_item.origin_server_ts = event.server_timestamp
-        message_db_item.external_url = external_url
-        message_db_item.sender = event.sender
-        message_db_item.datetime = timestamp
-        message_db_item.date = timestamp.date()
-        if event_replace:
-            message_db_item.is_replacement = True
-            replace_item = MatrixMessage.get_or_none(
-                (MatrixMessage.room_id == room.room_id)
-                & (MatrixMessage.event_id == event_replace)
+            row["body"] = event.body
+            row["formatted_body"] = event.formatted_body
+        return row
+
+    @staticmethod
+    def last_message(room_id: str, sender: str) -> "MatrixMessage":
+        return (
+            MatrixMessage.select()
+            .where(
+                (MatrixMessage.room_id == room_id) & (MatrixMessage.sender == sender)
             )
-            if replace_item:
-                replace_item.replaced_by = event.event_id
-                replace_item.save()
-        message_db_item.save()
+            .order_by(MatrixMessage.origin_server_ts.desc())
+            .get()
+        )
+
+    @staticmethod
+    def lookup_external_url(
+        room_id: str, external_url: str
+    ) -> Optional["MatrixMessage"]:
+        return (
+            MatrixMessage.select()
+            .where(
+                (MatrixMessage.room_id == room_id)
+                & (MatrixMessage.external_url == external_url)
+            )
+            .get_or_none()
+        )
+
+    @staticmethod
+    def count_messages(room_id: Optional[str] = None) -> int:
+        query = MatrixMessage.select()
+        if room_id is not None:
+            query = query.where(MatrixMessage.room_id == room_id)
+        return query.count()
 
 
 class MembershipUpdates(Model):
@@ -84,36 +164,203 @@ class MembershipUpdates(Model):
     date = DateField()
     datetime = DateTimeField()
 
+    class Meta:
+        indexes = (
+            (("room_id", "event_id"), True),
+            (("room_id", "state_key", "origin_server_ts"), False),
+        )
+
     @staticmethod
-    def update_membership(
-        room: MatrixRoom,
-        event: RoomMemberEvent,
-        timestamp: datetime,
-    ):
+    def make_row(room_id: str, event: RoomMemberEvent) -> Dict[str, Any]:
+        """Build the row recorded for a membership event, for use with bulk inserts."""
+        timestamp = make_datetime(event.server_timestamp)
         content = event.content or {}
         prev_content = event.prev_content or {}
-        avatar_url = content.get("avatar_url")
-        prev_avatar_url = prev_content.get("avatar_url")
-        name = content.get("displayname")
-        prev_name = prev_content.get("displayname")
-        db_item = MembershipUpdates.get_or_none(
-            (MembershipUpdates.room_id == room.room_id)
-            & (MembershipUpdates.event_id == event.event_id)
+        return {
+            "room_id": room_id,
+            "event_id": event.event_id,
+            "origin_server_ts": event.server_timestamp,
+            "sender": event.sender,
+            "state_key": event.state_key,
+            "avatar_url": content.get("avatar_url"),
+            "prev_avatar_url": prev_content.get("avatar_url"),
+            "name": content.get("displayname"),
+            "prev_name": prev_content.get("displayname"),
+            "date": timestamp.date(),
+            "datetime": timestamp,
+        }
+
+    @staticmethod
+    def changes(room_id: str, state_key: str) -> List["MembershipUpdates"]:
+        """Get membership updates of a user in a room, newest first."""
+        return list(
+            MembershipUpdates.select()
+            .where(
+                (MembershipUpdates.room_id == room_id)
+                & (MembershipUpdates.state_key == state_key)
+            )
+            .order_by(MembershipUpdates.origin_server_ts.desc())
         )
-        if not db_item:
-            db_item = MembershipUpdates()
-        db_item.room_id = room.room_id
-        db_item.event_id = event.event_id
-        db_item.origin_server_ts = event.server_timestamp
-        db_item.sender = event.sender
-        db_item.state_key = event.state_key
-        db_item.datetime = timestamp
-        db_item.date = timestamp.date()
-        db_item.avatar_url = avatar_url
-        db_item.prev_avatar_url = prev_avatar_url
-        db_item.name = name
-        db_item.prev_name = prev_name
-        db_item.save()
+
+
+class MessageEdit(Model):
+    """The latest replacement of an edited message."""
+
+    room_id = CharField()
+    event_id = CharField()
+    replaced_by = CharField()
+    origin_server_ts = BigIntegerField()
+    # Only filled when message content is recorded in the room
+    body = TextField(null=True)
+    formatted_body = TextField(null=True)
+
+    class Meta:
+        indexes = ((("room_id", "event_id"), True),)
+
+    @staticmethod
+    def get_edit(room_id: str, event_id: str) -> Optional["MessageEdit"]:
+        return MessageEdit.get_or_none(
+            (MessageEdit.room_id == room_id) & (MessageEdit.event_id == event_id)
+        )
+
+
+class PendingConfirmation(Model):
+    """A join confirm notice waiting for the joined user's reaction."""
+
+    room_id = CharField()
+    event_id = CharField()
+    state_key = CharField()
+    reaction = CharField()
+
+    class Meta:
+        indexes = ((("room_id", "event_id"), True),)
+
+    @staticmethod
+    def add(room_id: str, event_id: str, state_key: str, reaction: str):
+        PendingConfirmation.insert(
+            room_id=room_id, event_id=event_id, state_key=state_key, reaction=reaction
+        ).on_conflict_ignore().execute()
+
+    @staticmethod
+    def remove(room_id: str, event_id: str):
+        PendingConfirmation.delete().where(
+            (PendingConfirmation.room_id == room_id)
+            & (PendingConfirmation.event_id == event_id)
+        ).execute()
+
+    @staticmethod
+    def load_all() -> List[Tuple[str, str, str, str]]:
+        return list(
+            PendingConfirmation.select(
+                PendingConfirmation.room_id,
+                PendingConfirmation.event_id,
+                PendingConfirmation.state_key,
+                PendingConfirmation.reaction,
+            ).tuples()
+        )
+
+
+class BackfillGap(Model):
+    """A part of a room's history missed by a limited sync, being backfilled."""
+
+    room_id = CharField()
+    # Pagination token to continue from, going back in time
+    start = CharField()
+    # Pagination token of the sync before the gap, where backfilling stops
+    end = CharField()
+    pages = IntegerField(default=0)
+
+    @staticmethod
+    def add(room_id: str, start: str, end: str) -> int:
+        return BackfillGap.insert(room_id=room_id, start=start, end=end).execute()
+
+    @staticmethod
+    def advance(gap_id: int, start: str, pages: int):
+        BackfillGap.update(start=start, pages=pages).where(
+            BackfillGap.id == gap_id
+        ).execute()
+
+    @staticmethod
+    def remove(gap_id: int):
+        BackfillGap.delete().where(BackfillGap.id == gap_id).execute()
+
+    @staticmethod
+    def load_all() -> List[Tuple[int, str, str, str, int]]:
+        return list(
+            BackfillGap.select(
+                BackfillGap.id,
+                BackfillGap.room_id,
+                BackfillGap.start,
+                BackfillGap.end,
+                BackfillGap.pages,
+            )
+            .order_by(BackfillGap.id)
+            .tuples()
+        )
+
+
+class QuoteCache(Model):
+    """Quote images uploaded before, by a hash of what was drawn."""
+
+    key = CharField(unique=True)
+    content_uri = CharField()
+    mimetype = CharField()
+    size = IntegerField()
+    width = IntegerField()
+    height = IntegerField()
+    # Unix time in milliseconds, the least recently used are expired first
+    last_used = BigIntegerField(index=True)
+
+    @staticmethod
+    def lookup(key: str, now: int) -> Optional["QuoteCache"]:
+        row = QuoteCache.get_or_none(QuoteCache.key == key)
+        if row is not None:
+            QuoteCache.update(last_used=now).where(QuoteCache.id == row.id).execute()
+        return row
+
+    @staticmethod
+    def store(
+        key: str,
+        content_uri: str,
+        mimetype: str,
+        size: int,
+        width: int,
+        height: int,
+        now: int,
+        max_entries: int,
+    ):
+        """Record an uploaded quote image, and expire the oldest beyond max_entries."""
+        with QuoteCache._meta.database.atomic():
+            QuoteCache.insert(
+                key=key,
+                content_uri=content_uri,
+                mimetype=mimetype,
+                size=size,
+                width=width,
+                height=height,
+                last_used=now,
+            ).on_conflict(
+                conflict_target=[QuoteCache.key],
+                preserve=[
+                    QuoteCache.content_uri,
+                    QuoteCache.mimetype,
+                    QuoteCache.size,
+                    QuoteCache.width,
+                    QuoteCache.height,
+                    QuoteCache.last_used,
+                ],
+            ).execute()
+            newest_expired = (
+                QuoteCache.select(QuoteCache.last_used)
+                .order_by(QuoteCache.last_used.desc())
+                .limit(1)
+                .offset(max_entries)
+                .scalar()
+            )
+            if newest_expired is not None:
+                QuoteCache.delete().where(
+                    QuoteCache.last_used <= newest_expired
+                ).execute()
 
 
 class UserTag(Model):
@@ -122,6 +369,18 @@ class UserTag(Model):
     tag = CharField()
     locked = BooleanField(default=False)
 
+    class Meta:
+        indexes = ((("room_id", "sender"), True),)
+
+    @staticmethod
+    def get_tag(room_id: str, sender: str) -> Optional[str]:
+        user_tag = UserTag.get_or_none(
+            (UserTag.room_id == room_id) & (UserTag.sender == sender)
+        )
+        if user_tag:
+            return user_tag.tag
+        return None
+
     @staticmethod
     def update_user_tag(room_id: str, sender: str, tag: str):
         user_tag = UserTag.get_or_none(
@@ -269,3 +528,272 @@ def update_package_info(data_source, repo):
 
 class DatabaseVersion(Model):
     version = IntegerField()
+
+
+def upsert_rows(
+    model, rows: List[Dict[str, Any]], conflict_target, preserve, where=None
+):
+    """Insert rows in batches, updating the preserved fields of existing rows.
+
+    If given, existing rows are only updated when ``where`` holds. This is not
+    supported on MySQL, where they are always updated.
+    """
+    database = model._meta.database
+    for batch in chunked(rows, 100):
+        query = model.insert_many(batch)
+        if isinstance(database, MySQLDatabase):
+            # MySQL always resolves conflicts on any unique key
+            query = query.on_conflict(preserve=preserve)
+        else:
+            query = query.on_conflict(
+                conflict_target=conflict_target, preserve=preserve, where=where
+            )
+        query.execute()
+
+
+def existing_event_ids(model, keys: Iterable[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+    """Get the given (room_id, event_id) that already have a row of ``model``."""
+    by_room: Dict[str, List[str]] = {}
+    for room_id, event_id in keys:
+        by_room.setdefault(room_id, []).append(event_id)
+    existing = set()
+    for room_id, event_ids in by_room.items():
+        for batch in chunked(event_ids, 500):
+            query = model.select(model.event_id).where(
+                (model.room_id == room_id) & (model.event_id.in_(batch))
+            )
+            existing.update((room_id, event_id) for (event_id,) in query.tuples())
+    return existing
+
+
+def recent_recorded_events(limit: int) -> List[Tuple[str, str]]:
+    """Get the (room_id, event_id) of the latest recorded messages and
+    membership updates, up to ``limit`` of each."""
+    keys = []
+    for model in (MatrixMessage, MembershipUpdates):
+        query = (
+            model.select(model.room_id, model.event_id)
+            .order_by(model.id.desc())
+            .limit(limit)
+        )
+        keys.extend(query.tuples())
+    return keys
+
+
+def write_recorded_rows(
+    messages: List[Dict[str, Any]],
+    replacements: List[Tuple[str, str, str]],
+    memberships: List[Dict[str, Any]],
+    edits: List[Dict[str, Any]],
+):
+    """Write a batch of buffered rows in one transaction."""
+    message_key = [MatrixMessage.room_id, MatrixMessage.event_id]
+    message_fields = [
+        MatrixMessage.origin_server_ts,
+        MatrixMessage.external_url,
+        MatrixMessage.sender,
+        MatrixMessage.is_replacement,
+        MatrixMessage.date,
+        MatrixMessage.datetime,
+    ]
+    text_fields = [MatrixMessage.body, MatrixMessage.formatted_body]
+    with MatrixMessage._meta.database.atomic():
+        # Message content is only overwritten when it was recorded.
+        with_text = [row for row in messages if "body" in row]
+        without_text = [row for row in messages if "body" not in row]
+        upsert_rows(MatrixMessage, with_text, message_key, message_fields + text_fields)
+        upsert_rows(MatrixMessage, without_text, message_key, message_fields)
+        for room_id, event_id, replaced_by in replacements:
+            MatrixMessage.update(replaced_by=replaced_by).where(
+                (MatrixMessage.room_id == room_id)
+                & (MatrixMessage.event_id == event_id)
+            ).execute()
+        # Membership events don't change, so recorded ones can be skipped.
+        # Full state syncs send every member again, most of them recorded.
+        existing = existing_event_ids(
+            MembershipUpdates,
+            [(row["room_id"], row["event_id"]) for row in memberships],
+        )
+        memberships = [
+            row
+            for row in memberships
+            if (row["room_id"], row["event_id"]) not in existing
+        ]
+        upsert_rows(
+            MembershipUpdates,
+            memberships,
+            [MembershipUpdates.room_id, MembershipUpdates.event_id],
+            [
+                MembershipUpdates.origin_server_ts,
+                MembershipUpdates.sender,
+                MembershipUpdates.state_key,
+                MembershipUpdates.avatar_url,
+                MembershipUpdates.prev_avatar_url,
+                MembershipUpdates.name,
+                MembershipUpdates.prev_name,
+                MembershipUpdates.date,
+                MembershipUpdates.datetime,
+            ],
+        )
+        upsert_rows(
+            MessageEdit,
+            edits,
+            [MessageEdit.room_id, MessageEdit.event_id],
+            [
+                MessageEdit.replaced_by,
+                MessageEdit.origin_server_ts,
+                MessageEdit.body,
+                MessageEdit.formatted_body,
+            ],
+            # Don't let a replayed older edit win
+            where=(MessageEdit.origin_server_ts < EXCLUDED.origin_server_ts),
+        )
+
+
+class MessageRecorder:
+    """Buffers message and membership rows and writes them in batches.
+
+    Buffered rows are flushed in one transaction when there are ``batch_size``
+    of them, or ``flush_interval`` seconds after the first one was buffered.
+    """
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Keyed by (room_id, event_id) so a replayed event is only written once.
+        self.messages: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.replacements: List[Tuple[str, str, str]] = []
+        self.memberships: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.edits: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.flush_timer: Optional[asyncio.TimerHandle] = None
+        self.flush_lock: Optional[asyncio.Lock] = None
+
+    def pending(self) -> int:
+        return (
+            len(self.messages)
+            + len(self.replacements)
+            + len(self.memberships)
+            + len(self.edits)
+        )
+
+    def record_message(
+        self,
+        room: MatrixRoom,
+        event: RoomMessageText,
+        event_replace: Optional[str] = None,
+        include_text: Optional[bool] = False,
+    ):
+        key = (room.room_id, event.event_id)
+        if key in seen_events:
+            return
+        row = MatrixMessage.make_row(room.room_id, event, event_replace, include_text)
+        self.messages[key] = row
+        if event_replace:
+            self.replacements.append((room.room_id, event_replace, event.event_id))
+        self._schedule_flush()
+
+    def record_membership(self, room: MatrixRoom, event: RoomMemberEvent):
+        self.record_memberships(room.room_id, [event])
+
+    def record_memberships(self, room_id: str, events: Iterable[RoomMemberEvent]):
+        """Record many membership events of a room, like the state of a sync.
+
+        Events the seen events filter knows are skipped. The others are looked
+        up when written, as the whole state is sent again after a restart.
+        """
+        for event in events:
+            if (room_id, event.event_id) in seen_events:
+                continue
+            row = MembershipUpdates.make_row(room_id, event)
+            self.memberships[(room_id, event.event_id)] = row
+        self._schedule_flush()
+
+    def record_edit(
+        self,
+        room_id: str,
+        event_id: str,
+        replaced_by: str,
+        origin_server_ts: int,
+        body: Optional[str] = None,
+        formatted_body: Optional[str] = None,
+    ):
+        """Record the latest replacement of the event ``event_id``."""
+        key = (room_id, event_id)
+        buffered = self.edits.get(key)
+        if buffered and buffered["origin_server_ts"] > origin_server_ts:
+            return
+        self.edits[key] = {
+            "room_id": room_id,
+            "event_id": event_id,
+            "replaced_by": replaced_by,
+            "origin_server_ts": origin_server_ts,
+            "body": body,
+            "formatted_body": formatted_body,
+        }
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.pending() >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        elif self.flush_timer is None:
+            self._start_flush_timer()
+
+    def _start_flush_timer(self):
+        loop = asyncio.get_running_loop()
+        self.flush_timer = loop.call_later(
+            self.flush_interval, lambda: asyncio.ensure_future(self.flush())
+        )
+
+    async def flush(self) -> bool:
+        """Write all buffered rows.
+
+        Returns:
+            Whether every row buffered before the call was written.
+        """
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        async with self.flush_lock:
+            if not self.pending():
+                return True
+            messages, self.messages = self.messages, {}
+            replacements, self.replacements = self.replacements, []
+            memberships, self.memberships = self.memberships, {}
+            edits, self.edits = self.edits, {}
+            try:
+                await run_db(
+                    write_recorded_rows,
+                    list(messages.values()),
+                    replacements,
+                    list(memberships.values()),
+                    list(edits.values()),
+                )
+            except Exception:
+                logger.exception("Failed to write recorded rows, will retry.")
+                # Put them back, keeping anything newer recorded in the meantime
+                self.messages = {**messages, **self.messages}
+                self.replacements = replacements + self.replacements
+                self.memberships = {**memberships, **self.memberships}
+                self.edits = {**edits, **self.edits}
+                if self.flush_timer is None:
+                    self._start_flush_timer()
+                return False
+            else:
+                seen_events.add_many(messages)
+                seen_events.add_many(memberships)
+                logger.debug(
+                    f"Recorded {len(messages)} messages, {len(replacements)} edits, "
+                    f"{len(memberships)} membership updates and "
+                    f"{len(edits)} edit index updates."
+                )
+                return True
+
+    async def close(self):
+        """Flush everything left."""
+        await self.flush()
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+            logger.error(f"Dropping {self.pending()} rows that couldn't be recorded.")
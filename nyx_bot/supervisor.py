@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Dict, Optional
+
+from nio import SyncResponse
+
+logger = logging.getLogger(__name__)
+
+# Delay before the first retry, doubled on every failure in a row
+INITIAL_DELAY_SECONDS = 1.0
+MAX_DELAY_SECONDS = 300.0
+
+
+class ReconnectBackoff:
+    """Waits between reconnect attempts with exponential backoff and jitter.
+
+    The delay grows with consecutive failures and goes back to the initial one
+    once a sync succeeds.
+    """
+
+    def __init__(
+        self,
+        initial_delay: float = INITIAL_DELAY_SECONDS,
+        max_delay: float = MAX_DELAY_SECONDS,
+    ):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        # Failures since the last successful sync
+        self.failures = 0
+        self.total_failures = 0
+        self.reconnects = 0
+        self.last_error: Optional[str] = None
+        self.connected_since: Optional[float] = None
+
+    def next_delay(self) -> float:
+        delay = min(self.max_delay, self.initial_delay * 2**self.failures)
+        # Keep at least half of the delay, randomize the rest so many clients
+        # don't retry in lockstep
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def wait(self, error: str):
+        """Record a failure and sleep before the next attempt."""
+        if self.connected_since is not None:
+            connected_for = time.monotonic() - self.connected_since
+            logger.warning(f"Connection lost after {connected_for:.0f}s.")
+        delay = self.next_delay()
+        self.failures += 1
+        self.total_failures += 1
+        self.last_error = error
+        self.connected_since = None
+        logger.warning(
+            f"{error}, retrying in {delay:.1f}s "
+            f"(attempt {self.failures}, {self.reconnects} reconnects so far)."
+        )
+        await asyncio.sleep(delay)
+
+    async def sync_succeeded(self, response: SyncResponse):
+        """Response callback resetting the backoff once syncing works again."""
+        if self.connected_since is None:
+            self.connected_since = time.monotonic()
+            if self.failures:
+                self.reconnects += 1
+                logger.info(
+                    f"Reconnected after {self.failures} failed attempts "
+                    f"({self.reconnects} reconnects and {self.total_failures} "
+                    f"failures since start, last error: {self.last_error})."
+                )
+            self.failures = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "last_error": self.last_error,
+            "connected_for": (
+                time.monotonic() - self.connected_since
+                if self.connected_since is not None
+                else None
+            ),
+        }
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from nio import (
+    AsyncClient,
+    Event,
+    MatrixRoom,
+    RoomEncryptionEvent,
+    RoomMemberEvent,
+    RoomSummary,
+    SyncResponse,
+)
+
+from nyx_bot.storage import MessageRecorder
+
+logger = logging.getLogger(__name__)
+
+# Minimum time between two saves of the sync state, in seconds
+SAVE_INTERVAL_SECONDS = 60.0
+
+STATE_VERSION = 1
+
+
+class SyncStateStore:
+    """Persists the sync token with the state of joined rooms.
+
+    The state events of each room are kept as received from sync, by type and
+    state key, so the MatrixRoom objects of the client can be rebuilt on startup
+    and syncing resumed from the saved token without a full initial sync.
+
+    A token is only saved once ``recorder`` has written everything received up
+    to it, so what wasn't recorded is synced again after a crash.
+    """
+
+    def __init__(self, client: AsyncClient, path: str, recorder: MessageRecorder):
+        self.client = client
+        self.path = path
+        self.recorder = recorder
+        self.next_batch: Optional[str] = None
+        # Room ID -> "type|state_key" -> event source
+        self.rooms: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.dirty = False
+        self.last_save: Optional[float] = None
+        self.save_task: Optional[asyncio.Task] = None
+
+    def restore(self) -> Optional[str]:
+        """Rebuild the rooms of the client from the saved state.
+
+        Returns:
+            The sync token to resume from, or None if there's no saved state.
+        """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.exception(f"Failed to read sync state from {self.path}.")
+            return None
+        if data.get("version") != STATE_VERSION:
+            return None
+
+        start = time.perf_counter()
+        summaries = data.get("summaries", {})
+        for room_id, state in data.get("rooms", {}).items():
+            room = MatrixRoom(room_id, self.client.user_id)
+            for source in state.values():
+                event = Event.parse_event(source)
+                if isinstance(event, RoomMemberEvent):
+                    room.handle_membership(event)
+                elif isinstance(event, Event):
+                    room.handle_event(event)
+                    if isinstance(event, RoomEncryptionEvent):
+                        self.client.encrypted_rooms.add(room_id)
+            summary = summaries.get(room_id)
+            if summary:
+                room.update_summary(RoomSummary(*summary))
+            self.client.rooms[room_id] = room
+        self.rooms = data.get("rooms", {})
+        self.next_batch = data["next_batch"]
+        self.client.next_batch = self.next_batch
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Restored {len(self.rooms)} rooms from sync state in {elapsed:.3f}s."
+        )
+        return self.next_batch
+
+    def reset(self):
+        """Forget the saved state, when the server rejected its sync token."""
+        self.next_batch = None
+        self.rooms = {}
+        self.client.rooms.clear()
+        self.client.next_batch = ""
+        self.dirty = True
+
+    async def handle_sync(self, response: SyncResponse):
+        """Update the state from a sync response, saving it now and then."""
+        for room_id, info in response.rooms.join.items():
+            state = self.rooms.setdefault(room_id, {})
+            for event in (*info.state, *info.timeline.events):
+                source = getattr(event, "source", None)
+                if not source or "state_key" not in source:
+                    continue
+                state[f"{source['type']}|{source['state_key']}"] = source
+        for room_id in response.rooms.leave:
+            self.rooms.pop(room_id, None)
+        self.next_batch = response.next_batch
+        self.dirty = True
+
+        now = time.monotonic()
+        if (self.save_task is None or self.save_task.done()) and (
+            self.last_save is None or now - self.last_save >= SAVE_INTERVAL_SECONDS
+        ):
+            self.save_task = asyncio.ensure_future(self._save())
+
+    async def save(self):
+        """Write the latest state, after a save that is still running."""
+        if self.save_task is not None:
+            await self.save_task
+        await self._save()
+
+    async def _save(self):
+        if not self.dirty or self.next_batch is None:
+            return
+        self.dirty = False
+        self.last_save = time.monotonic()
+        summaries = {}
+        for room_id in self.rooms:
+            room = self.client.rooms.get(room_id)
+            if room is not None and room.summary is not None:
+                summary = room.summary
+                summaries[room_id] = [
+                    summary.invited_member_count,
+                    summary.joined_member_count,
+                    summary.heroes,
+                ]
+        data = {
+            "version": STATE_VERSION,
+            "next_batch": self.next_batch,
+            # Event sources aren't changed after being received, copying the
+            # mappings is enough to write them in another thread
+            "rooms": {room_id: dict(state) for room_id, state in self.rooms.items()},
+            "summaries": summaries,
+        }
+        # Messages up to the token were buffered before its sync callbacks ran
+        if not await self.recorder.flush():
+            logger.warning("Not saving sync state until recorded rows are written.")
+            self.dirty = True
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, data)
+        except Exception:
+            logger.exception(f"Failed to save sync state to {self.path}.")
+            self.dirty = True
+
+    def _write(self, data: Dict[str, Any]):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
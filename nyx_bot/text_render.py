@@ -0,0 +1,167 @@
+import logging
+import os
+import subprocess
+import sys
+from tempfile import mkstemp
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+from nyx_bot.errors import NyxBotRuntimeError
+
+if TYPE_CHECKING:
+    from wand.image import Image
+
+logger = logging.getLogger(__name__)
+
+FONT = "Sarasa Gothic SC 16"
+BACKGROUND = "#C0E5F5"
+# Lines are wrapped at this width in points, like pango-view's --width
+WRAP_WIDTH = 500
+DPI = 96
+
+
+class RenderedText(NamedTuple):
+    """Text rendered on the quote background."""
+
+    blob: bytes
+    # "bgra" for raw pixels, "png" from pango-view
+    format: str
+    width: int
+    height: int
+
+    def to_image(self) -> "Image":
+        from wand.image import Image
+
+        if self.format == "png":
+            return Image(blob=self.blob, format="png")
+        return Image(
+            blob=self.blob,
+            format=self.format,
+            width=self.width,
+            height=self.height,
+            depth=8,
+        )
+
+
+class PangoRenderer:
+    """Renders Pango markup in process with PangoCairo.
+
+    The font map and context are kept, so fontconfig and the fonts are only
+    loaded once. Not thread safe, each render process has its own.
+
+    Raises:
+        ImportError: If PyGObject or pycairo isn't installed.
+    """
+
+    def __init__(self):
+        import cairo
+        import gi
+
+        gi.require_version("Pango", "1.0")
+        gi.require_version("PangoCairo", "1.0")
+        from gi.repository import GLib, Pango, PangoCairo
+
+        self.cairo = cairo
+        self.GLib = GLib
+        self.Pango = Pango
+        self.PangoCairo = PangoCairo
+        self.context = PangoCairo.FontMap.get_default().create_context()
+        options = cairo.FontOptions()
+        options.set_antialias(cairo.ANTIALIAS_GRAY)
+        options.set_hint_style(cairo.HINT_STYLE_FULL)
+        PangoCairo.context_set_font_options(self.context, options)
+        PangoCairo.context_set_resolution(self.context, DPI)
+        self.font = Pango.FontDescription.from_string(FONT)
+        background = BACKGROUND.lstrip("#")
+        self.background = tuple(
+            int(background[i : i + 2], 16) / 255 for i in range(0, 6, 2)
+        )
+        # cairo's ARGB32 is in native byte order
+        self.format = "bgra" if sys.byteorder == "little" else "argb"
+
+    def render(self, markup: str) -> RenderedText:
+        Pango = self.Pango
+        PangoCairo = self.PangoCairo
+        try:
+            Pango.parse_markup(markup, -1, "\0")
+        except self.GLib.Error as e:
+            raise NyxBotRuntimeError(f"Failed to render text: {e.message}")
+        layout = Pango.Layout.new(self.context)
+        layout.set_font_description(self.font)
+        layout.set_width(int(WRAP_WIDTH * DPI / 72 * Pango.SCALE))
+        layout.set_wrap(Pango.WrapMode.WORD_CHAR)
+        layout.set_markup(markup, -1)
+        _, logical = layout.get_pixel_extents()
+        width = max(1, logical.width)
+        height = max(1, logical.height)
+
+        surface = self.cairo.ImageSurface(self.cairo.FORMAT_ARGB32, width, height)
+        cr = self.cairo.Context(surface)
+        cr.set_source_rgb(*self.background)
+        cr.paint()
+        cr.set_source_rgb(0, 0, 0)
+        cr.move_to(-logical.x, -logical.y)
+        PangoCairo.show_layout(cr, layout)
+        surface.flush()
+        return RenderedText(bytes(surface.get_data()), self.format, width, height)
+
+
+_renderer: Optional[PangoRenderer] = None
+# False once PangoCairo turned out to be missing
+_in_process = True
+
+
+def get_renderer() -> Optional[PangoRenderer]:
+    """Get this process's renderer, None if PangoCairo isn't available."""
+    global _renderer, _in_process
+    if _renderer is None and _in_process:
+        try:
+            _renderer = PangoRenderer()
+        except (ImportError, ValueError) as e:
+            _in_process = False
+            logger.warning(f"PangoCairo is unavailable ({e}), using pango-view.")
+    return _renderer
+
+
+def render_text(text: str) -> RenderedText:
+    """Render Pango markup, in process if possible."""
+    renderer = get_renderer()
+    if renderer is not None:
+        return renderer.render(text)
+    return render_text_pango_view(text)
+
+
+def render_text_pango_view(text: str) -> RenderedText:
+    fd, path = mkstemp(".png")
+    os.close(fd)
+    logger.debug(f"File path: {path}")
+    try:
+        proc = subprocess.run(
+            [
+                "pango-view",
+                f"--background={BACKGROUND}",
+                "--foreground=black",
+                f"--font={FONT}",
+                "--antialias=gray",
+                "--margin=0",
+                "--hinting=full",
+                "--markup",
+                f"--width={WRAP_WIDTH}",
+                f"--dpi={DPI}",
+                "--wrap=word-char",
+                "-q",
+                "-o",
+                path,
+                f"--text={text}",
+            ],
+            input=text.encode("utf-8"),
+            capture_output=True,
+        )
+        if proc.stdout:
+            logger.debug(f"pango-view stdout: {proc.stdout.decode(errors='replace')}")
+        if proc.stderr:
+            logger.debug(f"pango-view stderr: {proc.stderr.decode(errors='replace')}")
+        with open(path, "rb") as f:
+            blob = f.read()
+    finally:
+        os.remove(path)
+    return RenderedText(blob, "png", 0, 0)
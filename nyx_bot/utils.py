@@ -4,13 +4,14 @@ from datetime import datetime
 from html.parser import HTMLParser
 from io import StringIO
 from random import Random
-from typing import Dict, Optional, Tuple
+from typing import Optional, Tuple
 from urllib.parse import parse_qs, unquote, urlparse
 
 import xxhash
-from nio import AsyncClient, Event, MatrixRoom, RoomGetEventError, RoomMessageText
+from nio import AsyncClient, Event, MatrixRoom, RoomMessageText
 
 from nyx_bot.errors import NyxBotRuntimeError
+from nyx_bot.event_cache import fetch_event
 
 
 def user_name(room: MatrixRoom, user_id: str) -> Optional[str]:
@@ -22,51 +23,44 @@ def user_name(room: MatrixRoom, user_id: str) -> Optional[str]:
 
 
 async def get_body(
-    client: AsyncClient, room_id: str, event_id: str, replace_map: Optional[str] = None
+    client: AsyncClient, room_id: str, event_id: str, edit_index=None
 ) -> str:
-    if replace_map is None:
-        replace_map = {}
-    if event_id not in replace_map:
-        target_response = await client.room_get_event(room_id, event_id)
-        if isinstance(target_response, RoomGetEventError):
-            error = target_response.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        target_event = target_response.event
+    edit = None
+    if edit_index is not None:
+        edit = await edit_index.resolve(room_id, event_id)
+    if edit is None:
+        target_event = await fetch_event(client, room_id, event_id)
         return target_event.body
+    elif edit.has_content:
+        return edit.body
     else:
-        new_evid = replace_map.get(event_id)
-        target_response = await client.room_get_event(room_id, new_evid)
-        if isinstance(target_response, RoomGetEventError):
-            error = target_response.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        target_event = target_response.event
-        content = target_event.source.get("content")
-        new_content = content.get("m.new_content")
+        new_content = await get_new_content(client, room_id, edit.replaced_by)
         return new_content.get("body")
 
 
 async def get_formatted_body(
-    client: AsyncClient, room: MatrixRoom, event_id: str, replace_map: Dict[str, str]
+    client: AsyncClient, room: MatrixRoom, event_id: str, edit_index=None
 ) -> Optional[str]:
-    if event_id not in replace_map:
-        target_response = await client.room_get_event(room.room_id, event_id)
-        if isinstance(target_response, RoomGetEventError):
-            error = target_response.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        target_event = target_response.event
+    edit = None
+    if edit_index is not None:
+        edit = await edit_index.resolve(room.room_id, event_id)
+    if edit is None:
+        target_event = await fetch_event(client, room.room_id, event_id)
         return target_event.formatted_body
+    elif edit.has_content:
+        return edit.formatted_body
     else:
-        new_evid = replace_map.get(event_id)
-        target_response = await client.room_get_event(room.room_id, new_evid)
-        if isinstance(target_response, RoomGetEventError):
-            error = target_response.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        target_event = target_response.event
-        content = target_event.source.get("content")
-        new_content = content.get("m.new_content")
+        new_content = await get_new_content(client, room.room_id, edit.replaced_by)
         return new_content.get("formatted_body")
 
 
+async def get_new_content(client: AsyncClient, room_id: str, event_id: str) -> dict:
+    """Fetch a replacement event and return its new content."""
+    target_event = await fetch_event(client, room_id, event_id)
+    content = target_event.source.get("content")
+    return content.get("m.new_content")
+
+
 def strip_beginning_quote(original: str) -> str:
     if original.startswith(">"):
         count = 0
@@ -208,11 +202,8 @@ async def parse_wordcloud_args(
     if not reply_to:
         sender = event.sender
     else:
-        target_event = await client.room_get_event(room.room_id, reply_to)
-        if isinstance(target_event, RoomGetEventError):
-            error = target_event.message
-            raise NyxBotRuntimeError(f"Failed to fetch event: {error}")
-        sender = target_event.event.sender
+        target_event = await fetch_event(client, room.room_id, reply_to)
+        sender = target_event.sender
     if args:
         if args[0] == "all":
             sender = None
@@ -257,6 +248,16 @@ def should_enable_join_confirm(room_features, room_id: str) -> bool:
     return room_features[room_id]["join_confirm"]
 
 
+def get_rate_limits(room_features, room_id: str) -> Tuple[float, float, float, float]:
+    features = room_features[room_id]
+    return (
+        features["room_commands_per_minute"],
+        features["room_command_burst"],
+        features["user_commands_per_minute"],
+        features["user_command_burst"],
+    )
+
+
 # A structure for a Matrix UID. It also supports legacy UID formats.
 # First part: [\!-9\;-\~]+
 # Matches legacy UIDs too.
@@ -278,5 +279,5 @@ REACTIONS = ["🎉", "🤣", "😃", "😋", "🥳", "🤔", "😅"]
 
 
 def hash_user_id(user_id: str):
-    hash = xxhash.xxh64_intdigest(user_id)
+    hash = xxhash.xxh64_intdigest(user_id.encode())
     return REACTIONS[hash % len(REACTIONS)]
@@ -7,15 +7,13 @@ from asyncio import create_subprocess_exec
 from asyncio.subprocess import PIPE
 from datetime import datetime, timedelta, timezone
 from io import BytesIO, StringIO
-from typing import Optional
+from typing import List, Optional
 
 from nio import AsyncClient, MatrixRoom, RoomMessageText, UploadResponse
-from wand.image import Image
-from wordcloud import WordCloud
 
 import nyx_bot
 from nyx_bot.chat_functions import send_text_to_room
-from nyx_bot.storage import MatrixMessage
+from nyx_bot.storage import MatrixMessage, run_db
 from nyx_bot.utils import strip_tags
 
 CUTWORDS_EXE = "nyx_bot-cutword"
@@ -51,6 +49,8 @@ async def get_word_freqs(texts):
 
 
 def make_image(freqs, bytesio):
+    from wordcloud import WordCloud
+
     image = (
         WordCloud(
             font_path=FONT,
@@ -82,7 +82,7 @@ async def send_wordcloud(
         end_date = start_date - timedelta(days=days)
     texts = MessageIter(room, event.server_timestamp, sender, end_date)
 
-    freqs = await get_word_freqs(texts)
+    freqs = await get_word_freqs(await texts.collect())
     st3 = time.time()
     logger.info("Analyzed message using %.3f seconds", st3 - st2)
 
@@ -110,6 +110,8 @@ async def send_wordcloud(
     length = bytesio.getbuffer().nbytes
     bytesio.seek(0)
 
+    from wand.image import Image
+
     image = Image(file=bytesio)
     (width, height) = (image.width, image.height)
 
@@ -184,37 +186,37 @@ class MessageIter:
         self.count = 0
         self.last_ts = base_ts
 
-    def batches(self, limit: int):
-        """Return a iterator for query pagination."""
+    def read_batch(self, limit: int) -> List[str]:
+        """Read and process the next batch of messages. This blocks on the database."""
+        msg_items = MatrixMessage.select().where(
+            (MatrixMessage.room_id == self.room.room_id)
+            & (MatrixMessage.origin_server_ts < self.last_ts)
+        )
+        if self.sender is not None:
+            msg_items = msg_items.where(MatrixMessage.sender == self.sender)
+        if self.end_date is not None:
+            msg_items = msg_items.where(MatrixMessage.datetime >= self.end_date)
+        msg_items = list(
+            msg_items.order_by(MatrixMessage.origin_server_ts.desc()).limit(limit)
+        )
+        if len(msg_items) < limit:
+            self.done = True
+        strings = []
+        for msg_item in msg_items:
+            self.last_ts = msg_item.origin_server_ts
+            if msg_item.sender in DROP_USERS:  # XXX: Special case for Arch Linux CN
+                continue
+            self.count += 1
+            strings.append(process_message(msg_item))
+            self.users.add(msg_item.sender)
+        return strings
+
+    async def collect(self) -> List[str]:
+        """Read all matching messages, paginating on the database threads."""
+        texts = []
         while not self.done:
-            msg_items = MatrixMessage.select().where(
-                (MatrixMessage.room_id == self.room.room_id)
-                & (MatrixMessage.origin_server_ts < self.last_ts)
-            )
-            if self.sender is not None:
-                msg_items = msg_items.where(MatrixMessage.sender == self.sender)
-            if self.end_date is not None:
-                msg_items = msg_items.where(MatrixMessage.datetime >= self.end_date)
-            msg_items = msg_items.order_by(MatrixMessage.origin_server_ts.desc()).limit(
-                limit
-            )
-            count = msg_items.count()
-            if count == 0:
-                return
-            elif count < limit:
-                self.done = True
-            yield msg_items
-
-    def __iter__(self):
-        for msg_items in self.batches(self.LIMIT):
-            for msg_item in msg_items:
-                if msg_item.sender in DROP_USERS:  # XXX: Special case for Arch Linux CN
-                    continue
-                self.count += 1
-                string = process_message(msg_item)
-                self.users.add(msg_item.sender)
-                self.last_ts = msg_item.origin_server_ts
-                yield string
+            texts.extend(await run_db(self.read_batch, self.LIMIT))
+        return texts
 
 
 def process_message(msg_item):
@@ -0,0 +1,89 @@
+import os.path
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+from nio import DownloadError, ThumbnailError
+
+from nyx_bot.avatar_cache import AvatarCache
+from nyx_bot.errors import NyxBotRuntimeError
+
+
+class AvatarCacheTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "avatars")
+        self.client = Mock()
+        self.client.thumbnail = AsyncMock(return_value=Mock(body=b"thumbnail"))
+        self.client.download = AsyncMock(return_value=Mock(body=b"avatar"))
+        patcher = patch(
+            "nyx_bot.avatar_cache.run_render", AsyncMock(return_value=b"tile")
+        )
+        self.run_render = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def test_cached(self):
+        """Test that a tile is drawn once and kept in memory and on disk"""
+        cache = AvatarCache()
+        cache.configure(self.path, 10, 10)
+        self.assertEqual(await cache.get(self.client, "mxc://a/1"), b"tile")
+        self.assertEqual(await cache.get(self.client, "mxc://a/1"), b"tile")
+        self.client.thumbnail.assert_awaited_once()
+        self.assertEqual(self.client.thumbnail.await_args.args[:4], ("a", "1", 96, 96))
+        self.client.download.assert_not_awaited()
+        self.assertEqual(self.run_render.await_args.args[1], b"thumbnail")
+
+        # Read from disk after a restart
+        cache = AvatarCache()
+        cache.configure(self.path, 10, 10)
+        self.assertEqual(await cache.get(self.client, "mxc://a/1"), b"tile")
+        self.assertEqual(self.client.thumbnail.await_count, 1)
+
+        cache.invalidate("mxc://a/1")
+        await cache.get(self.client, "mxc://a/1")
+        self.assertEqual(self.client.thumbnail.await_count, 2)
+
+    async def test_thumbnail_fallback(self):
+        """Test that the avatar is downloaded if there is no thumbnail"""
+        self.client.thumbnail.return_value = ThumbnailError("nope")
+        cache = AvatarCache()
+        cache.configure(self.path, 10, 10)
+        await cache.get(self.client, "mxc://a/1")
+        self.client.download.assert_awaited_once_with(mxc="mxc://a/1")
+        self.assertEqual(self.run_render.await_args.args[1], b"avatar")
+
+    async def test_download_error(self):
+        """Test that failed downloads aren't cached"""
+        self.client.thumbnail.return_value = ThumbnailError("nope")
+        self.client.download.return_value = DownloadError("nope")
+        cache = AvatarCache()
+        cache.configure(self.path, 10, 10)
+        with self.assertRaises(NyxBotRuntimeError):
+            await cache.get(self.client, "mxc://a/1")
+        self.assertEqual(os.listdir(self.path), [])
+
+    async def test_disk_eviction(self):
+        """Test that the least recently used files are removed"""
+        cache = AvatarCache()
+        cache.configure(self.path, 1, 2)
+        await cache.get(self.client, "mxc://a/1")
+        await cache.get(self.client, "mxc://a/2")
+        # Read from disk, as only the last one is kept in memory
+        await cache.get(self.client, "mxc://a/1")
+        await cache.get(self.client, "mxc://a/3")
+        self.assertEqual(len(os.listdir(self.path)), 2)
+        self.assertNotIn(cache._file("mxc://a/2"), cache.files)
+        self.assertFalse(os.path.exists(cache._file("mxc://a/2")))
+        self.assertEqual(self.client.thumbnail.await_count, 3)
+
+        # Lowering the limit removes files on the next start
+        cache = AvatarCache()
+        cache.configure(self.path, 1, 1)
+        self.assertEqual(len(os.listdir(self.path)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import asyncio
+import os.path
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+from nio import RoomMessagesResponse, RoomMessageText
+from peewee import SqliteDatabase
+
+from nyx_bot.backfill import Backfiller
+from nyx_bot.callbacks import RoomDispatcher
+from nyx_bot.seen_events import seen_events
+from nyx_bot.storage import BackfillGap
+
+
+def make_message(event_id):
+    return RoomMessageText.from_dict(
+        {
+            "event_id": event_id,
+            "sender": "@alice:example.com",
+            "origin_server_ts": 1700000000000,
+            "type": "m.room.message",
+            "content": {"msgtype": "m.text", "body": event_id},
+        }
+    )
+
+
+def make_sync(next_batch, limited):
+    response = Mock()
+    response.next_batch = next_batch
+    info = Mock()
+    info.timeline.limited = limited
+    info.timeline.prev_batch = f"prev-{next_batch}"
+    response.rooms.join = {"!room": info}
+    return response
+
+
+class BackfillerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = SqliteDatabase(os.path.join(self.tmpdir.name, "test.db"))
+        self.db.bind([BackfillGap])
+        self.db.create_tables([BackfillGap])
+        seen_events.configure(1000, 0.0001)
+        self.client = Mock()
+        self.client.rooms = {"!room": Mock()}
+        self.pages = {
+            "prev-s3": RoomMessagesResponse(
+                "!room", [make_message("$3"), make_message("$2")], "prev-s3", "t1"
+            ),
+            "t1": RoomMessagesResponse("!room", [make_message("$1")], "t1", "t2"),
+            "t2": RoomMessagesResponse("!room", [], "t2", None),
+        }
+        self.client.room_messages = AsyncMock(
+            side_effect=lambda room_id, start, *args, **kwargs: self.pages[start]
+        )
+        self.recorded = []
+        self.backfiller = Backfiller(
+            self.client,
+            lambda room, event: self.recorded.append(event.event_id),
+            RoomDispatcher(1),
+        )
+
+    async def asyncTearDown(self):
+        await self.backfiller.close()
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    async def wait_filled(self):
+        # Gaps are queued once written to the database
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if self.backfiller.queue is not None:
+                await self.backfiller.queue.join()
+                return
+
+    async def test_fill_gap(self):
+        """Test that a limited sync is backfilled up to the previous token"""
+        # Nothing is missing after the first sync
+        self.backfiller.handle_sync(make_sync("s1", True))
+        self.backfiller.handle_sync(make_sync("s2", False))
+        self.backfiller.handle_sync(make_sync("s3", True))
+        await self.wait_filled()
+
+        self.assertEqual(self.recorded, ["$3", "$2", "$1"])
+        self.assertEqual(self.client.room_messages.await_count, 3)
+        # Paginated until the sync token before the gap
+        self.assertEqual(self.client.room_messages.await_args.args[2], "s2")
+        self.assertEqual(BackfillGap.select().count(), 0)
+
+    async def test_resume(self):
+        """Test that a gap continues from its checkpoint after a restart"""
+        BackfillGap.insert(room_id="!room", start="t1", end="s2", pages=1).execute()
+        await self.backfiller.load()
+        await self.wait_filled()
+
+        self.assertEqual(self.recorded, ["$1"])
+        self.assertEqual(BackfillGap.select().count(), 0)
+
+    async def test_stop_at_recorded(self):
+        """Test that backfilling stops at messages recorded before"""
+        seen_events.add("!room", "$3")
+        seen_events.add("!room", "$2")
+        self.backfiller.since = "s2"
+        self.backfiller.handle_sync(make_sync("s3", True))
+        await self.wait_filled()
+
+        self.assertEqual(self.client.room_messages.await_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+import nio
+
+from nyx_bot.bot_commands import COMMANDS, Command, CommandCost
+from nyx_bot.errors import NyxBotValueError
+
+
+class CommandTestCase(unittest.IsolatedAsyncioTestCase):
+    def make_command(self, text, reply_to=None):
+        client = Mock(spec=nio.AsyncClient)
+        room = nio.MatrixRoom("!room:example.com", "@fake_user:example.com")
+        event = Mock(spec=nio.RoomMessageText)
+        event.event_id = "$command"
+        event.server_timestamp = 0
+        return Command(
+            client, Mock(), text, room, event, reply_to, Mock(), "!", Mock(), Mock()
+        )
+
+    def test_registry(self):
+        """Test that commands carry their metadata"""
+        self.assertEqual(COMMANDS["ping"].cost, CommandCost.CHEAP)
+        self.assertEqual(COMMANDS["wordcloud"].cost, CommandCost.RENDER)
+        self.assertTrue(COMMANDS["quote"].needs_reply)
+        self.assertEqual(COMMANDS["multiquote"].kwargs, {"forward": False})
+        self.assertEqual(COMMANDS["forward_multiquote"].kwargs, {"forward": True})
+
+    async def test_needs_reply(self):
+        """Test that a command needing a reply fails before running"""
+        command = self.make_command("quote")
+        with self.assertRaisesRegex(NyxBotValueError, "reply"):
+            await command._process()
+
+    async def test_dispatch_timing(self):
+        """Test that commands are dispatched through the registry and timed"""
+        command = self.make_command("room_id")
+        spec = COMMANDS["room_id"]
+        calls = spec.calls
+        with patch("nyx_bot.bot_commands.send_text_to_room", AsyncMock()) as send:
+            await command._process()
+        send.assert_awaited_once()
+        self.assertEqual(spec.calls, calls + 1)
+
+    async def test_unknown(self):
+        command = self.make_command("no_such_command")
+        self.assertIsNone(command.spec)
+        with patch("nyx_bot.bot_commands.send_text_to_room", AsyncMock()) as send:
+            await command._process()
+        self.assertIn("Unknown command", send.await_args.args[2])
+
+    async def test_slow_mode(self):
+        """Test that moderators can turn slow mode on and off"""
+        for text, enabled in (("slow", True), ("slow_disable", False)):
+            command = self.make_command(text)
+            command.event.sender = "@mod:example.com"
+            command.room.power_levels.users["@mod:example.com"] = 50
+            with patch("nyx_bot.bot_commands.send_text_to_room", AsyncMock()):
+                await command._process()
+            command.rate_limiter.set_slow.assert_called_once_with(
+                "!room:example.com", enabled
+            )
@@ -0,0 +1,136 @@
+import os.path
+import tempfile
+import unittest
+
+from nio import RoomMessageText
+from peewee import SqliteDatabase
+
+from nyx_bot.cache import EditIndex, LRUCache
+from nyx_bot.event_cache import EVENT_OVERHEAD, EventCache, RoomTimeline
+from nyx_bot.storage import (
+    MatrixMessage,
+    MembershipUpdates,
+    MessageEdit,
+    MessageRecorder,
+)
+
+MODELS = [MatrixMessage, MembershipUpdates, MessageEdit]
+
+
+def make_edit(event_id, original, body, ts):
+    return RoomMessageText.from_dict(
+        {
+            "event_id": event_id,
+            "sender": "@alice:example.com",
+            "origin_server_ts": ts,
+            "type": "m.room.message",
+            "content": {
+                "msgtype": "m.text",
+                "body": f"* {body}",
+                "m.new_content": {"msgtype": "m.text", "body": body},
+                "m.relates_to": {"rel_type": "m.replace", "event_id": original},
+            },
+        }
+    )
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        # Using "a" makes "b" the least recently used
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertNotIn("b", cache)
+        self.assertEqual(len(cache), 2)
+
+
+class EventCacheTestCase(unittest.TestCase):
+    def test_size_bound(self):
+        """Test that events are evicted once the size limit is reached"""
+        cache = EventCache(max_bytes=3 * EVENT_OVERHEAD + 10)
+        for i in range(3):
+            cache.put("!room", make_edit(f"${i}", "$0", "", 1000))
+        self.assertIsNotNone(cache.get("!room", "$0"))
+        # $1 is now the least recently used, and a larger event needs more space
+        cache.put("!room", make_edit("$3", "$0", "x" * 100, 1000))
+        self.assertIsNone(cache.get("!room", "$1"))
+        self.assertIsNotNone(cache.get("!room", "$0"))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        cache.pop("!room", "$0")
+        self.assertIsNone(cache.get("!room", "$0"))
+
+
+class RoomTimelineTestCase(unittest.TestCase):
+    def test_neighbours(self):
+        """Test that the timeline is bounded and walks in both directions"""
+        timeline = RoomTimeline(size=3)
+        for i in range(4):
+            timeline.append("!room", make_edit(f"${i}", "$0", "", 1000))
+        # $0 fell out of the buffer
+        self.assertIsNone(timeline.get("!room", "$0"))
+        self.assertIsNone(timeline.neighbours("!room", "$0", True))
+        after = timeline.neighbours("!room", "$1", True)
+        self.assertEqual([ev.event_id for ev in after], ["$2", "$3"])
+        before = timeline.neighbours("!room", "$3", False)
+        self.assertEqual([ev.event_id for ev in before], ["$2", "$1"])
+        self.assertEqual(timeline.neighbours("!room", "$1", False), [])
+        timeline.remove("!room", "$2")
+        after = timeline.neighbours("!room", "$1", True)
+        self.assertEqual([ev.event_id for ev in after], ["$3"])
+
+    def test_reset(self):
+        """Test that messages before a gap aren't neighbours of later ones"""
+        timeline = RoomTimeline(size=3)
+        timeline.append("!room", make_edit("$1", "$0", "", 1000))
+        timeline.append("!room", make_edit("$2", "$0", "", 1000))
+        timeline.reset("!room", [make_edit("$5", "$0", "", 1000)])
+        self.assertIsNone(timeline.neighbours("!room", "$2", True))
+        self.assertEqual(timeline.neighbours("!room", "$5", False), [])
+
+
+class EditIndexTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = SqliteDatabase(os.path.join(self.tmpdir.name, "test.db"))
+        self.db.bind(MODELS)
+        self.db.create_tables(MODELS)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    async def test_resolve(self):
+        """Test that the latest edit is resolved, from memory or the database"""
+        recorder = MessageRecorder(flush_interval=60)
+        edits = EditIndex(recorder)
+        edits.record("!room", "$1", make_edit("$3", "$1", "second", 2000), True)
+        # An older edit arriving late is ignored
+        edits.record("!room", "$1", make_edit("$2", "$1", "first", 1000), True)
+        edit = await edits.resolve("!room", "$1")
+        self.assertEqual(edit.replaced_by, "$3")
+        self.assertEqual(edit.body, "second")
+        self.assertIsNone(await edits.resolve("!room", "$4"))
+
+        await recorder.close()
+        edit = await EditIndex(recorder).resolve("!room", "$1")
+        self.assertEqual(edit.replaced_by, "$3")
+        self.assertTrue(edit.has_content)
+        self.assertEqual(edit.body, "second")
+
+    async def test_content_not_recorded(self):
+        """Test that content isn't stored unless allowed"""
+        recorder = MessageRecorder(flush_interval=60)
+        EditIndex(recorder).record(
+            "!room", "$1", make_edit("$2", "$1", "secret", 1000), False
+        )
+        await recorder.close()
+        edit = await EditIndex(recorder).resolve("!room", "$1")
+        self.assertEqual(edit.replaced_by, "$2")
+        self.assertFalse(edit.has_content)
+        self.assertIsNone(MessageEdit.get().body)
+
+
+if __name__ == "__main__":
+    unittest.main()
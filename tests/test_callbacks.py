@@ -1,9 +1,18 @@
+import asyncio
 import unittest
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock, patch
 
 import nio
 
-from nyx_bot.callbacks import Callbacks
+from nyx_bot.callbacks import (
+    STATS_INTERVAL_SECONDS,
+    Callbacks,
+    HeavyLane,
+    RoomDispatcher,
+)
+from nyx_bot.event_cache import room_timeline
+from nyx_bot.join_confirm import Pending
+from nyx_bot.utils import hash_user_id
 
 
 class CallbacksTestCase(unittest.TestCase):
@@ -17,6 +26,228 @@ class CallbacksTestCase(unittest.TestCase):
 
         self.callbacks = Callbacks(self.fake_client, self.fake_config)
 
+    def test_limited_sync_resets_timeline(self):
+        """Test that a gap in a room's timeline resets its recent messages"""
+        old = Mock(spec=nio.RoomMessageText, event_id="$old")
+        new = Mock(spec=nio.RoomMessageText, event_id="$new")
+        redacted = Mock(spec=nio.RoomMessageText, event_id="$redacted")
+        redaction = Mock(spec=nio.RedactionEvent, redacts="$redacted")
+        room_timeline.reset("!room:example.com", [old])
+        self.addCleanup(room_timeline.rooms.pop, "!room:example.com", None)
+        info = Mock(state=[])
+        info.timeline.limited = True
+        info.timeline.events = [redacted, new, redaction]
+        response = Mock()
+        response.rooms.join = {"!room:example.com": info}
+        self.callbacks.power_levels = Mock()
+        self.callbacks.backfiller = Mock()
+
+        asyncio.run(self.callbacks.sync(response))
+
+        self.assertIsNone(room_timeline.get("!room:example.com", "$old"))
+        self.assertIsNone(room_timeline.get("!room:example.com", "$redacted"))
+        self.assertIs(room_timeline.get("!room:example.com", "$new"), new)
+
+    def test_stats_logged(self):
+        """Test that the queue statistics are logged periodically"""
+        with patch.object(self.callbacks, "log_stats") as log_stats:
+            self.callbacks._maybe_log_stats()
+            log_stats.assert_not_called()
+        self.callbacks.stats_logged_at -= STATS_INTERVAL_SECONDS
+        command_stats = {"ping": (2, 0.01, 0.015), "quote": (1, 0.5, 0.5)}
+        with self.assertLogs("nyx_bot.callbacks", "INFO") as logs, patch(
+            "nyx_bot.callbacks.get_command_stats", return_value=command_stats
+        ):
+            self.callbacks._maybe_log_stats()
+        self.assertIn("Room queues: 0 jobs waiting", logs.output[0])
+        self.assertIn(
+            "Commands: quote 1 calls, 0.500s avg, 0.500s max, ping 2 calls",
+            logs.output[1],
+        )
+
+
+class JoinReactionTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        client = Mock(spec=nio.AsyncClient)
+        client.user = "@fake_user:example.com"
+        config = Mock()
+        config.dispatcher_workers = 2
+        self.callbacks = Callbacks(client, config)
+        self.callbacks.join_confirm = Mock()
+        self.callbacks.pending_confirmations = Mock()
+        self.callbacks.pending_confirmations.remove = AsyncMock()
+        self.room = nio.MatrixRoom("!room:example.com", "@fake_user:example.com")
+        self.event = Mock(spec=nio.UnknownEvent)
+        self.event.sender = "@new:example.com"
+        self.event.source = {"content": {"m.relates_to": {"key": "X"}}}
+
+    async def asyncTearDown(self):
+        await self.callbacks.dispatcher.close()
+
+    async def react(self, written: bool):
+        released = asyncio.get_running_loop().create_future()
+        self.callbacks.join_confirm.release.return_value = released
+        await self.callbacks._reaction(
+            self.room, self.event, "$notice", Pending("@new:example.com", "X")
+        )
+        # Nothing is forgotten before the power levels are written
+        self.callbacks.pending_confirmations.remove.assert_not_awaited()
+        released.set_result(written)
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def test_released(self):
+        """Test that the confirmation is removed once the user is released"""
+        await self.react(True)
+        self.callbacks.pending_confirmations.remove.assert_awaited_once_with(
+            "!room:example.com", "$notice"
+        )
+
+    async def test_unrecorded_notice(self):
+        """Test that notices sent before they were recorded are still handled"""
+        notice = Mock(spec=nio.RoomMessageText)
+        notice.source = {
+            "content": {
+                "io.github.shadowrz.nyx_bot": {
+                    "type": "join_confirm",
+                    "state_key": "@new:example.com",
+                }
+            }
+        }
+        reaction = hash_user_id("@new:example.com")
+        self.event.type = "m.reaction"
+        self.event.source = {
+            "content": {
+                "m.relates_to": {
+                    "rel_type": "m.annotation",
+                    "event_id": "$notice",
+                    "key": reaction,
+                }
+            }
+        }
+        self.callbacks.pending_confirmations.get.return_value = None
+        released = asyncio.get_running_loop().create_future()
+        released.set_result(True)
+        self.callbacks.join_confirm.release.return_value = released
+        with patch(
+            "nyx_bot.callbacks.should_enable_join_confirm", return_value=True
+        ), patch(
+            "nyx_bot.callbacks.fetch_event", AsyncMock(return_value=notice)
+        ) as fetch:
+            await self.callbacks.unknown(self.room, self.event)
+            for _ in range(5):
+                await asyncio.sleep(0)
+        fetch.assert_awaited_once_with(
+            self.callbacks.client, "!room:example.com", "$notice"
+        )
+        self.callbacks.join_confirm.release.assert_called_once_with(
+            "!room:example.com", "@new:example.com"
+        )
+
+    async def test_release_failed(self):
+        """Test that the confirmation is kept if releasing the user failed"""
+        await self.react(False)
+        self.callbacks.pending_confirmations.remove.assert_not_awaited()
+
+
+class RoomDispatcherTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_room_order(self):
+        """Test that jobs of a room run in order while rooms run concurrently"""
+        dispatcher = RoomDispatcher(workers=2)
+        results = []
+        release = asyncio.Event()
+
+        def make_job(room_id, i, wait=False):
+            async def job():
+                if wait:
+                    await release.wait()
+                results.append((room_id, i))
+
+            return job
+
+        # The first job of room A blocks until room B is done
+        dispatcher.submit("!a", make_job("!a", 0, wait=True))
+        dispatcher.submit("!a", make_job("!a", 1))
+        for i in range(3):
+            dispatcher.submit("!b", make_job("!b", i))
+        self.assertEqual(dispatcher.depth("!a"), 2)
+        self.assertEqual(dispatcher.depth(), 5)
+
+        while len(results) < 3:
+            await asyncio.sleep(0)
+        self.assertEqual(results, [("!b", 0), ("!b", 1), ("!b", 2)])
+
+        release.set()
+        await dispatcher.ready.join()
+        self.assertEqual(results[3:], [("!a", 0), ("!a", 1)])
+        self.assertEqual(dispatcher.depth(), 0)
+        self.assertEqual(dispatcher.stats()["processed"], 5)
+
+        for task in dispatcher.tasks:
+            task.cancel()
+
+    async def test_worker_restarted(self):
+        """Test that a worker that crashed is logged and replaced"""
+        dispatcher = RoomDispatcher(workers=1)
+        ran = asyncio.Event()
+
+        async def job():
+            ran.set()
+
+        dispatcher.submit("!a", job)
+        # Make the worker fail outside of the job
+        del dispatcher.room_queues["!a"]
+        with self.assertLogs("nyx_bot.callbacks", "ERROR") as logs:
+            for _ in range(5):
+                await asyncio.sleep(0)
+        self.assertIn("KeyError", logs.output[0])
+        self.assertEqual(len(dispatcher.tasks), 1)
+        self.assertFalse(dispatcher.tasks[0].done())
+
+        dispatcher.submit("!b", job)
+        await asyncio.wait_for(ran.wait(), 1)
+        await dispatcher.close()
+
+
+class HeavyLaneTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_interactive_first(self):
+        """Test that heavy jobs wait for interactive ones and are bounded"""
+        dispatcher = RoomDispatcher(workers=1)
+        lane = HeavyLane(dispatcher, workers=1, max_queued=2)
+        results = []
+        release = asyncio.Event()
+
+        def make_job(name, wait=False):
+            async def job():
+                if wait:
+                    await release.wait()
+                results.append(name)
+
+            return job
+
+        # The interactive worker is busy, and a ping is waiting behind it
+        dispatcher.submit("!a", make_job("busy", wait=True))
+        await asyncio.sleep(0)
+        dispatcher.submit("!b", make_job("ping"))
+        self.assertTrue(lane.submit("!c", make_job("render")))
+        self.assertTrue(lane.submit("!c", make_job("render")))
+        await asyncio.sleep(0)
+        # One job was taken by the worker, the queue is full again after this
+        self.assertTrue(lane.submit("!c", make_job("render")))
+        self.assertFalse(lane.submit("!c", make_job("render")))
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(results, [])
+
+        release.set()
+        await dispatcher.ready.join()
+        await lane.queue.join()
+        self.assertEqual(results, ["busy", "ping", "render", "render", "render"])
+        self.assertEqual(lane.rejected, 1)
+
+        for task in dispatcher.tasks + lane.tasks:
+            task.cancel()
+
 
 if __name__ == "__main__":
     unittest.main()
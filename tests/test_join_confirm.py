@@ -0,0 +1,85 @@
+import asyncio
+import os.path
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+from peewee import SqliteDatabase
+
+from nyx_bot.join_confirm import JoinConfirmBatcher, PendingConfirmations
+from nyx_bot.power_levels import PowerLevelCache
+from nyx_bot.storage import PendingConfirmation
+
+
+class JoinConfirmBatcherTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_coalesce(self):
+        """Test that changes of a room are written with one update"""
+        power_levels = Mock(spec=PowerLevelCache)
+        power_levels.get_content = AsyncMock(
+            return_value={"users": {"@old:example.com": -1}, "ban": 50}
+        )
+        power_levels.put_content = AsyncMock(return_value=True)
+        batcher = JoinConfirmBatcher(power_levels, window=0)
+
+        futures = [
+            batcher.restrict("!room", f"@user{i}:example.com") for i in range(50)
+        ]
+        futures.append(batcher.release("!room", "@old:example.com"))
+        # Joined and confirmed within the same window
+        futures.append(batcher.restrict("!room", "@quick:example.com"))
+        futures.append(batcher.release("!room", "@quick:example.com"))
+        self.assertTrue(all(await asyncio.gather(*futures)))
+
+        power_levels.put_content.assert_awaited_once()
+        room_id, content = power_levels.put_content.await_args.args
+        self.assertEqual(room_id, "!room")
+        self.assertEqual(len(content["users"]), 50)
+        self.assertEqual(content["users"]["@user0:example.com"], -1)
+        self.assertNotIn("@quick:example.com", content["users"])
+        self.assertEqual(content["events"]["m.reaction"], -1)
+        self.assertEqual(content["ban"], 50)
+
+        # A later change starts a new batch
+        self.assertTrue(await batcher.release("!room", "@user0:example.com"))
+        self.assertEqual(power_levels.put_content.await_count, 2)
+
+    async def test_failures(self):
+        """Test that failed or dropped updates resolve to False"""
+        power_levels = Mock(spec=PowerLevelCache)
+        power_levels.get_content = AsyncMock(side_effect=RuntimeError("nope"))
+        batcher = JoinConfirmBatcher(power_levels, window=0)
+        with self.assertLogs("nyx_bot.join_confirm", "ERROR"):
+            self.assertFalse(await batcher.restrict("!room", "@user:example.com"))
+
+        batcher = JoinConfirmBatcher(power_levels, window=60)
+        future = batcher.restrict("!room", "@user:example.com")
+        await asyncio.sleep(0)
+        await batcher.close()
+        self.assertFalse(await future)
+        self.assertEqual(batcher.tasks, set())
+
+
+class PendingConfirmationsTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = SqliteDatabase(os.path.join(self.tmpdir.name, "test.db"))
+        self.db.bind([PendingConfirmation])
+        self.db.create_tables([PendingConfirmation])
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    async def test_persisted(self):
+        """Test that pending confirmations survive a restart"""
+        pending = PendingConfirmations()
+        await pending.add("!room", "$notice1", "@alice:example.com", "🐱")
+        await pending.add("!room", "$notice2", "@bob:example.com", "🐶")
+        await pending.remove("!room", "$notice1")
+        self.assertIsNone(pending.get("!room", "$notice1"))
+
+        restarted = PendingConfirmations()
+        await restarted.load()
+        self.assertIsNone(restarted.get("!room", "$notice1"))
+        self.assertEqual(restarted.get("!room", "$notice2"), ("@bob:example.com", "🐶"))
+        self.assertIsNone(restarted.get("!other", "$notice2"))
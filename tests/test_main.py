@@ -0,0 +1,75 @@
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+from nio import AsyncClient, SyncError, UploadFilterError, UploadFilterResponse
+
+from nyx_bot.main import is_rejected_token, make_sync_filter, upload_sync_filter
+
+
+def make_sync_error(errcode, message, status=400):
+    resp = SyncError(message, errcode)
+    resp.transport_response = Mock(status=status)
+    return resp
+
+
+class SyncFilterTestCase(unittest.IsolatedAsyncioTestCase):
+    def test_make_sync_filter(self):
+        """Test that the filter follows the sync options"""
+        config = Mock(
+            sync_timeline_types=["m.room.message"], sync_lazy_load_members=True
+        )
+        room = make_sync_filter(config)["room"]
+        self.assertEqual(room["timeline"]["types"], ["m.room.message"])
+        self.assertTrue(room["timeline"]["lazy_load_members"])
+        self.assertTrue(room["state"]["lazy_load_members"])
+
+        config = Mock(sync_timeline_types=[], sync_lazy_load_members=False)
+        room = make_sync_filter(config)["room"]
+        # No types means every type
+        self.assertNotIn("types", room["timeline"])
+        self.assertFalse(room["timeline"]["lazy_load_members"])
+        self.assertFalse(room["state"]["lazy_load_members"])
+
+    async def test_upload_sync_filter(self):
+        """Test that the filter ID is used, or the filter itself on failure"""
+        sync_filter = make_sync_filter(
+            Mock(sync_timeline_types=[], sync_lazy_load_members=True)
+        )
+        client = Mock(spec=AsyncClient)
+        client.upload_filter = AsyncMock(return_value=UploadFilterResponse("1"))
+        self.assertEqual(await upload_sync_filter(client, sync_filter), "1")
+        client.upload_filter.assert_awaited_once_with(
+            presence=sync_filter["presence"], room=sync_filter["room"]
+        )
+
+        client.upload_filter.return_value = UploadFilterError("nope")
+        with self.assertLogs("nyx_bot.main", "WARNING"):
+            self.assertIs(await upload_sync_filter(client, sync_filter), sync_filter)
+
+
+class RejectedTokenTestCase(unittest.TestCase):
+    def test_invalid_token(self):
+        """Test that only errors about the since token reset the sync"""
+        self.assertTrue(
+            is_rejected_token(make_sync_error("M_UNKNOWN", "Invalid stream token"))
+        )
+        self.assertTrue(
+            is_rejected_token(make_sync_error("M_INVALID_PARAM", "Invalid since"))
+        )
+
+    def test_other_errors(self):
+        """Test that other failures keep the saved token"""
+        self.assertFalse(
+            is_rejected_token(make_sync_error("M_UNKNOWN_TOKEN", "Expired", 401))
+        )
+        self.assertFalse(
+            is_rejected_token(make_sync_error("M_UNKNOWN", "Internal error", 500))
+        )
+        self.assertFalse(
+            is_rejected_token(make_sync_error("M_LIMIT_EXCEEDED", "Slow down", 429))
+        )
+        self.assertFalse(is_rejected_token(SyncError("Connection reset")))
+
+
+if __name__ == "__main__":
+    unittest.main()
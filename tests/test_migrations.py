@@ -0,0 +1,55 @@
+import unittest
+
+from peewee import SqliteDatabase
+
+from nyx_bot.migrations import LATEST_VERSION, migrate_db
+from nyx_bot.storage import DatabaseVersion, MatrixMessage, MembershipUpdates, UserTag
+
+MODELS = [DatabaseVersion, MatrixMessage, MembershipUpdates, UserTag]
+
+
+class MigrationsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = SqliteDatabase(":memory:")
+        self.db.bind(MODELS)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_from_version_1(self):
+        """Test that every pending step is applied in turn"""
+        # Tables as they were in version 1
+        self.db.execute_sql(
+            "CREATE TABLE usertag (id INTEGER PRIMARY KEY, room_id VARCHAR, "
+            "sender VARCHAR, tag VARCHAR)"
+        )
+        self.db.execute_sql(
+            "CREATE TABLE matrixmessage (id INTEGER PRIMARY KEY, room_id VARCHAR, "
+            "event_id VARCHAR, origin_server_ts INTEGER, external_url VARCHAR, "
+            "sender VARCHAR, is_replacement INTEGER, replaced_by VARCHAR, "
+            "date DATE, datetime DATETIME)"
+        )
+        self.db.execute_sql(
+            "CREATE TABLE membershipupdates (id INTEGER PRIMARY KEY, "
+            "room_id VARCHAR, event_id VARCHAR, origin_server_ts INTEGER, "
+            "sender VARCHAR, state_key VARCHAR, avatar_url VARCHAR, "
+            "prev_avatar_url VARCHAR, name VARCHAR, prev_name VARCHAR, "
+            "date DATE, datetime DATETIME)"
+        )
+        self.db.create_tables([DatabaseVersion])
+        DatabaseVersion.create(version=1)
+
+        migrate_db(self.db)
+
+        self.assertEqual(DatabaseVersion.get().version, LATEST_VERSION)
+        usertag_columns = {column.name for column in self.db.get_columns("usertag")}
+        self.assertIn("locked", usertag_columns)
+        message_columns = {
+            column.name for column in self.db.get_columns("matrixmessage")
+        }
+        self.assertIn("body", message_columns)
+        self.assertIn("formatted_body", message_columns)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nyx_bot.power_levels import PowerLevelCache
+
+
+class PowerLevelCacheTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.client = Mock(spec=nio.AsyncClient)
+        self.client.room_get_state_event = AsyncMock(
+            return_value=nio.RoomGetStateEventResponse(
+                {"users": {"@admin:example.com": 100}, "ban": 50},
+                "m.room.power_levels",
+                "",
+                "!room:example.com",
+            )
+        )
+        self.client.room_put_state = AsyncMock(
+            return_value=nio.RoomPutStateResponse("$state", "!room:example.com")
+        )
+        self.power_levels = PowerLevelCache(self.client)
+
+    async def test_fetch_once(self):
+        """Test that the content is fetched once and written back whole"""
+        content = await self.power_levels.get_content("!room:example.com")
+        content["users"]["@new:example.com"] = -1
+        # The cached content isn't changed by callers
+        cached = await self.power_levels.get_content("!room:example.com")
+        self.assertNotIn("@new:example.com", cached["users"])
+        self.client.room_get_state_event.assert_awaited_once()
+
+        self.assertTrue(
+            await self.power_levels.put_content("!room:example.com", content)
+        )
+        self.assertEqual(self.client.room_put_state.await_args.args[2]["ban"], 50)
+        cached = await self.power_levels.get_content("!room:example.com")
+        self.assertEqual(cached["users"]["@new:example.com"], -1)
+        self.client.room_get_state_event.assert_awaited_once()
+
+    async def test_put_failure(self):
+        """Test that the cache is dropped when writing fails"""
+        self.client.room_put_state.return_value = nio.RoomPutStateError("Forbidden")
+        self.power_levels.update("!room:example.com", {"users": {}})
+        self.assertFalse(
+            await self.power_levels.put_content("!room:example.com", {"users": {}})
+        )
+        await self.power_levels.get_content("!room:example.com")
+        self.client.room_get_state_event.assert_awaited_once()
@@ -0,0 +1,58 @@
+import unittest
+from collections import defaultdict
+
+from nyx_bot.ratelimit import RateLimiter, TokenBucket
+
+
+def make_features(**overrides):
+    default = {
+        "room_commands_per_minute": 60,
+        "room_command_burst": 3,
+        "user_commands_per_minute": 60,
+        "user_command_burst": 2,
+    }
+    features = defaultdict(lambda: default)
+    for room_id, override in overrides.items():
+        features[room_id] = default | override
+    return features
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_refill(self):
+        bucket = TokenBucket(rate=1, burst=2, now=0)
+        self.assertTrue(bucket.consume(0))
+        self.assertTrue(bucket.consume(0))
+        self.assertFalse(bucket.consume(0.5))
+        self.assertTrue(bucket.consume(1.5))
+        # Never refilled past the burst size
+        bucket.refill(100)
+        self.assertEqual(bucket.tokens, 2)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_user_and_room(self):
+        """Test that users are limited first, and rooms independently"""
+        limiter = RateLimiter(make_features())
+        self.assertTrue(limiter.allow("!a", "@alice", now=0))
+        self.assertTrue(limiter.allow("!a", "@alice", now=0))
+        self.assertFalse(limiter.allow("!a", "@alice", now=0))
+        # The rejected command didn't use up the room limit
+        self.assertTrue(limiter.allow("!a", "@bob", now=0))
+        self.assertFalse(limiter.allow("!a", "@carol", now=0))
+        # Other rooms aren't affected
+        self.assertTrue(limiter.allow("!b", "@alice", now=0))
+        self.assertTrue(limiter.allow("!a", "@carol", now=1))
+
+    def test_overrides_and_slow_mode(self):
+        limiter = RateLimiter(make_features(**{"!a": {"room_commands_per_minute": 0}}))
+        for _ in range(2):
+            self.assertTrue(limiter.allow("!a", "@alice", now=0))
+            self.assertTrue(limiter.allow("!a", "@bob", now=0))
+            self.assertTrue(limiter.allow("!a", "@carol", now=0))
+
+        limiter.set_slow("!b", True)
+        self.assertTrue(limiter.allow("!b", "@alice", now=0))
+        self.assertFalse(limiter.allow("!b", "@bob", now=30))
+        self.assertTrue(limiter.allow("!b", "@bob", now=60))
+        limiter.set_slow("!b", False)
+        self.assertTrue(limiter.allow("!b", "@carol", now=60))
@@ -0,0 +1,26 @@
+import unittest
+
+from nyx_bot.errors import NyxBotRuntimeError
+from nyx_bot.render_pool import RenderPool
+
+
+class RenderPoolTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_run(self):
+        """Test that jobs run in a render process"""
+        pool = RenderPool(workers=1, max_queued=0)
+        try:
+            self.assertEqual(await pool.run(pow, 2, 10), 1024)
+        finally:
+            pool.shutdown()
+
+    async def test_queue_full(self):
+        """Test that jobs beyond the queue are refused"""
+        pool = RenderPool(workers=1, max_queued=1)
+        pool.running = 2
+        with self.assertRaises(NyxBotRuntimeError):
+            await pool.run(pow, 2, 10)
+        self.assertIsNone(pool.executor)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from nyx_bot.seen_events import BloomFilter, SeenEvents
+
+
+class BloomFilterTestCase(unittest.TestCase):
+    def test_false_positive_rate(self):
+        """Test that added keys are found and few others are"""
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(f"added {i}".encode())
+        self.assertTrue(all(f"added {i}".encode() in bloom for i in range(1000)))
+        false_positives = sum(f"other {i}".encode() in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.01, delta=0.005)
+
+
+class SeenEventsTestCase(unittest.TestCase):
+    def test_rotation(self):
+        """Test that the oldest events are forgotten after two rotations"""
+        seen = SeenEvents(capacity=10, error_rate=0.0001)
+        seen.add_many(("!room", f"$old{i}") for i in range(10))
+        seen.add_many(("!room", f"$mid{i}") for i in range(10))
+        self.assertIn(("!room", "$old0"), seen)
+        self.assertNotIn(("!other", "$old0"), seen)
+
+        seen.add("!room", "$new")
+        self.assertNotIn(("!room", "$old0"), seen)
+        self.assertIn(("!room", "$mid0"), seen)
+        self.assertIn(("!room", "$new"), seen)
+
+        stats = seen.stats()
+        self.assertEqual(stats["events"], 11)
+        self.assertEqual(stats["rotations"], 2)
+        self.assertEqual(stats["memory_bytes"], 2 * len(seen.current.bits))
+
+
+if __name__ == "__main__":
+    unittest.main()
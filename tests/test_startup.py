@@ -0,0 +1,18 @@
+import subprocess
+import sys
+import unittest
+
+
+class LazyImportTestCase(unittest.TestCase):
+    def test_heavy_modules_not_imported(self):
+        """Test that rendering and NLP libraries aren't loaded at startup"""
+        code = (
+            "import sys, nyx_bot.main; "
+            "print(' '.join(m for m in "
+            "('wand', 'magic', 'markdown', 'wordcloud', 'gi', 'cairo') "
+            "if m in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        self.assertEqual(result.stdout.strip(), "")
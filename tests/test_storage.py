@@ -0,0 +1,193 @@
+import asyncio
+import os.path
+import tempfile
+import threading
+import unittest
+from unittest.mock import Mock
+
+from nio import RoomMemberEvent, RoomMessageText
+from peewee import SqliteDatabase
+
+from nyx_bot.seen_events import seen_events
+from nyx_bot.storage import (
+    DatabaseExecutor,
+    MatrixMessage,
+    MembershipUpdates,
+    MessageRecorder,
+    QuoteCache,
+    run_db,
+)
+
+MODELS = [MatrixMessage, MembershipUpdates]
+
+
+def make_message(event_id, body, replaces=None):
+    content = {"msgtype": "m.text", "body": body}
+    if replaces:
+        content["m.relates_to"] = {"rel_type": "m.replace", "event_id": replaces}
+    return RoomMessageText.from_dict(
+        {
+            "event_id": event_id,
+            "sender": "@alice:example.com",
+            "origin_server_ts": 1700000000000,
+            "type": "m.room.message",
+            "content": content,
+        }
+    )
+
+
+def make_membership(event_id, name):
+    return RoomMemberEvent.from_dict(
+        {
+            "event_id": event_id,
+            "sender": "@alice:example.com",
+            "state_key": "@alice:example.com",
+            "origin_server_ts": 1700000000000,
+            "type": "m.room.member",
+            "content": {"membership": "join", "displayname": name},
+        }
+    )
+
+
+class DatabaseExecutorTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_run(self):
+        """Test that calls run off the event loop thread and return to the caller"""
+        executor = DatabaseExecutor(workers=1)
+        self.addCleanup(executor.shutdown)
+        thread = await executor.run(threading.current_thread)
+        self.assertIsNot(thread, threading.current_thread())
+        self.assertTrue(thread.name.startswith("nyx_bot-db"))
+        self.assertEqual(await executor.run(sum, [1, 2], start=3), 6)
+        with self.assertRaises(ZeroDivisionError):
+            await executor.run(lambda: 1 / 0)
+
+    async def test_run_db(self):
+        """Test that run_db goes through the shared database threads"""
+        thread = await run_db(threading.current_thread)
+        self.assertTrue(thread.name.startswith("nyx_bot-db"))
+        with self.assertRaises(KeyError):
+            await run_db({}.__getitem__, "missing")
+
+
+class MessageRecorderTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Rows are written from another thread, so use a file database
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = SqliteDatabase(os.path.join(self.tmpdir.name, "test.db"))
+        self.db.bind(MODELS)
+        self.db.create_tables(MODELS)
+        self.room = Mock()
+        self.room.room_id = "!room:example.com"
+        seen_events.configure(1000, 0.0001)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    async def test_batched_upsert(self):
+        """Test that recorded rows are written on flush and upserted"""
+        recorder = MessageRecorder(batch_size=100, flush_interval=60)
+        recorder.record_message(self.room, make_message("$1", "hello"), None, True)
+        recorder.record_message(
+            self.room, make_message("$2", "* hi", replaces="$1"), "$1", True
+        )
+        recorder.record_membership(self.room, make_membership("$3", "Alice"))
+        self.assertEqual(MatrixMessage.select().count(), 0)
+
+        await recorder.flush()
+        self.assertEqual(MatrixMessage.select().count(), 2)
+        original = MatrixMessage.get(MatrixMessage.event_id == "$1")
+        self.assertEqual(original.body, "hello")
+        self.assertEqual(original.replaced_by, "$2")
+        self.assertTrue(
+            MatrixMessage.get(MatrixMessage.event_id == "$2").is_replacement
+        )
+        self.assertEqual(MembershipUpdates.get().name, "Alice")
+
+        # Replaying without content keeps the recorded content and edit
+        recorder.record_message(self.room, make_message("$1", "hello"), None, False)
+        await recorder.close()
+        self.assertEqual(MatrixMessage.select().count(), 2)
+        original = MatrixMessage.get(MatrixMessage.event_id == "$1")
+        self.assertEqual(original.body, "hello")
+        self.assertEqual(original.replaced_by, "$2")
+
+    async def test_flush_on_batch_size(self):
+        """Test that a full batch is written without waiting for the timer"""
+        recorder = MessageRecorder(batch_size=2, flush_interval=60)
+        recorder.record_message(self.room, make_message("$1", "a"))
+        recorder.record_message(self.room, make_message("$2", "b"))
+        # The flush started right away
+        await asyncio.sleep(0)
+        self.assertEqual(recorder.pending(), 0)
+        await recorder.close()
+        self.assertEqual(MatrixMessage.select().count(), 2)
+
+    async def test_bulk_membership_skips_recorded(self):
+        """Test that memberships already recorded aren't written again"""
+        recorder = MessageRecorder(batch_size=100, flush_interval=60)
+        recorder.record_membership(self.room, make_membership("$1", "Alice"))
+        await recorder.flush()
+        MembershipUpdates.update(name="Renamed").execute()
+        # Forget it, like after a restart, so the database is checked
+        seen_events.configure(1000, 0.0001)
+
+        recorder.record_memberships(
+            self.room.room_id,
+            [make_membership("$1", "Alice"), make_membership("$2", "Bob")],
+        )
+        await recorder.close()
+        self.assertEqual(MembershipUpdates.select().count(), 2)
+        # The existing row was left alone
+        self.assertEqual(
+            MembershipUpdates.get(MembershipUpdates.event_id == "$1").name, "Renamed"
+        )
+
+    async def test_seen_events_skipped(self):
+        """Test that replayed events are skipped once recorded"""
+        recorder = MessageRecorder(batch_size=100, flush_interval=60)
+        recorder.record_message(self.room, make_message("$1", "hello"), None, True)
+        self.assertEqual(recorder.pending(), 1)
+        await recorder.flush()
+        self.assertIn((self.room.room_id, "$1"), seen_events)
+
+        recorder.record_membership(self.room, make_membership("$2", "Alice"))
+        await recorder.flush()
+
+        # Neither is buffered or looked up again
+        recorder.record_message(self.room, make_message("$1", "hello"), None, True)
+        recorder.record_membership(self.room, make_membership("$2", "Alice"))
+        self.assertEqual(recorder.pending(), 0)
+        await recorder.close()
+
+
+class QuoteCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = SqliteDatabase(":memory:")
+        self.db.bind([QuoteCache])
+        self.db.create_tables([QuoteCache])
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_lru_expiry(self):
+        """Test that the least recently used images are expired"""
+        QuoteCache.store("a", "mxc://a/1", "image/webp", 10, 1, 1, 1, 2)
+        QuoteCache.store("b", "mxc://a/2", "image/webp", 10, 1, 1, 2, 2)
+        self.assertEqual(QuoteCache.lookup("a", 3).content_uri, "mxc://a/1")
+        QuoteCache.store("c", "mxc://a/3", "image/webp", 10, 1, 1, 4, 2)
+        self.assertIsNone(QuoteCache.lookup("b", 5))
+        self.assertIsNotNone(QuoteCache.lookup("a", 5))
+        self.assertIsNotNone(QuoteCache.lookup("c", 5))
+
+    def test_store_again(self):
+        """Test that storing a key again replaces its image"""
+        QuoteCache.store("a", "mxc://a/1", "image/webp", 10, 1, 1, 1, 2)
+        QuoteCache.store("a", "mxc://a/2", "image/webp", 20, 2, 2, 2, 2)
+        self.assertEqual(QuoteCache.select().count(), 1)
+        row = QuoteCache.lookup("a", 3)
+        self.assertEqual((row.content_uri, row.size), ("mxc://a/2", 20))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+from nyx_bot.supervisor import ReconnectBackoff
+
+
+class ReconnectBackoffTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_backoff(self):
+        """Test that delays grow until capped and reset after a sync"""
+        backoff = ReconnectBackoff(initial_delay=1, max_delay=8)
+        with patch("nyx_bot.supervisor.asyncio.sleep", AsyncMock()) as sleep:
+            for _ in range(6):
+                await backoff.wait("Unable to connect to homeserver")
+        delays = [call.args[0] for call in sleep.await_args_list]
+        for delay, maximum in zip(delays, [1, 2, 4, 8, 8, 8]):
+            self.assertGreaterEqual(delay, maximum / 2)
+            self.assertLessEqual(delay, maximum)
+        self.assertEqual(backoff.failures, 6)
+
+        with self.assertLogs("nyx_bot.supervisor", "INFO") as logs:
+            await backoff.sync_succeeded(Mock())
+        self.assertIn("1 reconnects and 6 failures since start", logs.output[0])
+        stats = backoff.stats()
+        self.assertEqual(stats["reconnects"], 1)
+        self.assertEqual(stats["failures"], 0)
+        self.assertEqual(stats["total_failures"], 6)
+        self.assertEqual(stats["last_error"], "Unable to connect to homeserver")
+        self.assertLessEqual(backoff.next_delay(), 1)
+
+        with self.assertLogs("nyx_bot.supervisor", "WARNING") as logs, patch(
+            "nyx_bot.supervisor.asyncio.sleep", AsyncMock()
+        ):
+            await backoff.wait("Sync loop stopped")
+        self.assertIn("Connection lost after", logs.output[0])
@@ -0,0 +1,119 @@
+import os.path
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nyx_bot.sync_state import SyncStateStore
+
+ROOM_ID = "!room:example.com"
+
+
+def make_sync_response(next_batch, state, timeline=()):
+    return nio.SyncResponse.from_dict(
+        {
+            "next_batch": next_batch,
+            "rooms": {
+                "join": {
+                    ROOM_ID: {
+                        "state": {"events": list(state)},
+                        "timeline": {
+                            "events": list(timeline),
+                            "limited": False,
+                            "prev_batch": "p1",
+                        },
+                        "summary": {
+                            "m.heroes": ["@alice:example.com"],
+                            "m.joined_member_count": 2,
+                            "m.invited_member_count": 0,
+                        },
+                    }
+                }
+            },
+        }
+    )
+
+
+def make_state(type_, state_key, content, event_id):
+    return {
+        "type": type_,
+        "state_key": state_key,
+        "content": content,
+        "event_id": event_id,
+        "sender": "@admin:example.com",
+        "origin_server_ts": 1000,
+    }
+
+
+class SyncStateStoreTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sync_state.json")
+        self.recorder = Mock()
+        self.recorder.flush = AsyncMock(return_value=True)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_client(self):
+        client = nio.AsyncClient("https://example.com", "@bot:example.com")
+        client.user_id = "@bot:example.com"
+        return client
+
+    async def test_restore(self):
+        """Test that rooms are rebuilt from the saved state"""
+        client = self.make_client()
+        store = SyncStateStore(client, self.path, self.recorder)
+        self.assertIsNone(store.restore())
+
+        response = make_sync_response(
+            "s1",
+            [
+                make_state("m.room.name", "", {"name": "Old name"}, "$1"),
+                make_state(
+                    "m.room.member",
+                    "@alice:example.com",
+                    {"membership": "join", "displayname": "Alice"},
+                    "$2",
+                ),
+            ],
+            # Newer state from the timeline replaces older state
+            [make_state("m.room.name", "", {"name": "Test room"}, "$3")],
+        )
+        await client.receive_response(response)
+        await store.handle_sync(response)
+        await store.save()
+        self.assertFalse(store.dirty)
+
+        restored_client = self.make_client()
+        restored = SyncStateStore(restored_client, self.path, self.recorder)
+        self.assertEqual(restored.restore(), "s1")
+        self.assertEqual(restored_client.next_batch, "s1")
+        room = restored_client.rooms[ROOM_ID]
+        self.assertEqual(room.name, "Test room")
+        self.assertEqual(room.user_name("@alice:example.com"), "Alice")
+        self.assertEqual(room.member_count, 2)
+
+        restored.reset()
+        self.assertEqual(restored_client.rooms, {})
+        self.assertFalse(restored_client.next_batch)
+
+    async def test_saved_after_recording(self):
+        """Test that a token is only saved once the recorder has flushed"""
+        store = SyncStateStore(self.make_client(), self.path, self.recorder)
+        self.recorder.flush.return_value = False
+        await store.handle_sync(make_sync_response("s1", []))
+        await store.save()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(store.dirty)
+
+        self.recorder.flush.return_value = True
+        store.last_save = None
+        await store.handle_sync(make_sync_response("s2", []))
+        # The final save waits for the one started by the sync
+        self.assertFalse(store.save_task.done())
+        await store.save()
+        self.assertEqual(
+            SyncStateStore(self.make_client(), self.path, None).restore(), "s2"
+        )